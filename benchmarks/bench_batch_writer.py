@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""Compare per-message inserts with the group-commit BatchWriter.
+
+Runs against the storage configured in .env (DB_HOST, DB_USER, ...), e.g. the
+docker-compose MySQL on 127.0.0.1:3306, or an embedded database with
+STORAGE_BACKEND=sqlite SQLITE_PATH=/tmp/bench.db. Every benchmark email is addressed to
+BENCH_RECIPIENT and removed again at the end.
+
+    EMAIL_PROCESSOR_LOG=/tmp/email_processor.log python benchmarks/bench_batch_writer.py -n 2000 -t 20
+"""
+
+import os, sys, threading, time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "postfix"))
+
+import email_processor
+from email_processor import MailJson, insert_email_data
+from batch_writer import BatchWriter
+
+BENCH_RECIPIENT = "bench@benchmark.invalid"
+
+MESSAGE = """From: Bench Sender <sender@benchmark.invalid>
+To: Bench <%s>
+Subject: benchmark message %%d
+Date: Mon, 01 Jan 2024 10:00:00 +0000
+Content-Type: text/plain; charset=utf-8
+
+Body of benchmark message %%d.
+""" % BENCH_RECIPIENT
+
+
+def run(store, count, threads):
+    """Store count messages from threads concurrent senders, returns elapsed seconds."""
+    messages = [MailJson(MESSAGE % (i, i)).parse() for i in range(count)]
+    failures = []
+
+    def sender(chunk):
+        for data in chunk:
+            if store(data) is None:
+                failures.append(data)
+
+    workers = [threading.Thread(target=sender, args=(messages[i::threads],)) for i in range(threads)]
+    started = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - started
+    if failures:
+        print("  %d inserts failed" % len(failures))
+    return elapsed
+
+
+def cleanup():
+    storage = email_processor.storage
+    while True:
+        with storage.cursor() as cursor:
+            cursor.execute("SELECT id FROM emails WHERE to_email = %s LIMIT 1000", (BENCH_RECIPIENT,))
+            email_ids = [row['id'] for row in cursor.fetchall()]
+        if not email_ids:
+            return
+        storage.delete_emails(email_ids)
+
+
+def report(name, count, elapsed):
+    print("%-28s %7d msgs %8.2f s %10.1f msgs/s" % (name, count, elapsed, count / elapsed))
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-n", "--count", dest="count", type="int", default=1000, help="messages per run")
+    parser.add_option("-t", "--threads", dest="threads", type="int", default=10, help="concurrent senders")
+    parser.add_option("-b", "--batch-size", dest="batch_size", type="int", default=50)
+    parser.add_option("-l", "--max-latency-ms", dest="max_latency_ms", type="int", default=20)
+    (options, args) = parser.parse_args()
+
+    try:
+        elapsed = run(insert_email_data, options.count, options.threads)
+        report("per-message transaction", options.count, elapsed)
+
+        writer = BatchWriter(options.batch_size, options.max_latency_ms)
+        try:
+            elapsed = run(writer.insert, options.count, options.threads)
+        finally:
+            writer.close()
+        report("batched (size=%d, %dms)" % (options.batch_size, options.max_latency_ms), options.count, elapsed)
+    finally:
+        cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+"""Measure the CPU, storage and latency trade-off of column compression.
+
+For every codec setting the messages are parsed once and then stored in a
+fresh embedded SQLite database (STORAGE_BACKEND=sqlite, so no server is
+needed), reporting the compression ratio of the compressed columns, ingest
+time, database size and the time to read pages of rendered parts back.
+
+Messages come from a directory of .eml files, or are generated HTML
+newsletters with verbose headers when none is given.
+
+    python benchmarks/bench_compression.py -n 2000
+    python benchmarks/bench_compression.py -d /path/to/eml/files
+"""
+
+import os, sys, glob, json, random, shutil, tempfile, time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "postfix"))
+os.environ.setdefault("EMAIL_PROCESSOR_LOG", os.path.join(tempfile.gettempdir(), "email_processor.log"))
+os.environ.setdefault("MAIL_EVENTS_ADDR", "")
+os.environ.setdefault("STORAGE_BACKEND", "sqlite")
+os.environ.setdefault("SQLITE_PATH", os.path.join(tempfile.gettempdir(), "bench_compression.db"))
+
+from email_processor import MailJson
+from mailstore.sqlite import SQLiteStorage
+from mailstore.codec import Compressor, zstandard
+from mailstore.render import render_headers, render_part_content
+
+BENCH_RECIPIENT = "bench@benchmark.invalid"
+
+SETTINGS = [("none", None), ("zlib", 1), ("zlib", 6), ("zlib", 9), ("zstd", 3), ("zstd", 9)]
+
+WORDS = ("offer newsletter weekly update product launch discount member exclusive event webinar "
+         "customer account security report summary invoice shipping delivery tracking").split()
+
+
+def newsletter(i):
+    """A synthetic HTML newsletter with the header bloat of a typical bulk sender."""
+    rnd = random.Random(i)
+    received = "".join("Received: from mx%d.sender.invalid (mx%d.sender.invalid [10.0.%d.%d])\n"
+                       "\tby mail.benchmark.invalid with ESMTPS id %08x\n\tfor <%s>; Mon, 01 Jan 2024 10:00:00 +0000\n"
+                       % (n, n, n, rnd.randrange(255), rnd.getrandbits(32), BENCH_RECIPIENT) for n in range(4))
+    rows = "".join('<tr><td style="padding:12px;font-family:Arial,sans-serif;color:#333333">'
+                   '<a href="https://sender.invalid/track/%08x?utm_source=newsletter&amp;utm_medium=email">%s</a>'
+                   '</td></tr>\n' % (rnd.getrandbits(32), " ".join(rnd.choice(WORDS) for _ in range(12)))
+                   for _ in range(rnd.randrange(20, 80)))
+    return ("%sFrom: Sender <news@sender.invalid>\nTo: Bench <%s>\nSubject: newsletter %d\n"
+            "Date: Mon, 01 Jan 2024 10:00:00 +0000\nList-Unsubscribe: <https://sender.invalid/u/%08x>\n"
+            "DKIM-Signature: v=1; a=rsa-sha256; d=sender.invalid; s=s1; h=from:to:subject:date; b=%s\n"
+            "Content-Type: text/html; charset=utf-8\n\n<html><body><table>\n%s</table></body></html>\n"
+            % (received, BENCH_RECIPIENT, i, rnd.getrandbits(32), "%064x" % rnd.getrandbits(256), rows)).encode("utf-8")
+
+
+def load_messages(options):
+    if options.directory:
+        paths = sorted(glob.glob(os.path.join(options.directory, "*.eml")))[:options.count]
+        raw = [open(path, "rb").read() for path in paths]
+    else:
+        raw = [newsletter(i) for i in range(options.count)]
+    messages = [MailJson(content).parse() for content in raw]
+    for data in messages:
+        data["envelope-to"] = [BENCH_RECIPIENT]
+    return messages
+
+
+def run(messages, codec, level, options):
+    compressor = Compressor(codec, options.min_bytes, level)
+    directory = tempfile.mkdtemp(prefix="bench_compression_")
+    try:
+        storage = SQLiteStorage(os.path.join(directory, "emails.db"), compressor=compressor)
+
+        started = time.perf_counter()
+        email_ids = []
+        for i in range(0, len(messages), options.batch_size):
+            email_ids.extend(storage.insert_email_batch(messages[i:i + options.batch_size]))
+        ingest = time.perf_counter() - started
+
+        with storage.cursor() as cursor:
+            cursor.execute("SELECT COALESCE(SUM(LENGTH(CAST(raw_headers AS BLOB))), 0) + COALESCE(SUM(LENGTH(CAST(rendered_headers AS BLOB))), 0) AS size FROM emails")
+            stored = cursor.fetchone()["size"]
+            cursor.execute("SELECT COALESCE(SUM(LENGTH(CAST(content AS BLOB))), 0) + COALESCE(SUM(LENGTH(CAST(rendered_content AS BLOB))), 0) AS size FROM email_parts")
+            stored += cursor.fetchone()["size"]
+            cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        size = os.path.getsize(os.path.join(directory, "emails.db"))
+
+        pages = [email_ids[i:i + options.page_size] for i in range(0, len(email_ids), options.page_size)]
+        started = time.perf_counter()
+        with storage.cursor() as cursor:
+            for page in pages:
+                storage.select_parts(cursor, page)
+        read = (time.perf_counter() - started) / len(pages)
+        return ingest, stored, size, read
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def plain_size(messages):
+    """Bytes the compressed columns take uncompressed, for the ratio."""
+    total = 0
+    for data in messages:
+        total += len(json.dumps(data["headers"]).encode("utf-8")) + len(render_headers(data["headers"]).encode("utf-8"))
+        for part in data["parts"]:
+            total += len(part["content"].encode("utf-8")) + len(render_part_content(part["content"]).encode("utf-8"))
+    return total
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-n", "--count", dest="count", type="int", default=1000, help="messages per run")
+    parser.add_option("-d", "--directory", dest="directory", help="read up to COUNT .eml files from DIRECTORY")
+    parser.add_option("-m", "--min-bytes", dest="min_bytes", type="int", default=512, help="COMPRESSION_MIN_BYTES")
+    parser.add_option("-b", "--batch-size", dest="batch_size", type="int", default=50, help="messages per insert transaction")
+    parser.add_option("-p", "--page-size", dest="page_size", type="int", default=100, help="emails per read")
+    (options, args) = parser.parse_args()
+
+    messages = load_messages(options)
+    plain = plain_size(messages)
+    print("%d messages, %.1f MB in compressed columns uncompressed\n" % (len(messages), plain / 1024 / 1024))
+    print("%-10s %8s %12s %12s %12s %14s" % ("codec", "ratio", "ingest msg/s", "columns MB", "db file MB", "read ms/page"))
+    for codec, level in SETTINGS:
+        if codec == "zstd" and zstandard is None:
+            print("%-10s skipped, zstandard is not installed" % ("zstd-%d" % level))
+            continue
+        ingest, stored, size, read = run(messages, codec, level, options)
+        name = codec if level is None else "%s-%d" % (codec, level)
+        print("%-10s %7.2fx %12.0f %12.2f %12.2f %14.2f" % (name, plain / stored, len(messages) / ingest,
+                                                            stored / 1024 / 1024, size / 1024 / 1024, read * 1000))
+
+
+if __name__ == "__main__":
+    main()
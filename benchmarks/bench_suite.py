@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+
+"""Reproducible benchmarks of the ingest and API hot paths.
+
+The deterministic corpus of corpus.py is parsed with MailJson, stored in a
+fresh embedded SQLite database (the local stand-in for MySQL, no server
+needed) and read back through GET /emails with the Flask test client. Each
+stage reports throughput, latency percentiles and peak RSS, and the results
+are saved as JSON so two versions can be compared:
+
+    python benchmarks/bench_suite.py -n 300 -o before.json
+    python benchmarks/bench_suite.py -n 300 -o after.json --baseline before.json
+    python benchmarks/bench_suite.py --compare before.json after.json
+
+Stages:
+
+    parse          MailJson(raw).parse(), per message
+    insert         insert_email_data(), one transaction per message
+    insert_batch   insert_email_batch(), --batch-size messages per transaction, into a second database
+    api            GET /emails pages of --page-size for every corpus mailbox, following next_cursor,
+                   with the response cache off
+    api_cached     the same requests again, answered from the response cache
+    api_ndjson     every mailbox streamed whole with format=ndjson
+
+--compare exits with status 1 when a metric got worse by more than
+--threshold percent, for use in CI.
+"""
+
+import os, sys, json, hashlib, math, platform, resource, shutil, sqlite3, subprocess, tempfile, threading, time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from optparse import OptionParser
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCHMARKS, "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "postfix"))
+sys.path.insert(0, os.path.join(ROOT, "flask_app"))
+
+import corpus
+
+RESULTS_FORMAT = 1
+API_KEY = "bench"
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+# (metric, True if higher is better) checked by --compare
+COMPARED_METRICS = [("throughput_per_second", True), ("mb_per_second", True), ("latency_ms.p50", False),
+                    ("latency_ms.p99", False), ("peak_rss_mb", False)]
+
+
+def current_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        # Not Linux: the peak so far, in kilobytes (bytes on macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class PeakRSS:
+    """Highest resident set size while the block runs, sampled every few milliseconds."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        self.start = self.peak = current_rss()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+
+def percentile(ordered, p):
+    """Nearest-rank percentile of an ascending list."""
+    if not ordered:
+        return None
+    return ordered[max(0, math.ceil(p / 100.0 * len(ordered)) - 1)]
+
+
+def measure(operations):
+    """Run (kind, size in bytes, function) operations one at a time and summarize them.
+
+    Only the functions are timed; returns the stage result and what the functions returned.
+    """
+    latencies = []
+    by_kind = defaultdict(list)
+    total_bytes = 0
+    results = []
+    with PeakRSS() as rss:
+        for kind, size, function in operations:
+            started = time.perf_counter()
+            results.append(function())
+            elapsed = time.perf_counter() - started
+            latencies.append(elapsed)
+            by_kind[kind].append(elapsed)
+            total_bytes += size
+    seconds = sum(latencies)
+    ordered = sorted(latencies)
+    ms = lambda value: round(value * 1000, 3)
+    return {
+        "operations": len(latencies),
+        "bytes": total_bytes,
+        "seconds": round(seconds, 4),
+        "throughput_per_second": round(len(latencies) / seconds, 1) if seconds else None,
+        "mb_per_second": round(total_bytes / seconds / corpus.MB, 2) if seconds else None,
+        "latency_ms": {
+            "mean": ms(seconds / len(latencies)) if latencies else None,
+            "p50": ms(percentile(ordered, 50)) if latencies else None,
+            "p90": ms(percentile(ordered, 90)) if latencies else None,
+            "p99": ms(percentile(ordered, 99)) if latencies else None,
+            "max": ms(ordered[-1]) if latencies else None,
+        },
+        "by_kind": {kind: {"operations": len(values), "p50_ms": ms(percentile(sorted(values), 50)),
+                           "max_ms": ms(max(values))} for kind, values in sorted(by_kind.items())},
+        "peak_rss_mb": round(rss.peak / corpus.MB, 1),
+        "rss_growth_mb": round((rss.peak - rss.start) / corpus.MB, 1),
+    }, results
+
+
+def setup_environment(directory):
+    """Point the ingest and API modules at a fresh embedded database before they are imported."""
+    os.environ["STORAGE_BACKEND"] = "sqlite"
+    os.environ["SQLITE_PATH"] = os.path.join(directory, "emails.db")
+    os.environ["EMAIL_PROCESSOR_LOG"] = os.path.join(directory, "email_processor.log")
+    os.environ["MAIL_EVENTS_ADDR"] = ""
+    os.environ["MAIL_EVENTS_PORT"] = "0"
+    os.environ["RETENTION_POLICIES"] = ""
+    os.environ["API_KEY"] = API_KEY
+
+
+def run_parse(messages):
+    from email_processor import MailJson
+
+    def parse(message):
+        data = MailJson(message.raw).parse()
+        data["envelope-to"] = [message.recipient]
+        return data
+
+    return measure((message.kind, len(message.raw), lambda message=message: parse(message)) for message in messages)
+
+
+def run_insert(messages, parsed):
+    from email_processor import insert_email_data
+    return measure((message.kind, len(message.raw), lambda data=data: insert_email_data(data))
+                   for message, data in zip(messages, parsed))
+
+
+def run_insert_batch(messages, parsed, batch_size, directory):
+    from mailstore.sqlite import SQLiteStorage
+    storage = SQLiteStorage(os.path.join(directory, "batch.db"))
+    batches = []
+    for i in range(0, len(parsed), batch_size):
+        batches.append((sum(len(message.raw) for message in messages[i:i + batch_size]), parsed[i:i + batch_size]))
+    return measure(("batch", size, lambda batch=batch: storage.insert_email_batch(batch)) for size, batch in batches)
+
+
+def api_get(client, url):
+    """GET url and return the body, which runs streamed responses to the end."""
+    response = client.get(url)
+    body = response.get_data()
+    response.close()
+    if response.status_code not in (200, 404):
+        raise RuntimeError("GET %s answered %d: %s" % (url, response.status_code, body[:200]))
+    return body
+
+
+def page_urls(client, page_size):
+    """The page URLs of every corpus mailbox, found by following next_cursor."""
+    urls = []
+    for i in range(corpus.MAILBOXES):
+        url = "/emails?api_key=%s&to_email=%s&limit=%d" % (API_KEY, corpus.mailbox(i), page_size)
+        while url is not None:
+            urls.append(url)
+            next_cursor = json.loads(api_get(client, url)).get("next_cursor")
+            url = "/emails?api_key=%s&to_email=%s&limit=%d&after=%s" % (
+                API_KEY, corpus.mailbox(i), page_size, next_cursor) if next_cursor else None
+    return urls
+
+
+def run_api(urls, kind):
+    import app
+    client = app.app.test_client()
+    operations = []
+    for url in urls:
+        operations.append((kind, 0, lambda url=url: api_get(client, url)))
+    result, bodies = measure(operations)
+    # Response sizes are only known afterwards
+    result["bytes"] = sum(len(body) for body in bodies)
+    if result["seconds"]:
+        result["mb_per_second"] = round(result["bytes"] / result["seconds"] / corpus.MB, 2)
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(options):
+    directory = tempfile.mkdtemp(prefix="bench_suite_")
+    try:
+        setup_environment(directory)
+        import email_processor
+        import app
+
+        messages = list(corpus.generate(options.count, options.seed, int(options.max_attachment_mb * corpus.MB)))
+        digest = hashlib.sha256()
+        for message in messages:
+            digest.update(hashlib.sha256(message.raw).digest())
+        print("Corpus: %d messages, %.1f MB (%s)" % (len(messages), sum(len(m.raw) for m in messages) / corpus.MB,
+                                                     ", ".join("%d %s" % (n, kind) for kind, n in
+                                                               sorted(Counter(m.kind for m in messages).items()))),
+              flush=True)
+
+        stages = {}
+
+        def done(name, result):
+            stages[name] = result
+            print("%-13s %8s ops/s %8s MB/s   p50 %9.3f ms   p99 %9.3f ms   peak RSS %7.1f MB" % (
+                name, result["throughput_per_second"], result["mb_per_second"], result["latency_ms"]["p50"],
+                result["latency_ms"]["p99"], result["peak_rss_mb"]), flush=True)
+
+        result, parsed = run_parse(messages)
+        done("parse", result)
+        result, email_ids = run_insert(messages, parsed)
+        if None in email_ids:
+            raise RuntimeError("%d inserts failed, see %s" % (email_ids.count(None), os.environ["EMAIL_PROCESSOR_LOG"]))
+        done("insert", result)
+        done("insert_batch", run_insert_batch(messages, parsed, options.batch_size, directory)[0])
+        del parsed
+
+        urls = page_urls(app.app.test_client(), options.page_size)
+        # page_urls() filled the cache; with max_entries 0 nothing stored from here on is kept
+        max_entries = app.response_cache.max_entries
+        app.response_cache.max_entries = 0
+        app.response_cache.invalidate_all()
+        done("api", run_api(urls, "page"))
+        app.response_cache.max_entries = max_entries
+        for url in urls:
+            api_get(app.app.test_client(), url)
+        done("api_cached", run_api(urls, "page"))
+        done("api_ndjson", run_api(["/emails?api_key=%s&to_email=%s&format=ndjson" % (API_KEY, corpus.mailbox(i))
+                                    for i in range(corpus.MAILBOXES)], "mailbox"))
+
+        return {
+            "format": RESULTS_FORMAT,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "version": email_processor.VERSION,
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "storage": "sqlite %s" % sqlite3.sqlite_version,
+            "corpus": {
+                "count": options.count,
+                "seed": options.seed,
+                "max_attachment_mb": options.max_attachment_mb,
+                "bytes": sum(len(message.raw) for message in messages),
+                "sha256": digest.hexdigest(),
+                "kinds": dict(Counter(message.kind for message in messages)),
+            },
+            "options": {"batch_size": options.batch_size, "page_size": options.page_size},
+            "stages": stages,
+        }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _metric(stage, name):
+    value = stage
+    for key in name.split("."):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def compare(baseline, current, threshold):
+    """Print every compared metric of two results; returns the number that got worse by more than threshold %."""
+    if baseline["corpus"]["sha256"] != current["corpus"]["sha256"]:
+        print("Warning: the results are from different corpora, compare runs with the same -n, -s and -m\n")
+    print("%-13s %-22s %12s %12s %9s" % ("stage", "metric", "baseline", "current", "change"))
+    regressions = 0
+    for name, stage in current["stages"].items():
+        old_stage = baseline["stages"].get(name)
+        if old_stage is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS:
+            old, new = _metric(old_stage, metric), _metric(stage, metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            worse = -change if higher_is_better else change
+            flag = ""
+            if worse > threshold:
+                flag = "  REGRESSION"
+                regressions += 1
+            print("%-13s %-22s %12s %12s %+8.1f%%%s" % (name, metric, old, new, change, flag))
+    return regressions
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]\n       %prog --compare BASELINE.json CURRENT.json")
+    parser.add_option("-n", "--count", dest="count", type="int", default=300, help="messages in the corpus")
+    parser.add_option("-s", "--seed", dest="seed", type="int", default=1, help="corpus seed")
+    parser.add_option("-m", "--max-attachment-mb", dest="max_attachment_mb", type="float", default=50,
+                      help="cap attachment sizes, e.g. 1 for a quick run")
+    parser.add_option("-b", "--batch-size", dest="batch_size", type="int", default=50,
+                      help="messages per transaction in insert_batch")
+    parser.add_option("-p", "--page-size", dest="page_size", type="int", default=20, help="emails per GET /emails page")
+    parser.add_option("-o", "--output", dest="output", help="write the results to OUTPUT as JSON")
+    parser.add_option("--baseline", dest="baseline", help="compare the results with an earlier results file")
+    parser.add_option("--compare", dest="compare", action="store_true", default=False,
+                      help="only compare two results files")
+    parser.add_option("-t", "--threshold", dest="threshold", type="float", default=10,
+                      help="percent a metric may get worse before it counts as a regression")
+    (options, args) = parser.parse_args()
+
+    if options.compare:
+        if len(args) != 2:
+            parser.error("--compare takes a baseline and a current results file")
+        sys.exit(1 if compare(load(args[0]), load(args[1]), options.threshold) else 0)
+
+    results = run_suite(options)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Results written to %s" % options.output)
+    if options.baseline:
+        print()
+        sys.exit(1 if compare(load(options.baseline), results, options.threshold) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""Check that the MailJson fast path parses exactly like the original code.
+
+Every message of the benchmark corpus (and of --directory, if given) is
+parsed with MAILJSON_FAST_PATH off and on, and the results, or the
+exceptions, must be equal. Address parsing is also compared on a fixed
+list of edge cases and on random strings made of the characters that
+matter to email_re.
+
+    python benchmarks/check_parse_equivalence.py -n 1000 -d /path/to/eml/files
+
+Exits with status 1 on the first few differences, which are printed.
+"""
+
+import os, sys, glob, random, tempfile
+from optparse import OptionParser
+
+import corpus
+from bench_suite import setup_environment
+
+EDGE_CASES = [
+    "", "a@b.co", "a.b@c.org", "a.@b.co", ".a@b.co", "a..b@c.org", "a@b", "a@b.c", "a@b.co.", "a@b..co", "a@-b.co",
+    "a@b-.co", "a@b.c-m", "a@1.23", "a@b.123", "a@@b.co", "@b.co", "a@", "a@[1.2.3.4]", "a@[300.1.1.1]",
+    "a@b.co\n", "ä@b.co", "a@ı.co", "K@b.co", "a@" + "x" * 63 + ".co", "a@" + "x" * 64 + ".co",
+    "x{|}~`!#$%&'*+/=?^_@b.co", "Name <a@b.co>", "Name a@b.co", "<a@b.co>", "x <y>", "Name", '"Doe, John" <j@d.org>',
+    "a@b.co, c@d.org", "Bob <bob@example.com>, <alice@example.org>, carol@example.net", "<a+tag@b.co> a+tag@b.co",
+    "=?utf-8?q?Jos=C3=A9?= <jose@example.com>", "a\0b@c.org",
+]
+FUZZ_ALPHABET = "ab1-.@[]<> \",ı"
+
+
+def parse_outcome(email_processor, raw, fast):
+    email_processor.MAILJSON_FAST_PATH = fast
+    try:
+        return "parsed", email_processor.MailJson(raw).parse()
+    except Exception as e:
+        return "raised", "%s: %s" % (type(e).__name__, e)
+
+
+def recipients_outcome(email_processor, value, fast):
+    email_processor.MAILJSON_FAST_PATH = fast
+    try:
+        return email_processor.MailJson()._parse_recipients(value)
+    except Exception as e:
+        return "%s: %s" % (type(e).__name__, e)
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-n", "--count", dest="count", type="int", default=1000, help="corpus messages")
+    parser.add_option("-s", "--seed", dest="seed", type="int", default=1)
+    parser.add_option("-m", "--max-attachment-mb", dest="max_attachment_mb", type="float", default=1)
+    parser.add_option("-d", "--directory", dest="directory", help="also check the .eml files in DIRECTORY")
+    parser.add_option("-f", "--fuzz", dest="fuzz", type="int", default=50000, help="random address strings")
+    (options, args) = parser.parse_args()
+
+    setup_environment(tempfile.mkdtemp(prefix="check_parse_"))
+    import email_processor
+
+    messages = [(message.kind, message.raw) for message in
+                corpus.generate(options.count, options.seed, int(options.max_attachment_mb * corpus.MB))]
+    if options.directory:
+        for path in sorted(glob.glob(os.path.join(options.directory, "*.eml"))):
+            with open(path, "rb") as f:
+                messages.append((path, f.read()))
+
+    differences = []
+    for name, raw in messages:
+        original, fast = parse_outcome(email_processor, raw, False), parse_outcome(email_processor, raw, True)
+        if original != fast:
+            differences.append("message %s: %r != %r" % (name, original, fast))
+
+    rnd = random.Random(options.seed)
+    values = EDGE_CASES + ["".join(rnd.choice(FUZZ_ALPHABET) for _ in range(rnd.randrange(1, 16)))
+                           for _ in range(options.fuzz)]
+    for value in values:
+        if email_processor._is_email(value) != (email_processor.email_re.match(value) is not None):
+            differences.append("email_re on %r" % value)
+        original, fast = recipients_outcome(email_processor, value, False), recipients_outcome(email_processor, value, True)
+        if original != fast:
+            differences.append("recipients %r: %r != %r" % (value, original, fast))
+
+    print("%d messages and %d address strings compared, %d differences" % (len(messages), len(values), len(differences)))
+    for difference in differences[:20]:
+        print(difference[:500])
+    sys.exit(1 if differences else 0)
+
+
+if __name__ == "__main__":
+    main()
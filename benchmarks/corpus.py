@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+"""Deterministic synthetic MIME corpus for the benchmarks.
+
+The same seed and count always give byte-identical messages, so results are
+comparable between versions. Messages cycle through these kinds:
+
+    plain             text/plain, UTF-8 with some non-ASCII words
+    html              multipart/alternative, text and a newsletter-style HTML body
+    nested            multipart/mixed nested 4 to 8 levels deep
+    encoded_subject   RFC 2047 subject and display names, UTF-8 and ISO-8859-1, B and Q
+    many_recipients   150 To and 100 Cc addresses
+    attachment        a base64 attachment of 1 KB to 50 MB
+
+Attachments from 1 MB up are rare: one in ten attachment messages carries
+one, taking the large sizes in turn. Every message is delivered to one of
+MAILBOXES corpus mailboxes.
+
+    python benchmarks/corpus.py -n 500 -o /tmp/corpus    # write .eml files, e.g. for bench_compression.py -d
+"""
+
+import os, base64, random
+from collections import namedtuple
+from email.header import Header
+from optparse import OptionParser
+
+MAILBOXES = 20
+DOMAIN = "corpus.invalid"
+
+KIND_CYCLE = ["plain", "html", "plain", "nested", "encoded_subject", "html", "many_recipients", "plain",
+              "attachment", "attachment"]
+KINDS = sorted(set(KIND_CYCLE))
+
+KB = 1024
+MB = 1024 * KB
+SMALL_ATTACHMENT_SIZES = [1 * KB, 10 * KB, 100 * KB]
+LARGE_ATTACHMENT_SIZES = [1 * MB, 10 * MB, 50 * MB]
+
+Message = namedtuple("Message", ["kind", "recipient", "raw"])
+
+WORDS = ("offer newsletter weekly update product launch discount member exclusive event webinar customer account "
+         "security report summary invoice shipping delivery tracking größe café naïve résumé Grüße смета заказ").split()
+NAMES = ["Alice Müller", "Bob Smith", "Chloé Dubois", "Dmitri Иванов", "Eva Novák", "François Lefèvre", "Gül Yılmaz"]
+
+
+def mailbox(i):
+    return "mailbox%02d@%s" % (i % MAILBOXES, DOMAIN)
+
+
+def _sentence(rnd, words=12):
+    return " ".join(rnd.choice(WORDS) for _ in range(words))
+
+
+def _text(rnd, lines):
+    return "".join(_sentence(rnd) + "\n" for _ in range(lines))
+
+
+def _html(rnd, rows):
+    return ("<html><body><table>\n%s</table></body></html>\n"
+            % "".join('<tr><td style="padding:12px;font-family:Arial,sans-serif;color:#333333">'
+                      '<a href="https://sender.invalid/track/%08x?utm_source=newsletter&amp;utm_medium=email">%s</a>'
+                      '</td></tr>\n' % (rnd.getrandbits(32), _sentence(rnd)) for _ in range(rows)))
+
+
+def _display_name(rnd):
+    """A display name from NAMES, RFC 2047 encoded unless it is plain ASCII."""
+    name = rnd.choice(NAMES)
+    return name if name.isascii() else Header(name, "utf-8").encode()
+
+
+def _boundary(i, level):
+    return "=_corpus_%d_%d" % (i, level)
+
+
+def _headers(i, rnd, recipient, subject, sender="Corpus Sender <sender@sender.invalid>", extra=""):
+    received = "".join("Received: from mx%d.sender.invalid (mx%d.sender.invalid [10.0.%d.%d])\n"
+                       "\tby mail.%s with ESMTPS id %08x\n\tfor <%s>; Mon, 01 Jan 2024 10:00:00 +0000\n"
+                       % (n, n, n, rnd.randrange(255), DOMAIN, rnd.getrandbits(32), recipient) for n in range(2))
+    return ("%sFrom: %s\nTo: %s\nSubject: %s\nDate: Mon, 01 Jan 2024 %02d:%02d:%02d +0000\n"
+            "Message-ID: <%d.%08x@sender.invalid>\nMIME-Version: 1.0\n%s"
+            % (received, sender, recipient, subject, i // 3600 % 24, i // 60 % 60, i % 60, i, rnd.getrandbits(32), extra))
+
+
+def _text_part(rnd, lines):
+    return "Content-Type: text/plain; charset=utf-8\nContent-Transfer-Encoding: 8bit\n\n" + _text(rnd, lines)
+
+
+def _multipart(subtype, boundary, parts):
+    body = "".join("--%s\n%s\n" % (boundary, part) for part in parts)
+    return 'Content-Type: multipart/%s; boundary="%s"\n\n%s--%s--\n' % (subtype, boundary, body, boundary)
+
+
+def plain(i, rnd):
+    return _headers(i, rnd, mailbox(i), "plain message %d" % i) + _text_part(rnd, rnd.randrange(20, 200))
+
+
+def html(i, rnd):
+    alternative = _multipart("alternative", _boundary(i, 0), [
+        _text_part(rnd, rnd.randrange(5, 20)),
+        "Content-Type: text/html; charset=utf-8\nContent-Transfer-Encoding: 8bit\n\n" + _html(rnd, rnd.randrange(20, 80)),
+    ])
+    return _headers(i, rnd, mailbox(i), "newsletter %d" % i) + alternative
+
+
+def nested(i, rnd):
+    depth = rnd.randrange(4, 9)
+    inner = _multipart("alternative", _boundary(i, depth), [
+        _text_part(rnd, 5),
+        "Content-Type: text/html; charset=utf-8\n\n" + _html(rnd, 5),
+    ])
+    for level in range(depth - 1, -1, -1):
+        inner = _multipart("mixed" if level % 2 else "related", _boundary(i, level), [_text_part(rnd, 2), inner])
+    return _headers(i, rnd, mailbox(i), "nested %d levels %d" % (depth, i)) + inner
+
+
+def encoded_subject(i, rnd):
+    subject = " ".join([
+        Header("Réservation confirmée n°%d – 東京 ✓" % i, "utf-8").encode(),
+        Header("Grüße aus Köln", "iso-8859-1").encode(),
+    ])
+    sender = "%s <sender@sender.invalid>" % Header(rnd.choice(NAMES), "utf-8").encode()
+    name = rnd.choice(NAMES)
+    # Q-encoded ISO-8859-1 where the name fits, as older clients send it
+    charset = "iso-8859-1" if rnd.random() < 0.5 and all(ord(c) < 256 for c in name) else "utf-8"
+    to = "%s <%s>" % (Header(name, charset).encode(), mailbox(i))
+    return _headers(i, rnd, to, subject, sender) + _text_part(rnd, rnd.randrange(10, 50))
+
+
+def many_recipients(i, rnd):
+    to = ",\n ".join(["%s <%s>" % (_display_name(rnd), mailbox(i))] +
+                     ["%s <user%d.%d@%s>" % (_display_name(rnd), i, n, DOMAIN) for n in range(149)])
+    cc = ",\n ".join("<cc%d.%d@%s>" % (i, n, DOMAIN) for n in range(100))
+    return _headers(i, rnd, to, "team announcement %d" % i, extra="Cc: %s\n" % cc) + _text_part(rnd, 20)
+
+
+def attachment_size(index, max_bytes=None):
+    """Size of the attachment of the index-th attachment message."""
+    if index % 10 == 9:
+        size = LARGE_ATTACHMENT_SIZES[(index // 10) % len(LARGE_ATTACHMENT_SIZES)]
+    else:
+        size = SMALL_ATTACHMENT_SIZES[index % len(SMALL_ATTACHMENT_SIZES)]
+    return min(size, max_bytes) if max_bytes else size
+
+
+def attachment(i, rnd, size):
+    payload = base64.encodebytes(rnd.randbytes(size)).decode("ascii")
+    mixed = _multipart("mixed", _boundary(i, 0), [
+        _text_part(rnd, 10),
+        'Content-Type: application/octet-stream; name="file-%d.bin"\nContent-Transfer-Encoding: base64\n'
+        'Content-Disposition: attachment; filename="file-%d.bin"\n\n%s' % (i, i, payload),
+    ])
+    return _headers(i, rnd, mailbox(i), "attachment of %d bytes" % size) + mixed
+
+
+GENERATORS = {"plain": plain, "html": html, "nested": nested, "encoded_subject": encoded_subject,
+              "many_recipients": many_recipients}
+
+
+def generate(count, seed=1, max_attachment_bytes=None):
+    """Yield count Messages; the same arguments always yield the same bytes."""
+    attachments = 0
+    for i in range(count):
+        kind = KIND_CYCLE[i % len(KIND_CYCLE)]
+        rnd = random.Random(seed * 1000003 + i)
+        if kind == "attachment":
+            text = attachment(i, rnd, attachment_size(attachments, max_attachment_bytes))
+            attachments += 1
+        else:
+            text = GENERATORS[kind](i, rnd)
+        yield Message(kind, mailbox(i), text.encode("utf-8"))
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-n", "--count", dest="count", type="int", default=500, help="messages to generate")
+    parser.add_option("-s", "--seed", dest="seed", type="int", default=1)
+    parser.add_option("-m", "--max-attachment-mb", dest="max_attachment_mb", type="float", default=50,
+                      help="cap attachment sizes")
+    parser.add_option("-o", "--output", dest="output", help="directory to write NNNNNN-kind.eml files to")
+    (options, args) = parser.parse_args()
+    if not options.output:
+        parser.error("no output directory given")
+
+    os.makedirs(options.output, exist_ok=True)
+    total = 0
+    for i, message in enumerate(generate(options.count, options.seed, int(options.max_attachment_mb * MB))):
+        with open(os.path.join(options.output, "%06d-%s.eml" % (i, message.kind)), "wb") as f:
+            f.write(message.raw)
+        total += len(message.raw)
+    print("%d messages, %.1f MB written to %s" % (options.count, total / MB, options.output))
+
+
+if __name__ == "__main__":
+    main()
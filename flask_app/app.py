@@ -1,34 +1,176 @@
-from flask import Flask, request, jsonify, send_from_directory
-from dbutils.pooled_db import PooledDB
-import pymysql
+from flask import Flask, request, jsonify, send_from_directory, g
 import logging
 import json
 from datetime import datetime
 from dotenv import load_dotenv
 from functools import wraps
-import html
 import decimal
+import base64
+import hashlib
+import math
+import time
 import os
+import sys
+import threading
+from urllib.parse import quote
+from response_cache import ResponseCache
+from jobs import JobRunner
+import mail_events
+
+# mailstore sits next to this file in the container and at the repository root in a checkout
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from mailstore import get_storage, PoolTimeout, EMAIL_COLUMNS, RECIPIENT_ROLES, metrics
+from mailstore.replication import ReadRouter
+from mailstore.render import RENDER_VERSION, RawJSON, dumps
+from mailstore.retention import PURGE_CHUNK_SIZE, policies_from_env, purge, describe
+from mailstore.search import parse_query
 
 # Load environment variables from .env file
 load_dotenv()
 
 app = Flask(__name__, static_folder='/opt/app/templates', static_url_path='')
 
-# Database connection pool
-pool = PooledDB(
-    creator=pymysql,
-    host=os.getenv('DB_HOST'),
-    user=os.getenv('DB_USER'),
-    password=os.getenv('DB_PASSWORD'),
-    database=os.getenv('DB_NAME'),
-    autocommit=True,
-    charset=os.getenv('DB_CHARSET'),
-    cursorclass=pymysql.cursors.DictCursor,
-    blocking=True,
-    maxconnections=int(os.getenv('DB_MAX_CONNECTIONS', 5))
+# Storage backend, see mailstore (STORAGE_BACKEND=mysql|sqlite)
+storage = get_storage()
+
+# Read-only handlers read through this, from a caught-up replica if any are configured, see mailstore/replication.py
+reads = ReadRouter(storage)
+reads.start()
+
+# Rendered GET /emails responses, dropped when mail for the recipient is stored or deleted
+response_cache = ResponseCache(
+    max_entries=int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 1000)),
+    max_bytes=int(os.getenv('RESPONSE_CACHE_MAX_MB', 64)) * 1024 * 1024,
+    ttl=int(os.getenv('RESPONSE_CACHE_TTL', 30))
 )
 
+# Requests parked in GET /emails/wait, woken by the same ingest notifications
+mailbox_waiters = mail_events.MailboxWaiters()
+
+# Latest spool depth and replay lag reported by the LMTP server (postfix/replay.py)
+spool_status = {}
+
+def on_mail_event(event):
+    if event.get('event') == 'stored' and event.get('recipients', []) is None:
+        # From the sweep, too much new mail to list; a lagging replica may serve old pages until RESPONSE_CACHE_TTL
+        response_cache.invalidate_all()
+        mailbox_waiters.notify_all()
+    elif event.get('event') == 'stored':
+        recipients = [recipient.lower() for recipient in event.get('recipients', [])]
+        # Before waking anyone, so the requests that follow read the new mail from the primary
+        reads.wrote(recipients)
+        for recipient in recipients:
+            response_cache.invalidate(recipient)
+        mailbox_waiters.notify(recipients)
+    elif event.get('event') == 'spool':
+        spool_status.update(event)
+        spool_status.pop('event')
+
+mail_events.subscribe(on_mail_event)
+mail_events.start_listener()
+# Stands in for the datagrams that never arrive
+mail_sweep = mail_events.MailSweep(storage)
+mail_sweep.start()
+
+# Mass deletes and retention purges, run in the background one at a time
+jobs = JobRunner()
+
+# Maximum age of stored mail per recipient domain, see mailstore/retention.py
+retention_policies = policies_from_env()
+RETENTION_INTERVAL = int(os.getenv('RETENTION_INTERVAL', 3600))
+
+# Held while DELETE /emails decides whether the active delete job covers its request
+delete_all_lock = threading.Lock()
+
+def delete_all_job(max_id):
+    """Job function deleting the emails up to max_id, those stored before DELETE /emails was received."""
+    def run_delete_all(job):
+        def progress(deleted, addresses):
+            reads.wrote(addresses)
+            for address in addresses:
+                response_cache.invalidate(address)
+            job.progress(deleted)
+
+        storage.delete_all_emails(max_id, PURGE_CHUNK_SIZE, progress)
+    return run_delete_all
+
+def run_retention(job):
+    def progress(policy, deleted, addresses):
+        reads.wrote(addresses)
+        for address in addresses:
+            response_cache.invalidate(address)
+        job.progress(deleted, describe(policy))
+
+    purge(storage, retention_policies, progress=progress)
+
+def submit_retention():
+    """Queue a retention purge unless one is already queued or running."""
+    return jobs.active('retention') or jobs.submit('retention', run_retention)
+
+def retention_scheduler():
+    while True:
+        submit_retention()
+        time.sleep(RETENTION_INTERVAL)
+
+if retention_policies and RETENTION_INTERVAL > 0:
+    threading.Thread(target=retention_scheduler, name="retention", daemon=True).start()
+
+# Per-endpoint request metrics, served on GET /metrics with the storage ones, see mailstore/metrics.py
+API_REQUESTS = metrics.counter('email_api_requests_total', 'Requests by endpoint, method and status',
+                               ['endpoint', 'method', 'status'])
+API_REQUEST_SECONDS = metrics.histogram('email_api_request_seconds', 'Time to handle a request, streamed bodies included',
+                                        ['endpoint'])
+API_REQUEST_QUERIES = metrics.histogram('email_api_request_queries', 'SQL statements per request', ['endpoint'],
+                                        metrics.COUNT_BUCKETS)
+API_REQUEST_DB_SECONDS = metrics.histogram('email_api_request_db_seconds', 'Time per request spent in SQL statements',
+                                           ['endpoint'])
+API_REQUEST_SERIALIZATION_SECONDS = metrics.histogram('email_api_request_serialization_seconds',
+                                                      'Time per request spent serializing JSON', ['endpoint'])
+API_RESPONSE_BYTES = metrics.histogram('email_api_response_bytes', 'Response body size', ['endpoint'],
+                                       metrics.BYTE_BUCKETS)
+
+@app.before_request
+def begin_request_metrics():
+    g.request_started = time.perf_counter()
+    g.request_stats = metrics.begin_request()
+
+@app.after_request
+def record_request_metrics(response):
+    """Record the request once its body is sent, so streamed responses are measured whole."""
+    started, stats = g.request_started, g.request_stats
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    method = request.method
+    size = [response.calculate_content_length() or 0]
+    if response.is_streamed:
+        response.response = count_bytes(response.iter_encoded(), size)
+
+    def record():
+        metrics.end_request()
+        labels = (endpoint,)
+        API_REQUESTS.inc((endpoint, method, str(response.status_code)))
+        API_REQUEST_SECONDS.observe(time.perf_counter() - started, labels)
+        API_REQUEST_QUERIES.observe(stats.queries, labels)
+        API_REQUEST_DB_SECONDS.observe(stats.db_seconds, labels)
+        API_REQUEST_SERIALIZATION_SECONDS.observe(stats.serialization_seconds, labels)
+        API_RESPONSE_BYTES.observe(size[0], labels)
+
+    response.call_on_close(record)
+    return response
+
+def count_bytes(chunks, size):
+    for chunk in chunks:
+        size[0] += len(chunk)
+        yield chunk
+
+@app.errorhandler(PoolTimeout)
+def database_busy(e):
+    # Every pooled connection stayed in use for DB_POOL_TIMEOUT seconds
+    logging.warning(str(e))
+    response = jsonify({"error": "The database is busy, try again"})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
 @app.route('/')
 def index():
     return send_from_directory('/opt/app/templates', 'index.html')
@@ -49,39 +191,63 @@ def require_api_key(f):
             return jsonify({"error": "Unauthorized access"}), 403
     return decorated_function
 
-def escape_json_special_characters(data):
-    """Escape special characters in JSON strings."""
-    if isinstance(data, str):
-        return data.replace('\\', '').replace('\n', ' ').replace('\t', ' ').replace('"', '')  # Remove \n, \t, ", and \
-    if isinstance(data, list):
-        return [escape_json_special_characters(item) for item in data]
-    if isinstance(data, dict):
-        return {key: escape_json_special_characters(value) for key, value in data.items()}
-    return data
-
-def decode_unicode_escape(data):
-    """Decode Unicode escape sequences in strings."""
-    if isinstance(data, str):
-        # Replace HTML entities and remove newlines
-        return html.unescape(data).replace('\n', '')
-    if isinstance(data, list):
-        return [decode_unicode_escape(item) for item in data]
-    if isinstance(data, dict):
-        return {key: decode_unicode_escape(value) for key, value in data.items()}
-    return data
-
-def replace_hyphens_in_keys(data):
-    """Recursively replace hyphens with underscores in JSON keys."""
-    if isinstance(data, dict):
-        new_data = {}
-        for key, value in data.items():
-            new_key = key.replace('-', '_')
-            new_data[new_key] = replace_hyphens_in_keys(value)
-        return new_data
-    elif isinstance(data, list):
-        return [replace_hyphens_in_keys(item) for item in data]
-    else:
-        return data
+# Values accepted by the include parameter of GET /emails, all of them by default
+INCLUDE_OPTIONS = ['raw_headers', 'parts', 'attachments', 'attachment_content']
+# Attachments link to GET /emails/<id>/attachments/<attachment_id>; their bytes are only embedded on request
+DEFAULT_INCLUDE = ['raw_headers', 'parts', 'attachments']
+
+# Recipient roles matched by to_email when the role parameter is not given
+DEFAULT_ROLES = ['to', 'cc', 'bcc']
+
+# Values accepted by the count parameter of GET /emails
+COUNT_MODES = ['exact', 'estimate', 'none']
+
+# Page size when paging with after/before and no explicit limit
+DEFAULT_PAGE_SIZE = int(os.getenv('DEFAULT_PAGE_SIZE', 100))
+
+# Values accepted by the format parameter of GET /emails
+OUTPUT_FORMATS = ['json', 'ndjson']
+
+# Upper bound and default for the timeout parameter of GET /emails/wait, in seconds
+WAIT_MAX_TIMEOUT = int(os.getenv('WAIT_MAX_TIMEOUT', 60))
+WAIT_DEFAULT_TIMEOUT = 30
+# Most emails one GET /emails/wait response returns
+WAIT_MAX_LIMIT = int(os.getenv('WAIT_MAX_LIMIT', 1000))
+# A waiting request re-checks the database this often even without a notification
+WAIT_RECHECK_INTERVAL = int(os.getenv('WAIT_RECHECK_INTERVAL', 10))
+
+# Default and maximum page size of GET /emails/search
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', 20))
+SEARCH_MAX_LIMIT = int(os.getenv('SEARCH_MAX_LIMIT', 100))
+
+# Emails fetched and serialized per round trip when streaming with format=ndjson
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', 50))
+
+# Bytes read from the database per query when downloading an attachment. MySQL 5.7 reads the whole blob for every
+# SUBSTR of it, so this is sized for a blob to be read once; it is also what a download holds in memory
+ATTACHMENT_READ_SIZE = int(os.getenv('ATTACHMENT_READ_SIZE', 16 * 1024 * 1024))
+# Bytes handed to the server at a time while sending an attachment
+ATTACHMENT_CHUNK_SIZE = int(os.getenv('ATTACHMENT_CHUNK_SIZE', 256 * 1024))
+
+def parse_include(value):
+    """Parse the comma separated include parameter, returns None if it names an unknown option."""
+    if value is None:
+        return set(DEFAULT_INCLUDE)
+    include = {item.strip() for item in value.split(',') if item.strip()}
+    if not include.issubset(INCLUDE_OPTIONS):
+        return None
+    if 'attachment_content' in include:
+        include.add('attachments')
+    return include
+
+def parse_roles(value):
+    """Parse the comma separated role parameter, returns None if it names an unknown role."""
+    if value is None:
+        return set(DEFAULT_ROLES)
+    roles = {item.strip() for item in value.split(',') if item.strip()}
+    if not roles or not roles.issubset(RECIPIENT_ROLES):
+        return None
+    return roles
 
 def json_serial(obj):
     """JSON serializer for objects not serializable by default json code."""
@@ -89,8 +255,168 @@ def json_serial(obj):
         return obj.isoformat()
     if isinstance(obj, decimal.Decimal):
         return float(obj)
+    if isinstance(obj, bytes):
+        return base64.b64encode(obj).decode('ascii')
     raise TypeError("Type not serializable")
 
+def wants_pretty():
+    """Indent JSON responses only when the client asks for it with pretty=1."""
+    return request.args.get('pretty', '').lower() in ('1', 'true', 'yes')
+
+def serialize(data, indent=None):
+    """dumps() with the time it takes counted in the request metrics."""
+    started = time.perf_counter()
+    body = dumps(data, default=json_serial, indent=indent)
+    metrics.record_serialization(time.perf_counter() - started)
+    return body
+
+def json_response(data):
+    return app.response_class(
+        response=serialize(data, indent=4 if wants_pretty() else None),
+        mimetype='application/json'
+    )
+
+def cached_json_response(status, body, etag):
+    """Serve a rendered body with its ETag, or 304 if the client already has it."""
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(response=body, status=status, mimetype='application/json')
+    response.set_etag(etag)
+    return response
+
+def parse_time(value):
+    """Parse an ISO 8601 time parameter into the server's local time, which received_time is stored in."""
+    if value is None:
+        return None
+    parsed = datetime.fromisoformat(value)
+    return parsed.astimezone().replace(tzinfo=None) if parsed.tzinfo else parsed
+
+def encode_cursor(email):
+    """Opaque pagination token for the (received_time, id) position of an email."""
+    received_time = email['received_time']
+    if isinstance(received_time, datetime):
+        received_time = received_time.isoformat()
+    raw = json.dumps([received_time, email['id']]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(token):
+    """Inverse of encode_cursor, raises ValueError for a malformed token."""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        received_time, email_id = json.loads(raw)
+        return datetime.fromisoformat(received_time), int(email_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def fetch_email_page(cursor, to_email, columns, sort_order, limit, offset, after=None, before=None, roles=None):
+    """Fetch one page of emails for a recipient, newest first for DESC.
+
+    Emails are found through idx_recipients_address, so any of the given recipient
+    roles matches. With an after/before cursor the page is found by a range scan instead of skipping offset rows. Returns the rows
+    plus next/prev cursors (None at either end of the mailbox).
+    """
+    # Walk the index backwards when paging to the previous page
+    scan_desc = (sort_order == 'DESC') != (before is not None)
+    # One extra row tells whether another page follows
+    emails = storage.select_email_page(cursor, to_email, columns, scan_desc,
+                                       limit + 1 if limit is not None else None, offset, after or before, roles)
+
+    has_more = limit is not None and len(emails) > limit
+    if has_more:
+        emails = emails[:limit]
+    if before is not None:
+        emails.reverse()
+
+    next_cursor = prev_cursor = None
+    if emails:
+        if before is not None:
+            next_cursor = encode_cursor(emails[-1])
+            prev_cursor = encode_cursor(emails[0]) if has_more else None
+        else:
+            next_cursor = encode_cursor(emails[-1]) if has_more else None
+            prev_cursor = encode_cursor(emails[0]) if after is not None or offset else None
+    return emails, next_cursor, prev_cursor
+
+def attachment_url(attachment):
+    return f"/emails/{attachment['email_id']}/attachments/{attachment['id']}"
+
+def select_columns(include):
+    """Columns of emails to read for include; raw_headers is served from its rendered form."""
+    columns = [('rendered_headers' if c == 'raw_headers' else c) for c in EMAIL_COLUMNS
+               if c != 'raw_headers' or 'raw_headers' in include]
+    return columns + ['render_version']
+
+def render_emails(cursor, emails, include):
+    """Attach parts and attachments to a page of email rows and format them for the API.
+
+    Headers and bodies were rendered at ingest (mailstore/render.py) and are
+    spliced into the response as stored JSON; rows from an older render
+    version are rendered again first, on the primary, and served as rendered
+    there since cursor may be on a replica that has not caught up with it.
+    """
+    email_ids = [email['id'] for email in emails]
+    rerendered, rerendered_parts = {}, {}
+    if 'raw_headers' in include or 'parts' in include:
+        stale_ids = [email['id'] for email in emails if (email['render_version'] or 0) < RENDER_VERSION]
+        if stale_ids:
+            rerendered, rerendered_parts = storage.rerender(stale_ids)
+
+    # Load parts and attachments for the whole page at once instead of per email
+    if 'parts' in include:
+        parts_by_email = storage.select_parts(cursor, [email_id for email_id in email_ids if email_id not in rerendered_parts])
+        parts_by_email.update(rerendered_parts)
+    if 'attachments' in include:
+        attachments_by_email = storage.select_attachments(cursor, email_ids, 'attachment_content' in include)
+
+    email_data = []
+    for email in emails:
+        email_id = email['id']
+        del email['render_version']
+        if 'raw_headers' in include:
+            rendered_headers = rerendered.get(email_id) or email['rendered_headers'] or '{}'
+            email = {('raw_headers' if key == 'rendered_headers' else key): value for key, value in email.items()}
+            email['raw_headers'] = RawJSON(rendered_headers)
+        email_info = {"email": email}
+
+        if 'parts' in include:
+            parts = parts_by_email[email_id]
+            for part in parts:
+                part['headers'] = RawJSON(part['headers'] or '{}')
+                part['content'] = RawJSON(part['content'] or 'null')
+            email_info["parts"] = parts
+
+        if 'attachments' in include:
+            attachments = attachments_by_email[email_id]
+            for attachment in attachments:
+                attachment['url'] = attachment_url(attachment)
+            email_info["attachments"] = attachments
+
+        email_data.append(email_info)
+    return email_data
+
+def stream_emails(to_email, columns, sort_order, limit, offset, after, include, roles):
+    """Yield one NDJSON line per email, fetching STREAM_CHUNK_SIZE emails at a time.
+
+    Chunks are chained with the same keyset condition as after= so memory stays
+    bounded by one chunk whatever the size of the mailbox.
+    """
+    with reads.cursor([to_email]) as cursor:
+        remaining = limit
+        while remaining is None or remaining > 0:
+            chunk_size = STREAM_CHUNK_SIZE if remaining is None else min(STREAM_CHUNK_SIZE, remaining)
+            emails, next_cursor, _ = fetch_email_page(cursor, to_email, columns, sort_order, chunk_size, offset, after, roles=roles)
+            if not emails:
+                return
+            last = emails[-1]
+            after, offset = (last['received_time'], last['id']), 0
+            for email_info in render_emails(cursor, emails, include):
+                yield serialize(email_info) + '\n'
+            if next_cursor is None:
+                return
+            if remaining is not None:
+                remaining -= len(emails)
+
 @app.route('/emails', methods=['GET'])
 @require_api_key
 def get_emails():
@@ -98,6 +424,12 @@ def get_emails():
     sort_order = request.args.get('sort', 'DESC').upper()
     limit = request.args.get('limit')
     offset = request.args.get('offset', 0)
+    include = parse_include(request.args.get('include'))
+    roles = parse_roles(request.args.get('role'))
+    count_mode = request.args.get('count', 'exact')
+    after = request.args.get('after')
+    before = request.args.get('before')
+    output_format = request.args.get('format', 'json')
 
     if not to_email:
         return jsonify({"error": "to_email parameter is required"}), 400
@@ -105,157 +437,371 @@ def get_emails():
     if sort_order not in ['ASC', 'DESC']:
         return jsonify({"error": "Invalid sort order. Use 'ASC' or 'DESC'"}), 400
 
+    if include is None:
+        return jsonify({"error": f"Invalid include. Use a comma separated list of {', '.join(INCLUDE_OPTIONS)}"}), 400
+
+    if roles is None:
+        return jsonify({"error": f"Invalid role. Use a comma separated list of {', '.join(RECIPIENT_ROLES)}"}), 400
+
+    if count_mode not in COUNT_MODES:
+        return jsonify({"error": f"Invalid count. Use {', '.join(COUNT_MODES)}"}), 400
+
+    if output_format not in OUTPUT_FORMATS:
+        return jsonify({"error": f"Invalid format. Use {', '.join(OUTPUT_FORMATS)}"}), 400
+
+    if output_format == 'ndjson' and before:
+        return jsonify({"error": "before is not supported with format=ndjson"}), 400
+
     try:
         limit = int(limit) if limit else None
         offset = int(offset)
     except ValueError:
         return jsonify({"error": "Limit and offset must be integers"}), 400
 
-    logging.debug(f"to_email: {to_email}, sort_order: {sort_order}, limit: {limit}, offset: {offset}")
+    if after and before:
+        return jsonify({"error": "Use either after or before, not both"}), 400
 
-    connection = pool.connection()
     try:
-        with connection.cursor() as cursor:
-            # Query to get the total count of emails
-            count_sql = "SELECT COUNT(*) as count FROM emails WHERE to_email = %s"
-            cursor.execute(count_sql, (to_email,))
-            total_count = cursor.fetchone()['count']
-
-            # Query to get emails with sorting, limit, and offset
-            sql = f"SELECT * FROM emails WHERE to_email = %s ORDER BY received_time {sort_order}"
-            query_params = [to_email]
-
-            if limit is not None:
-                sql += " LIMIT %s OFFSET %s"
-                query_params.extend([limit, offset])
-            elif offset:
-                sql += " LIMIT 18446744073709551615 OFFSET %s"  # MySQL's maximum limit
-                query_params.append(offset)
-
-            cursor.execute(sql, query_params)
-            emails = cursor.fetchall()
+        after = decode_cursor(after) if after else None
+        before = decode_cursor(before) if before else None
+    except ValueError:
+        return jsonify({"error": "Invalid after/before cursor"}), 400
 
-            if not emails:
-                return jsonify({"message": "No emails found for the given to_email"}), 404
-
-            email_data = []
-            for email in emails:
-                email_id = email['id']
-
-                # Query to get email parts
-                sql_parts = "SELECT * FROM email_parts WHERE email_id = %s"
-                cursor.execute(sql_parts, (email_id,))
-                parts = cursor.fetchall()
-
-                # Query to get email attachments
-                sql_attachments = "SELECT * FROM email_attachments WHERE email_id = %s"
-                cursor.execute(sql_attachments, (email_id,))
-                attachments = cursor.fetchall()
-
-                # Ensure raw_headers and parts headers are correctly formatted
-                email['raw_headers'] = escape_json_special_characters(json.loads(email['raw_headers']))
-                email['raw_headers']['to'] = escape_json_special_characters(email['raw_headers'].get('to', ''))
-                for part in parts:
-                    part['headers'] = escape_json_special_characters(json.loads(part['headers']))
-                    part['content'] = decode_unicode_escape(part['content'])
-
-                email_info = {
-                    "email": replace_hyphens_in_keys(email),
-                    "parts": replace_hyphens_in_keys(parts),
-                    "attachments": replace_hyphens_in_keys(attachments)
-                }
-                email_data.append(email_info)
-
-            response_data = {
+    if (after or before) and output_format == 'json':
+        if offset:
+            return jsonify({"error": "offset cannot be combined with after/before"}), 400
+        if limit is None:
+            limit = DEFAULT_PAGE_SIZE
+
+    logging.debug(f"to_email: {to_email}, sort_order: {sort_order}, limit: {limit}, offset: {offset}")
+
+    columns = select_columns(include)
+
+    if output_format == 'ndjson':
+        with reads.cursor([to_email]) as cursor:
+            total_count = storage.count_emails(cursor, to_email, count_mode, roles)
+        headers = {'X-Total-Count': str(total_count)} if total_count is not None else {}
+        return app.response_class(
+            stream_emails(to_email, columns, sort_order, limit, offset, after, include, roles),
+            mimetype='application/x-ndjson',
+            headers=headers
+        )
+
+    # Polling an unchanged mailbox is answered from the cache without touching the database
+    recipient = to_email.lower()
+    cache_key = tuple(sorted((k, v) for k, v in request.args.items(multi=True) if k != 'api_key'))
+    cached = response_cache.get(recipient, cache_key)
+    if cached is not None:
+        return cached_json_response(cached.status, cached.body, cached.etag)
+
+    generation = response_cache.generation()
+    with reads.cursor([to_email]) as cursor:
+        total_count = storage.count_emails(cursor, to_email, count_mode, roles)
+
+        # Query to get emails with sorting and either a cursor or limit and offset
+        emails, next_cursor, prev_cursor = fetch_email_page(cursor, to_email, columns, sort_order, limit, offset, after, before, roles)
+
+        if not emails and not (after or before):
+            status, response_data = 404, {"message": "No emails found for the given to_email"}
+        else:
+            status, response_data = 200, {
                 "count": total_count,
                 "limit": limit,
                 "offset": offset,
-                "emails": email_data
+                "next_cursor": next_cursor,
+                "prev_cursor": prev_cursor,
+                "emails": render_emails(cursor, emails, include)
             }
 
-            response = app.response_class(
-                response=json.dumps(response_data, default=json_serial, indent=4),
-                mimetype='application/json'
-            )
+    body = serialize(response_data, indent=4 if wants_pretty() else None).encode('utf-8')
+    etag = hashlib.sha1(body).hexdigest()
+    response_cache.put(recipient, cache_key, status, body, etag, generation)
+    return cached_json_response(status, body, etag)
+
+def fetch_new_emails(to_email, since_id, limit, include, roles):
+    """Emails stored for a recipient after since_id, oldest first, already rendered."""
+    columns = select_columns(include)
+    with reads.cursor([to_email]) as cursor:
+        emails = storage.select_new_emails(cursor, to_email, columns, since_id, limit, roles)
+        if not emails:
+            return None, []
+        cursor_token = encode_cursor(emails[-1])
+        return cursor_token, render_emails(cursor, emails, include)
+
+@app.route('/emails/wait', methods=['GET'])
+@require_api_key
+def wait_for_emails():
+    """Long-poll until mail newer than the since cursor arrives for to_email, or timeout."""
+    to_email = request.args.get('to_email')
+    since = request.args.get('since')
+    timeout = request.args.get('timeout', WAIT_DEFAULT_TIMEOUT)
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE)
+    include = parse_include(request.args.get('include'))
+    roles = parse_roles(request.args.get('role'))
+
+    if not to_email:
+        return jsonify({"error": "to_email parameter is required"}), 400
+
+    if include is None:
+        return jsonify({"error": f"Invalid include. Use a comma separated list of {', '.join(INCLUDE_OPTIONS)}"}), 400
+
+    if roles is None:
+        return jsonify({"error": f"Invalid role. Use a comma separated list of {', '.join(RECIPIENT_ROLES)}"}), 400
+
+    try:
+        timeout = float(timeout)
+        limit = int(limit)
+    except ValueError:
+        return jsonify({"error": "Timeout and limit must be numbers"}), 400
+
+    # nan would never run out and inf never be reached
+    if not math.isfinite(timeout) or timeout < 0:
+        return jsonify({"error": "Timeout must be a finite number of seconds, not negative"}), 400
+    timeout = min(timeout, WAIT_MAX_TIMEOUT)
+
+    if not 1 <= limit <= WAIT_MAX_LIMIT:
+        return jsonify({"error": f"Limit must be between 1 and {WAIT_MAX_LIMIT}"}), 400
+
+    try:
+        # Arrival order is id order; received_time comes from the sender's Date header
+        since_id = decode_cursor(since)[1] if since else 0
+    except ValueError:
+        return jsonify({"error": "Invalid since cursor"}), 400
+
+    recipient = to_email.lower()
+    deadline = time.monotonic() + timeout
+    while True:
+        # No pooled connection is held while parked, only while checking
+        event = mailbox_waiters.register(recipient)
+        try:
+            cursor_token, emails = fetch_new_emails(to_email, since_id, limit, include, roles)
+            remaining = deadline - time.monotonic()
+            if emails or remaining <= 0:
+                break
+            event.wait(min(remaining, WAIT_RECHECK_INTERVAL))
+        finally:
+            mailbox_waiters.unregister(recipient, event)
+
+    return json_response({
+        "count": len(emails),
+        "cursor": cursor_token or since,
+        "emails": emails
+    })
+
+@app.route('/emails/search', methods=['GET'])
+@require_api_key
+def search_emails():
+    """Full-text search over subject and body, best match first, see mailstore/search.py."""
+    query = request.args.get('q')
+    include = parse_include(request.args.get('include'))
+    roles = parse_roles(request.args.get('role'))
+
+    if not query:
+        return jsonify({"error": "q parameter is required"}), 400
+
+    try:
+        terms = parse_query(query)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid q. {e}"}), 400
+
+    if include is None:
+        return jsonify({"error": f"Invalid include. Use a comma separated list of {', '.join(INCLUDE_OPTIONS)}"}), 400
+
+    if roles is None:
+        return jsonify({"error": f"Invalid role. Use a comma separated list of {', '.join(RECIPIENT_ROLES)}"}), 400
+
+    try:
+        limit = min(int(request.args.get('limit', SEARCH_PAGE_SIZE)), SEARCH_MAX_LIMIT)
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({"error": "Limit and offset must be integers"}), 400
+
+    if limit < 1 or offset < 0:
+        return jsonify({"error": "Limit must be positive and offset not negative"}), 400
+
+    try:
+        since = parse_time(request.args.get('since'))
+        until = parse_time(request.args.get('until'))
+    except ValueError:
+        return jsonify({"error": "since and until must be ISO 8601 times, e.g. 2024-01-31T12:00:00"}), 400
+
+    to_email = request.args.get('to_email')
+    with reads.cursor([to_email] if to_email else []) as cursor:
+        # One extra row tells whether another page follows
+        emails = storage.search_emails(cursor, terms, select_columns(include), limit + 1, offset,
+                                       to_email, roles, request.args.get('from_email'), since, until)
+        has_more = len(emails) > limit
+        emails = emails[:limit]
+        scores = [email.pop('score') for email in emails]
+        results = render_emails(cursor, emails, include)
+
+    for email_info, score in zip(results, scores):
+        email_info["score"] = round(float(score), 6)
+
+    return json_response({
+        "query": query,
+        "limit": limit,
+        "offset": offset,
+        "next_offset": offset + limit if has_more else None,
+        "emails": results
+    })
+
+def stream_blob(digest, start, stop, on_primary=False):
+    """Yield bytes start..stop of a blob, ATTACHMENT_CHUNK_SIZE at a time, read ATTACHMENT_READ_SIZE per query.
+
+    A pooled connection is held for each query only, not while a slow client receives the bytes.
+    """
+    while start < stop:
+        with (storage.cursor() if on_primary else reads.cursor()) as cursor:
+            window = storage.read_blob(cursor, digest, start, min(ATTACHMENT_READ_SIZE, stop - start))
+        if not window:
+            # Deleted meanwhile; the client sees a body shorter than Content-Length
+            logging.warning(f"Attachment blob {digest} vanished while streaming")
+            return
+        window = memoryview(window)
+        for offset in range(0, len(window), ATTACHMENT_CHUNK_SIZE):
+            yield bytes(window[offset:offset + ATTACHMENT_CHUNK_SIZE])
+        start += len(window)
+
+def content_disposition(filename):
+    filename = filename or 'attachment'
+    fallback = filename.encode('ascii', 'replace').decode('ascii').replace('"', '').replace('\\', '')
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"
+
+@app.route('/emails/<int:email_id>/attachments/<int:attachment_id>', methods=['GET'])
+@require_api_key
+def get_attachment(email_id, attachment_id):
+    """Download one attachment, streamed from the database with Range and ETag support."""
+    with reads.cursor() as cursor:
+        attachment = storage.select_attachment(cursor, email_id, attachment_id)
+    # Links come from responses that may have been read from the primary; a replica may not have the email yet
+    on_primary = attachment is None and reads.enabled
+    if on_primary:
+        with storage.cursor() as cursor:
+            attachment = storage.select_attachment(cursor, email_id, attachment_id)
+    if attachment is None:
+        return jsonify({"message": "No attachment found with the given ID"}), 404
+
+    # The content digest is a strong validator: the bytes of a digest never change
+    etag = attachment['digest']
+    size = attachment['size']
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': content_disposition(attachment['filename']),
+        'Cache-Control': 'private'
+    }
+
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304, headers=headers)
+        response.set_etag(etag)
+        return response
+
+    start, stop, status = 0, size, 200
+    byte_range = request.range
+    # A single byte range; If-Range only honours our ETag as we send no Last-Modified
+    if (byte_range is not None and byte_range.units == 'bytes' and len(byte_range.ranges) == 1
+            and ('If-Range' not in request.headers or request.if_range.etag == etag)):
+        satisfiable = byte_range.range_for_length(size)
+        if satisfiable is None:
+            response = app.response_class(status=416, headers={'Content-Range': f"bytes */{size}"})
+            response.set_etag(etag)
             return response
-    finally:
-        connection.close()
+        start, stop = satisfiable
+        status = 206
+        headers['Content-Range'] = f"bytes {start}-{stop - 1}/{size}"
+
+    headers['Content-Length'] = str(stop - start)
+    response = app.response_class(
+        stream_blob(attachment['digest'], start, stop, on_primary),
+        status=status,
+        content_type=attachment['content_type'] or 'application/octet-stream',
+        headers=headers
+    )
+    response.set_etag(etag)
+    return response
 
 @app.route('/emails/<int:email_id>', methods=['DELETE'])
 @require_api_key
 def delete_email(email_id):
-    connection = pool.connection()
-    try:
-        with connection.cursor() as cursor:
-            # Delete email, parts, and attachments for the given email_id
-            sql_delete_email = "DELETE FROM emails WHERE id = %s"
-            sql_delete_parts = "DELETE FROM email_parts WHERE email_id = %s"
-            sql_delete_attachments = "DELETE FROM email_attachments WHERE email_id = %s"
+    # Delete email, parts, and attachments for the given email_id
+    deleted, addresses = storage.delete_email(email_id)
 
-            cursor.execute(sql_delete_parts, (email_id,))
-            cursor.execute(sql_delete_attachments, (email_id,))
-            cursor.execute(sql_delete_email, (email_id,))
+    reads.wrote(addresses)
+    for address in addresses:
+        response_cache.invalidate(address)
 
-            connection.commit()
+    if not deleted:
+        return jsonify({"message": "No email found with the given ID"}), 404
 
-            if cursor.rowcount == 0:
-                return jsonify({"message": "No email found with the given ID"}), 404
-
-            return jsonify({"message": f"Email with ID {email_id} deleted successfully"}), 200
-    finally:
-        connection.close()
+    return jsonify({"message": f"Email with ID {email_id} deleted successfully"}), 200
 
 @app.route('/emails', methods=['DELETE'])
 @require_api_key
 def delete_all_emails():
-    connection = pool.connection()
-    try:
-        with connection.cursor() as cursor:
-            # Delete all emails, parts, and attachments
-            cursor.execute("DELETE FROM email_parts")
-            cursor.execute("DELETE FROM email_attachments")
-            cursor.execute("DELETE FROM emails")
+    # Delete all emails, parts, and attachments stored so far in chunks in the background
+    with storage.cursor() as cursor:
+        max_id = storage.newest_email_id(cursor)
+        total = storage.email_count(cursor)
+    with delete_all_lock:
+        job = jobs.active('delete_all')
+        # A queued or running delete only covers the mail stored before its own request
+        if job is None or job.max_id < max_id:
+            job = jobs.submit('delete_all', delete_all_job(max_id), total)
+            job.max_id = max_id
+
+    return job_response("Deleting all emails", job)
+
+@app.route('/emails/purge', methods=['POST'])
+@require_api_key
+def purge_emails():
+    # Apply the retention policies now instead of waiting for the next scheduled run
+    if not retention_policies:
+        return jsonify({"message": "No retention policies configured, set RETENTION_POLICIES"}), 400
+
+    return job_response("Purging emails past their retention", submit_retention())
 
-            connection.commit()
+@app.route('/emails/jobs', methods=['GET'])
+@require_api_key
+def list_jobs():
+    return json_response({"jobs": [job.to_dict() for job in reversed(jobs.list())]})
 
-            return jsonify({"message": "All emails deleted successfully"}), 200
-    finally:
-        connection.close()
+@app.route('/emails/jobs/<job_id>', methods=['GET'])
+@require_api_key
+def get_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"message": "No job found with the given ID"}), 404
+
+    return json_response(job.to_dict())
+
+def job_response(message, job):
+    """202 Accepted pointing at the job to poll for progress."""
+    response = jsonify({"message": message, "job": job.to_dict()})
+    response.status_code = 202
+    response.headers['Location'] = f"/emails/jobs/{job.id}"
+    return response
 
 @app.route('/emails/stats', methods=['GET'])
 @require_api_key
 def get_email_stats():
-    connection = pool.connection()
+    # Counters kept up to date by ingest and deletes, so this stays cheap on any table size
     try:
-        with connection.cursor() as cursor:
-            # Query to get the total email count in the database
-            total_email_count_sql = "SELECT COUNT(*) as total_email_count FROM emails"
-            cursor.execute(total_email_count_sql)
-            total_email_count = cursor.fetchone()['total_email_count']
-
-            # Query to get the size of the database in MB
-            database_size_sql = """
-            SELECT table_schema AS database_name,
-                   ROUND(SUM(data_length + index_length) / 1024 / 1024, 2) AS size_mb
-            FROM information_schema.tables
-            WHERE table_schema = 'emails'
-            GROUP BY table_schema
-            """
-            cursor.execute(database_size_sql)
-            database_size = cursor.fetchone()['size_mb']
-
-            stats = {
-                "total_email_count": total_email_count,
-                "database_size_mb": database_size
-            }
+        top = min(int(request.args.get('top', 10)), 100)
+    except ValueError:
+        return jsonify({"error": "top must be an integer"}), 400
+    to_email = request.args.get('to_email')
+    with reads.cursor([to_email] if to_email else []) as cursor:
+        stats = storage.stats(cursor, top, to_email, request.args.get('domain'))
+    if spool_status:
+        stats['spool'] = dict(spool_status)
 
-            response = app.response_class(
-                response=json.dumps(stats, default=json_serial, indent=4),
-                mimetype='application/json'
-            )
-            return response
-    finally:
-        connection.close()
+    return json_response(stats)
+
+@app.route('/metrics', methods=['GET'])
+@require_api_key
+def get_metrics():
+    # Prometheus text format; scrape with params: {api_key: [...]}
+    return app.response_class(response=metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
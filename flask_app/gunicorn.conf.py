@@ -0,0 +1,20 @@
+"""gunicorn settings for the API container (CMD in the Dockerfile).
+
+One worker process: the response cache, the GET /emails/wait waiters, the
+read router and the background jobs live in it, and only one process can bind
+the UDP port of the ingest notifications (MAIL_EVENTS_PORT). The gevent worker
+serves each request in a greenlet, so a parked long poll costs a few KB instead
+of a thread. PyMySQL and the pool locks yield to other requests while they
+wait; SQLite calls do not.
+"""
+
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+workers = 1
+worker_class = 'gevent'
+# Requests served at once, parked long polls included
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 2000))
+# Long polls answer within WAIT_MAX_TIMEOUT seconds; give them that long to finish on shutdown
+graceful_timeout = int(os.getenv('WAIT_MAX_TIMEOUT', 60)) + 5
+accesslog = None
@@ -0,0 +1,104 @@
+"""Background jobs for long-running maintenance such as mass deletes.
+
+Jobs run one at a time on a worker thread, in the order they were submitted,
+so an HTTP request only has to queue one and return its id. Progress is kept
+in memory and polled through GET /emails/jobs/<id>; the most recent
+JOBS_KEEP finished jobs are remembered.
+"""
+
+import os, queue, threading, time, uuid
+import logging
+
+JOBS_KEEP = int(os.getenv('JOBS_KEEP', 100))
+
+
+class Job:
+    def __init__(self, kind, run, total=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.total = total
+        self.processed = 0
+        self.status = 'queued'
+        self.error = None
+        self.detail = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._run = run
+
+    def progress(self, count, detail=None):
+        """Record count more items done; called by the job function as it goes."""
+        self.processed += count
+        if detail is not None:
+            self.detail = detail
+
+    def to_dict(self):
+        elapsed = (self.finished_at or time.time()) - self.started_at if self.started_at else 0
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "processed": self.processed,
+            "total": self.total,
+            "detail": self.detail,
+            "rate_per_second": round(self.processed / elapsed, 1) if elapsed > 0 else None,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobRunner:
+    def __init__(self, keep=JOBS_KEEP):
+        self.keep = keep
+        self._jobs = {}  # id -> Job, in submission order
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="jobs", daemon=True)
+        self._thread.start()
+
+    def submit(self, kind, run, total=None):
+        """Queue run(job) and return the Job tracking it."""
+        job = Job(kind, run, total)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._forget_finished()
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def active(self, kind):
+        """The most recently submitted queued or running job of this kind, if any."""
+        with self._lock:
+            for job in reversed(list(self._jobs.values())):
+                if job.kind == kind and job.status in ('queued', 'running'):
+                    return job
+        return None
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in ('done', 'failed')]
+        for job_id in finished[:max(0, len(finished) - self.keep)]:
+            del self._jobs[job_id]
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            job.status = 'running'
+            job.started_at = time.time()
+            try:
+                job._run(job)
+                job.status = 'done'
+            except Exception as e:
+                logging.exception("Job %s (%s) failed: %s", job.id, job.kind, e)
+                job.error = str(e)
+                job.status = 'failed'
+            job.finished_at = time.time()
+            logging.info("Job %s (%s) %s after %d items", job.id, job.kind, job.status, job.processed)
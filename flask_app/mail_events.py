@@ -0,0 +1,145 @@
+"""Receive mail events sent by the ingest path (postfix/notify.py).
+
+A daemon thread listens on UDP MAIL_EVENTS_PORT and hands every decoded event
+to the subscribed callbacks, e.g. to invalidate cached responses or to wake
+requests waiting for new mail.
+
+Datagrams can be lost, so MailSweep also publishes a stored event for the mail
+that reached the database since its previous sweep, every
+MAIL_EVENTS_SWEEP_INTERVAL seconds.
+"""
+
+import os, socket, json, threading, time
+import logging
+
+MAIL_EVENTS_PORT = int(os.getenv('MAIL_EVENTS_PORT', 5001))
+MAIL_EVENTS_SWEEP_INTERVAL = float(os.getenv('MAIL_EVENTS_SWEEP_INTERVAL', 5))
+# More new emails than this in one sweep are published without their recipients
+MAIL_EVENTS_SWEEP_MAX_EMAILS = int(os.getenv('MAIL_EVENTS_SWEEP_MAX_EMAILS', 1000))
+
+_callbacks = []
+_listener = None
+
+
+def subscribe(callback):
+    """Call callback(event) for every event received, e.g. {"event": "stored", "recipients": [...]}."""
+    _callbacks.append(callback)
+
+
+def publish(event):
+    for callback in _callbacks:
+        try:
+            callback(event)
+        except Exception:
+            logging.exception("Mail event callback failed for %s", event)
+
+
+def _listen(sock):
+    while True:
+        data, _ = sock.recvfrom(65535)
+        try:
+            event = json.loads(data)
+        except ValueError:
+            logging.warning("Ignoring malformed mail event: %r", data[:200])
+            continue
+        publish(event)
+
+
+def start_listener(port=MAIL_EVENTS_PORT):
+    """Start the UDP listener thread once per process."""
+    global _listener
+    if _listener is not None or not port:
+        return
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('0.0.0.0', port))
+    _listener = threading.Thread(target=_listen, args=(sock,), name="mail-events", daemon=True)
+    _listener.start()
+    logging.info(f"Listening for mail events on udp/{port}")
+
+
+class MailSweep:
+    """Publishes the mail stored since the previous sweep, whether or not its notification arrived.
+
+    One query for the newest email id per sweep serves every recipient; only
+    when it moved are the recipients of the new emails read, by primary key
+    range. The event lists them, or is {"event": "stored", "recipients": None}
+    for more than max_emails new emails, meaning any mailbox may have changed.
+    The first sweep only records where to start.
+    """
+
+    def __init__(self, storage, interval=MAIL_EVENTS_SWEEP_INTERVAL, max_emails=MAIL_EVENTS_SWEEP_MAX_EMAILS):
+        self.storage = storage
+        self.interval = interval
+        self.max_emails = max_emails
+        self._newest = None
+        self._thread = None
+
+    def start(self):
+        if self.interval > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="mail-sweep", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception:
+                logging.exception("Sweeping for new mail failed")
+            time.sleep(self.interval)
+
+    def sweep(self):
+        # On the primary: a lagging replica would report the new mail a sweep late
+        with self.storage.cursor() as cursor:
+            newest = self.storage.newest_email_id(cursor)
+            previous, self._newest = self._newest, newest
+            if previous is None or newest <= previous:
+                return
+            if newest - previous > self.max_emails:
+                recipients = None
+            else:
+                recipients = self.storage.recipients_between(cursor, previous, newest)
+        publish({"event": "stored", "recipients": recipients})
+
+
+class MailboxWaiters:
+    """Requests blocked until mail arrives for a recipient.
+
+    Each waiter parks on its own Event, so a notification wakes only the
+    requests waiting on that mailbox and no thread polls the database.
+    """
+
+    def __init__(self):
+        self._waiting = {}  # recipient -> set of Events
+        self._lock = threading.Lock()
+
+    def register(self, recipient):
+        """Register before checking the database so a concurrent arrival is not missed."""
+        event = threading.Event()
+        with self._lock:
+            self._waiting.setdefault(recipient, set()).add(event)
+        return event
+
+    def unregister(self, recipient, event):
+        with self._lock:
+            events = self._waiting.get(recipient)
+            if events is not None:
+                events.discard(event)
+                if not events:
+                    del self._waiting[recipient]
+
+    def notify(self, recipients):
+        with self._lock:
+            events = [e for r in recipients for e in self._waiting.pop(r, ())]
+        for event in events:
+            event.set()
+
+    def notify_all(self):
+        with self._lock:
+            events = [e for events in self._waiting.values() for e in events]
+            self._waiting.clear()
+        for event in events:
+            event.set()
+
+    def count(self):
+        with self._lock:
+            return sum(len(events) for events in self._waiting.values())
@@ -0,0 +1,94 @@
+"""In-process LRU cache of rendered GET /emails responses.
+
+Entries are grouped per recipient so that new mail or a delete only drops the
+responses of the mailbox it touched. Invalidations are stamped from a global
+counter; a response rendered before its mailbox last changed is not stored.
+"""
+
+import threading, time
+from collections import OrderedDict
+
+
+class CachedResponse:
+    def __init__(self, status, body, etag):
+        self.status = status
+        self.body = body
+        self.etag = etag
+        self.stored_at = time.monotonic()
+
+
+class ResponseCache:
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024, ttl=30):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # (recipient, key) -> CachedResponse, oldest first
+        self._by_recipient = {}  # recipient -> set of keys
+        self._changed = OrderedDict()  # recipient -> generation of its last invalidation
+        self._max_changed = max_entries * 10
+        self._floor = 0  # newest stamp forgotten when trimming _changed
+        self._generation = 0
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def generation(self):
+        """Take before reading the database and pass to put() after rendering."""
+        with self._lock:
+            return self._generation
+
+    def get(self, recipient, key):
+        with self._lock:
+            entry = self._entries.get((recipient, key))
+            if entry is None:
+                return None
+            if time.monotonic() - entry.stored_at > self.ttl:
+                # Safety net in case an invalidation was missed
+                self._remove((recipient, key))
+                return None
+            self._entries.move_to_end((recipient, key))
+            return entry
+
+    def put(self, recipient, key, status, body, etag, generation):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if self._changed.get(recipient, self._floor) > generation:
+                return
+            self._remove((recipient, key))
+            self._entries[(recipient, key)] = CachedResponse(status, body, etag)
+            self._by_recipient.setdefault(recipient, set()).add(key)
+            self._size += len(body)
+            while self._entries and (len(self._entries) > self.max_entries or self._size > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, recipient):
+        with self._lock:
+            self._generation += 1
+            self._changed.pop(recipient, None)
+            self._changed[recipient] = self._generation
+            while len(self._changed) > self._max_changed:
+                _, stamp = self._changed.popitem(last=False)
+                self._floor = max(self._floor, stamp)
+            for key in list(self._by_recipient.get(recipient, ())):
+                self._remove((recipient, key))
+
+    def invalidate_all(self):
+        with self._lock:
+            self._generation += 1
+            self._floor = self._generation
+            self._changed.clear()
+            self._entries.clear()
+            self._by_recipient.clear()
+            self._size = 0
+
+    def _remove(self, entry_key):
+        entry = self._entries.pop(entry_key, None)
+        if entry is None:
+            return
+        self._size -= len(entry.body)
+        recipient, key = entry_key
+        keys = self._by_recipient.get(recipient)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_recipient[recipient]
@@ -12,10 +12,20 @@ CREATE TABLE emails (
     to_name VARCHAR(255),
     cc_email VARCHAR(255),
     cc_name VARCHAR(255),
-    raw_headers TEXT,
+    raw_headers MEDIUMBLOB,
+    raw_headers_codec TINYINT NOT NULL DEFAULT 0,
     encoding VARCHAR(50),
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    INDEX idx_to_email (to_email)
+    -- JSON served as raw_headers by the API, see mailstore/render.py; *_codec see mailstore/codec.py
+    rendered_headers MEDIUMBLOB,
+    rendered_headers_codec TINYINT NOT NULL DEFAULT 0,
+    render_version INT,
+    -- Message-ID plus content hash, so replaying the ingest spool never stores a message twice
+    idempotency_key CHAR(64),
+    INDEX idx_to_email_received (to_email, received_time, id),
+    -- Retention purges walk expired emails oldest first, see mailstore/retention.py
+    INDEX idx_created_at (created_at, id),
+    UNIQUE KEY idx_idempotency_key (idempotency_key)
 );
 
 CREATE TABLE email_attachments
@@ -24,17 +34,67 @@ CREATE TABLE email_attachments
     email_id INT,
     filename VARCHAR(255),
     content_type VARCHAR(255),
-    content LONGBLOB,
+    digest CHAR(64),
+    size BIGINT,
+    INDEX idx_attachments_digest (digest),
     FOREIGN KEY (email_id) REFERENCES emails(id) ON DELETE CASCADE
 );
 
+-- Attachment bytes, stored once per SHA-256 digest and shared by every email_attachments row with that digest
+CREATE TABLE attachment_blobs (
+    digest CHAR(64) PRIMARY KEY,
+    size BIGINT NOT NULL,
+    refcount INT NOT NULL,
+    content LONGBLOB
+);
+
 CREATE TABLE email_parts (
     id INT AUTO_INCREMENT PRIMARY KEY,
     email_id INT,
     headers TEXT,
     content_type VARCHAR(255),
-    content LONGTEXT,
+    content LONGBLOB,
+    content_codec TINYINT NOT NULL DEFAULT 0,
+    rendered_headers MEDIUMTEXT,
+    rendered_content LONGBLOB,
+    rendered_content_codec TINYINT NOT NULL DEFAULT 0,
+    FOREIGN KEY (email_id) REFERENCES emails(id) ON DELETE CASCADE
+);
+
+CREATE TABLE email_recipients (
+    email_id INT NOT NULL,
+    address VARCHAR(255) NOT NULL,
+    role VARCHAR(16) NOT NULL,
+    received_time DATETIME,
+    PRIMARY KEY (email_id, address, role),
+    INDEX idx_recipients_address (address, received_time, email_id),
     FOREIGN KEY (email_id) REFERENCES emails(id) ON DELETE CASCADE
 );
 
-CREATE INDEX idx_to_email ON emails(to_email);
\ No newline at end of file
+-- Running totals behind GET /emails/stats, updated by the transactions that store and delete mail
+CREATE TABLE stats_counters (
+    name VARCHAR(64) PRIMARY KEY,
+    value BIGINT NOT NULL DEFAULT 0
+);
+INSERT INTO stats_counters (name, value) VALUES ('emails', 0), ('part_bytes', 0), ('attachment_bytes', 0), ('blob_bytes', 0);
+
+-- Emails per To/Cc/Bcc address and per domain
+CREATE TABLE recipient_stats (
+    address VARCHAR(255) PRIMARY KEY,
+    emails BIGINT NOT NULL,
+    INDEX idx_recipient_stats_emails (emails)
+);
+
+CREATE TABLE domain_stats (
+    domain VARCHAR(255) PRIMARY KEY,
+    emails BIGINT NOT NULL,
+    INDEX idx_domain_stats_emails (emails)
+);
+
+-- Subject and text-only body of every email for GET /emails/search, see mailstore/search.py
+CREATE TABLE email_search (
+    email_id INT PRIMARY KEY,
+    subject VARCHAR(255),
+    body MEDIUMTEXT,
+    FULLTEXT INDEX ft_email_search (subject, body)
+);
@@ -0,0 +1,41 @@
+"""Storage layer shared by the postfix ingest path and the Flask API.
+
+STORAGE_BACKEND selects the engine: mysql (default, the docker-compose
+service) or sqlite (embedded, SQLITE_PATH). Read replicas of either are
+configured per backend and used by mailstore.replication.
+"""
+
+import os, threading
+
+from . import metrics
+from .base import Storage, PoolTimeout, EMAIL_COLUMNS, RECIPIENT_ROLES, recipient_addresses
+
+STORAGE_BACKENDS = ['mysql', 'sqlite']
+
+_storage = None
+_lock = threading.Lock()
+
+
+def create_storage(backend=None, **kwargs):
+    backend = backend or os.getenv('STORAGE_BACKEND', 'mysql')
+    if backend == 'mysql':
+        from .mysql import MySQLStorage
+        return MySQLStorage(**kwargs)
+    if backend == 'sqlite':
+        from .sqlite import SQLiteStorage
+        return SQLiteStorage(**kwargs)
+    raise ValueError("STORAGE_BACKEND must be one of %s, got %r" % (", ".join(STORAGE_BACKENDS), backend))
+
+
+def get_storage():
+    """The process-wide storage configured from the environment."""
+    global _storage
+    with _lock:
+        if _storage is None:
+            _storage = create_storage()
+            metrics.DB_POOL_CONNECTIONS.function = _pool_connections
+        return _storage
+
+
+def _pool_connections():
+    return {(pool, state): count for pool, stats in _storage.pool_stats().items() for state, count in stats.items()}
@@ -0,0 +1,897 @@
+"""Storage operations shared by the ingest path and the API.
+
+All SQL is written once with %s placeholders; backends provide connections
+that accept it and override the few statements that differ between engines.
+"""
+
+import os, abc, json, hashlib, threading, time
+from datetime import datetime, timedelta
+from collections import Counter
+from contextlib import contextmanager
+
+from .render import RENDER_VERSION, render_headers, render_part_headers, render_part_content
+from .codec import Compressor, COMPRESSED_COLUMNS, decode, decode_row
+from .search import extract_text
+from . import metrics
+
+# Columns of the emails table, in the order GET /emails returns them
+EMAIL_COLUMNS = ['id', 'received_time', 'subject', 'from_email', 'from_name', 'reply_to_email', 'reply_to_name',
+                 'to_email', 'to_name', 'cc_email', 'cc_name', 'raw_headers', 'encoding', 'created_at']
+
+sql_email = """
+INSERT INTO emails (received_time, subject, from_email, from_name, reply_to_email, reply_to_name,
+                    to_email, to_name, cc_email, cc_name, raw_headers, raw_headers_codec, encoding,
+                    rendered_headers, rendered_headers_codec, render_version, idempotency_key)
+VALUES """
+email_values = "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+
+sql_parts = """
+INSERT INTO email_parts (email_id, headers, content_type, content, content_codec, rendered_headers,
+                         rendered_content, rendered_content_codec)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+sql_attachments = """
+INSERT INTO email_attachments (email_id, filename, content_type, digest, size)
+VALUES (%s, %s, %s, %s, %s)
+"""
+
+# Columns of email_attachments; the bytes live once per digest in attachment_blobs
+ATTACHMENT_COLUMNS = ['id', 'email_id', 'filename', 'content_type', 'digest', 'size']
+
+sql_recipients = """
+INSERT INTO email_recipients (email_id, address, role, received_time)
+VALUES (%s, %s, %s, %s)
+"""
+
+# Roles of email_recipients rows; bcc also covers envelope recipients missing from the headers
+RECIPIENT_ROLES = ['to', 'cc', 'bcc', 'reply_to']
+
+# Roles that count an email for its address and domain in recipient_stats and domain_stats
+DELIVERY_ROLES = ('to', 'cc', 'bcc')
+
+# Names of the stats_counters rows
+STATS_COUNTERS = ['emails', 'part_bytes', 'attachment_bytes', 'blob_bytes']
+
+# Seconds GET /emails/stats reuses the database size, which MySQL sums up over information_schema
+STATS_SIZE_TTL = int(os.getenv('STATS_SIZE_TTL', 300))
+
+
+def _email_row(data, compressor):
+    from_data = data['from'][0] if data['from'] else {'email': None, 'name': None}
+    reply_to_data = data['reply-to'][0] if data['reply-to'] else {'email': None, 'name': None}
+    to_data = data['to'][0] if data['to'] else {'email': None, 'name': None}
+    cc_data = data['cc'][0] if data['cc'] else {'email': None, 'name': None}
+    return (
+        data['datetime'], data['subject'],
+        from_data['email'], from_data['name'],
+        reply_to_data['email'], reply_to_data['name'],
+        to_data['email'], to_data['name'],
+        cc_data['email'], cc_data['name'],
+        *compressor.encode(json.dumps(data['headers'])), data['encoding'],
+        *compressor.encode(render_headers(data['headers'])), RENDER_VERSION,
+        data.get('idempotency-key')
+    )
+
+
+def recipient_addresses(data):
+    """Unique (address, role) pairs of a parsed message, addresses lowercased.
+
+    Envelope recipients (data['envelope-to'], from LMTP RCPT or the pipe argv)
+    that are not already a To or Cc recipient are recorded as bcc.
+    """
+    pairs = []
+    for role, key in (('to', 'to'), ('cc', 'cc'), ('bcc', 'bcc'), ('reply_to', 'reply-to')):
+        for recipient in data.get(key) or []:
+            address = (recipient['email'] or '').strip().lower()[:255]
+            if address and (address, role) not in pairs:
+                pairs.append((address, role))
+    delivered = {address for address, role in pairs if role != 'reply_to'}
+    for address in data.get('envelope-to') or []:
+        address = address.strip().lower()[:255]
+        if address and address not in delivered:
+            delivered.add(address)
+            pairs.append((address, 'bcc'))
+    return pairs
+
+
+def _recipient_rows(email_id, data):
+    return [(email_id, address, role, data['datetime']) for address, role in recipient_addresses(data)]
+
+
+def _recipient_counts(recipient_rows, sign=1):
+    """Per-address and per-domain email counts of email_recipients rows, each email counted once."""
+    addresses = Counter()
+    domains = Counter()
+    for email_id, address in {(row[0], row[1]) for row in recipient_rows if row[2] in DELIVERY_ROLES}:
+        addresses[address] += sign
+    for email_id, domain in {(row[0], row[1].rpartition('@')[2]) for row in recipient_rows if row[2] in DELIVERY_ROLES}:
+        domains[domain] += sign
+    return addresses, domains
+
+
+def _stored_length(value):
+    """Bytes a column value takes, whether it is stored as text or compressed bytes."""
+    if value is None:
+        return 0
+    return len(value.encode('utf-8')) if isinstance(value, str) else len(value)
+
+
+def _role_filter(roles):
+    """SQL condition and parameters restricting email_recipients to roles, empty for all roles."""
+    if not roles or set(roles) >= set(RECIPIENT_ROLES):
+        return "", []
+    roles = sorted(roles)
+    return f" AND role IN ({', '.join(['%s'] * len(roles))})", roles
+
+
+def _domain_pattern(domain):
+    """LIKE pattern (ESCAPE '!') of the addresses in a domain; its _ and % match only themselves."""
+    escaped = domain.lower().replace('!', '!!').replace('%', '!%').replace('_', '!_')
+    return '%@' + escaped
+
+
+def _part_rows(email_id, data, compressor):
+    return [(email_id, json.dumps(part['headers']), part['content_type'], *compressor.encode(part['content']),
+             render_part_headers(part['headers']), *compressor.encode(render_part_content(part['content'])))
+            for part in data['parts']]
+
+
+def _search_row(email_id, data):
+    # MailJson.parse extracts the text before the transaction; other callers get it extracted here
+    text = data.get('search-text')
+    return email_id, data['subject'], text if text is not None else extract_text(data['parts'])
+
+
+def pool_timeout(variable, default=None):
+    """Seconds from a wait timeout setting; 0 or unset (without default) waits as long as it takes."""
+    value = float(os.getenv(variable) or default or 0)
+    return value if value > 0 else None
+
+
+def setting_list(variable):
+    """Items of a comma separated setting such as DB_REPLICA_HOSTS."""
+    return [item.strip() for item in os.getenv(variable, '').split(',') if item.strip()]
+
+
+class PoolTimeout(Exception):
+    """No connection of a pool became free within its wait timeout."""
+
+
+class Pool(abc.ABC):
+    """Connections to one database server, at most maxconnections of them handed out at a time.
+
+    name labels the pool in the metrics: primary, or replica:<host or path>. A
+    caller waits up to timeout seconds for a free connection (None: as long as
+    it takes) before PoolTimeout. Backends cache the connections themselves,
+    see _connect().
+    """
+
+    def __init__(self, name, maxconnections, timeout=None):
+        self.name = name
+        self.maxconnections = maxconnections
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(maxconnections)
+
+    def connection(self):
+        started = time.perf_counter()
+        acquired = self._slots.acquire(timeout=self.timeout)
+        metrics.DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - started, (self.name,))
+        if not acquired:
+            metrics.DB_POOL_TIMEOUTS.inc((self.name,))
+            raise PoolTimeout("No %s database connection became free within %.1f s" % (self.name, self.timeout))
+        try:
+            return PooledConnection(self, self._connect())
+        except Exception:
+            self._slots.release()
+            raise
+
+    @abc.abstractmethod
+    def _connect(self):
+        """A cached or new DB-API connection whose close() hands it back to the cache."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _idle(self):
+        """Number of cached connections not handed out."""
+        raise NotImplementedError
+
+    def stats(self):
+        # The semaphore counts the connections not handed out
+        return {'in_use': self.maxconnections - self._slots._value, 'idle': self._idle(), 'max': self.maxconnections}
+
+
+class PooledConnection:
+    """A connection of a Pool; close() hands it back and frees its slot."""
+
+    def __init__(self, pool, conn):
+        self.pool = pool
+        self._conn = conn
+
+    def cursor(self):
+        return self._conn.cursor()
+
+    def begin(self):
+        self._conn.begin()
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            try:
+                conn.close()
+            finally:
+                self.pool._slots.release()
+
+
+def _attachment_digest(attachment):
+    return hashlib.sha256(attachment['content']).hexdigest()
+
+
+def _attachment_rows(email_id, data, blobs):
+    """Rows for email_attachments; collects the content of every digest into blobs."""
+    rows = []
+    for attachment in data['attachments']:
+        digest = _attachment_digest(attachment)
+        blobs[digest] = attachment['content']
+        rows.append((email_id, attachment['filename'], attachment['content_type'], digest, len(attachment['content'])))
+    return rows
+
+
+class Storage(abc.ABC):
+    """Base class for storage backends, see MySQLStorage and SQLiteStorage.
+
+    A backend implements the abstract methods and sets up the pools; the SQL
+    shared by both lives here.
+    """
+
+    name = None
+    # LIMIT to use when only an OFFSET is wanted
+    no_limit = None
+    # INSERT of an attachment_blobs row (digest, size, refcount, content) that adds
+    # refcount to the existing row instead if the digest is already stored
+    sql_blob_upsert = None
+    # INSERTs of recipient_stats (address, emails) and domain_stats (domain, emails) rows
+    # that add emails to the existing row instead
+    sql_recipient_stats_upsert = None
+    sql_domain_stats_upsert = None
+    # SQL for the length in bytes of a column, whether it holds text or a blob
+    byte_length = "LENGTH({})"
+    # Column of email_search holding the email id
+    search_id = 'email_id'
+
+    def __init__(self, compressor=None):
+        self.compressor = compressor or Compressor.from_env()
+        self._database_size = None  # (size in MB, monotonic time it was measured)
+        # Pools set up by the backend; writes only ever use the primary, see mailstore/replication.py for reads
+        self.primary = None
+        self.replicas = []
+
+    def connection(self):
+        """A pooled DB-API connection to the primary whose cursors return dict rows and take %s placeholders."""
+        return self.primary.connection()
+
+    def pool_stats(self):
+        """Connections of every pool by pool name and state: in_use, idle and max."""
+        return {pool.name: pool.stats() for pool in [self.primary] + self.replicas}
+
+    @contextmanager
+    def cursor(self, pool=None):
+        """Cursor on a pooled connection of pool (the primary by default), given back when the block ends."""
+        conn = (pool or self.primary).connection()
+        try:
+            with conn.cursor() as cursor:
+                yield cursor
+        finally:
+            conn.close()
+
+    @contextmanager
+    def transaction(self, operation='other'):
+        """Cursor inside an explicit transaction, committed when the block succeeds.
+
+        The time spent in the block and in the commit is recorded under operation.
+        """
+        conn = self.connection()
+        try:
+            self._begin(conn)
+            started = time.perf_counter()
+            with conn.cursor() as cursor:
+                yield cursor
+            committing = time.perf_counter()
+            conn.commit()
+            metrics.DB_TRANSACTION_SECONDS.observe(committing - started, (operation, 'statements'))
+            metrics.DB_TRANSACTION_SECONDS.observe(time.perf_counter() - committing, (operation, 'commit'))
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _begin(self, conn):
+        conn.begin()
+
+    @abc.abstractmethod
+    def _first_insert_id(self, cursor, count):
+        """Id of the first row of the multi-row INSERT just executed on cursor."""
+        raise NotImplementedError
+
+    # Ingest
+
+    def insert_email(self, data):
+        """Store a parsed message in one transaction and return its email id."""
+        return self.insert_email_batch([data])[0]
+
+    def insert_email_batch(self, batch):
+        """Store several parsed messages in one transaction and return their email ids.
+
+        All emails go in with a single multi-row INSERT, which both backends
+        number consecutively, so the ids are derived from the first one.
+        Messages whose idempotency-key is already stored, or repeated within
+        the batch, are not stored again and get the id of the existing email.
+        """
+        with self.transaction('insert') as cursor:
+            stored = self._stored_keys(cursor, batch)
+            new = []
+            for data in batch:
+                key = data.get('idempotency-key')
+                if key is None or key not in stored:
+                    new.append(data)
+                    if key is not None:
+                        stored[key] = None
+            if not new:
+                return [stored[data['idempotency-key']] for data in batch]
+
+            rows = []
+            for data in new:
+                rows.extend(_email_row(data, self.compressor))
+            cursor.execute(sql_email + ", ".join([email_values] * len(new)), rows)
+            first_id = self._first_insert_id(cursor, len(new))
+            new_ids = list(range(first_id, first_id + len(new)))
+
+            parts_data = []
+            attachments_data = []
+            recipients_data = []
+            search_data = []
+            blobs = {}
+            for email_id, data in zip(new_ids, new):
+                if data.get('idempotency-key') is not None:
+                    stored[data['idempotency-key']] = email_id
+                parts_data.extend(_part_rows(email_id, data, self.compressor))
+                attachments_data.extend(_attachment_rows(email_id, data, blobs))
+                recipients_data.extend(_recipient_rows(email_id, data))
+                search_data.append(_search_row(email_id, data))
+            blob_bytes = 0
+            if parts_data:
+                cursor.executemany(sql_parts, parts_data)
+            if attachments_data:
+                blob_bytes = self._reference_blobs(cursor, Counter(row[3] for row in attachments_data), blobs)
+                cursor.executemany(sql_attachments, attachments_data)
+            if recipients_data:
+                cursor.executemany(sql_recipients, recipients_data)
+            cursor.executemany(self._sql_search_insert(), search_data)
+            self._update_stats(cursor, {
+                'emails': len(new),
+                'part_bytes': sum(_stored_length(row[3]) for row in parts_data),
+                'attachment_bytes': sum(row[4] for row in attachments_data),
+                'blob_bytes': blob_bytes,
+            }, *_recipient_counts(recipients_data))
+
+        if len(new) == len(batch):
+            return new_ids
+        # Unkeyed messages are always new, and appear in new in batch order
+        unkeyed = iter(email_id for email_id, data in zip(new_ids, new) if data.get('idempotency-key') is None)
+        return [next(unkeyed) if data.get('idempotency-key') is None else stored[data['idempotency-key']]
+                for data in batch]
+
+    def _stored_keys(self, cursor, batch):
+        """Email id by idempotency key, for the keys of batch that are already stored."""
+        keys = sorted({data['idempotency-key'] for data in batch if data.get('idempotency-key') is not None})
+        if not keys:
+            return {}
+        cursor.execute("SELECT id, idempotency_key FROM emails WHERE idempotency_key IN (%s)"
+                       % ", ".join(["%s"] * len(keys)), keys)
+        return {row['idempotency_key']: row['id'] for row in cursor.fetchall()}
+
+    # Attachment blobs
+    #
+    # Every transaction touching attachment_blobs locks its rows in digest order
+    # before it writes email_attachments, so ingest and delete cannot deadlock on
+    # them, and a blob whose refcount reaches zero is deleted while still locked.
+
+    def _reference_blobs(self, cursor, counts, blobs):
+        """Add counts[digest] references to each blob, storing the bytes only for new digests.
+
+        Returns the bytes of the blobs stored.
+        """
+        stored = 0
+        for digest in sorted(counts):
+            cursor.execute("UPDATE attachment_blobs SET refcount = refcount + %s WHERE digest = %s", (counts[digest], digest))
+            if cursor.rowcount == 0:
+                # New, or concurrently inserted after our UPDATE missed it: the upsert handles both
+                content = blobs[digest]
+                cursor.execute(self.sql_blob_upsert, (digest, len(content), counts[digest], content))
+                cursor.execute("SELECT refcount FROM attachment_blobs WHERE digest = %s", (digest,))
+                if cursor.fetchone()['refcount'] == counts[digest]:
+                    stored += len(content)
+        return stored
+
+    def _release_blobs(self, cursor, counts):
+        """Drop counts[digest] references from each blob and delete the ones left unreferenced.
+
+        Returns the bytes of the blobs deleted.
+        """
+        freed = 0
+        for digest in sorted(counts):
+            cursor.execute("UPDATE attachment_blobs SET refcount = refcount - %s WHERE digest = %s", (counts[digest], digest))
+            cursor.execute("SELECT size FROM attachment_blobs WHERE digest = %s AND refcount <= 0", (digest,))
+            row = cursor.fetchone()
+            if row is not None:
+                freed += row['size']
+                cursor.execute("DELETE FROM attachment_blobs WHERE digest = %s", (digest,))
+        return freed
+
+    # Stats counters
+
+    # Every transaction that stores or deletes emails updates the counters last,
+    # each table in key order, so concurrent writers queue on them instead of deadlocking.
+
+    def _update_stats(self, cursor, totals, addresses, domains):
+        """Add the deltas to stats_counters, recipient_stats and domain_stats."""
+        if addresses:
+            cursor.executemany(self.sql_recipient_stats_upsert, sorted(addresses.items()))
+            self._drop_empty_stats(cursor, 'recipient_stats', 'address', addresses)
+        if domains:
+            cursor.executemany(self.sql_domain_stats_upsert, sorted(domains.items()))
+            self._drop_empty_stats(cursor, 'domain_stats', 'domain', domains)
+        for name in sorted(totals):
+            if totals[name]:
+                cursor.execute("UPDATE stats_counters SET value = value + %s WHERE name = %s", (totals[name], name))
+
+    def _drop_empty_stats(self, cursor, table, key, deltas):
+        emptied = sorted(k for k, delta in deltas.items() if delta < 0)
+        if emptied:
+            cursor.execute(f"DELETE FROM {table} WHERE {key} IN ({', '.join(['%s'] * len(emptied))}) AND emails <= 0",
+                           emptied)
+
+    # Reads
+
+    def count_emails(self, cursor, address, count_mode, roles=None):
+        """Number of emails for a recipient address: exact, an estimate, or None."""
+        if count_mode == 'none':
+            return None
+        if count_mode == 'estimate':
+            return self._estimate_count(cursor, address, roles)
+        role_sql, role_params = _role_filter(roles)
+        cursor.execute("SELECT COUNT(DISTINCT email_id) as count FROM email_recipients WHERE address = %s" + role_sql,
+                       [address.lower()] + role_params)
+        return cursor.fetchone()['count']
+
+    @abc.abstractmethod
+    def _estimate_count(self, cursor, address, roles):
+        """Approximate number of emails for address in roles (count_mode=estimate), cheaper than counting."""
+        raise NotImplementedError
+
+    def _select_by_recipient(self, cursor, columns, inner_sql, query_params, order_by):
+        """Load the emails whose (received_time, email_id) rows inner_sql picks from email_recipients.
+
+        The page is chosen on idx_recipients_address alone; emails is only read for
+        the rows of the page. DISTINCT folds an address holding several roles.
+        """
+        columns = columns + [COMPRESSED_COLUMNS['emails'][c] for c in columns if c in COMPRESSED_COLUMNS['emails']]
+        sql = (f"SELECT {', '.join('e.' + c for c in columns)} FROM ({inner_sql}) r "
+               f"JOIN emails e ON e.id = r.email_id ORDER BY {order_by}")
+        cursor.execute(sql, query_params)
+        return [decode_row(row, 'emails') for row in cursor.fetchall()]
+
+    def select_email_page(self, cursor, address, columns, scan_desc, limit, offset, position=None, roles=None):
+        """Emails of a recipient address ordered by (received_time, id), starting after position if given."""
+        direction = 'DESC' if scan_desc else 'ASC'
+        comparison = '<' if scan_desc else '>'
+        role_sql, role_params = _role_filter(roles)
+
+        sql = "SELECT DISTINCT received_time, email_id FROM email_recipients WHERE address = %s" + role_sql
+        query_params = [address.lower()] + role_params
+        if position:
+            received_time, email_id = position
+            sql += f" AND (received_time {comparison} %s OR (received_time = %s AND email_id {comparison} %s))"
+            query_params.extend([received_time, received_time, email_id])
+        sql += f" ORDER BY received_time {direction}, email_id {direction}"
+
+        if limit is not None:
+            sql += " LIMIT %s OFFSET %s"
+            query_params.extend([limit, offset])
+        elif offset:
+            sql += f" LIMIT {self.no_limit} OFFSET %s"
+            query_params.append(offset)
+
+        return self._select_by_recipient(cursor, columns, sql, query_params,
+                                         f"r.received_time {direction}, r.email_id {direction}")
+
+    def select_new_emails(self, cursor, address, columns, since_id, limit, roles=None):
+        """Emails stored for a recipient address after since_id, in arrival order."""
+        role_sql, role_params = _role_filter(roles)
+        sql = ("SELECT DISTINCT received_time, email_id FROM email_recipients WHERE address = %s AND email_id > %s"
+               + role_sql + " ORDER BY email_id LIMIT %s")
+        query_params = [address.lower(), since_id] + role_params + [limit]
+        return self._select_by_recipient(cursor, columns, sql, query_params, "r.email_id")
+
+    def select_by_email_ids(self, cursor, table, columns, email_ids):
+        """Rows of a child table for a whole page of emails in one query, grouped by email_id."""
+        grouped = {email_id: [] for email_id in email_ids}
+        if not email_ids:
+            return grouped
+        placeholders = ', '.join(['%s'] * len(email_ids))
+        cursor.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE email_id IN ({placeholders}) ORDER BY id", email_ids)
+        for row in cursor.fetchall():
+            grouped[row['email_id']].append(row)
+        return grouped
+
+    def select_parts(self, cursor, email_ids):
+        """Rendered parts of a page of emails grouped by email_id; headers and content are JSON text."""
+        grouped = {email_id: [] for email_id in email_ids}
+        if not email_ids:
+            return grouped
+        placeholders = ', '.join(['%s'] * len(email_ids))
+        cursor.execute(f"SELECT id, email_id, rendered_headers AS headers, content_type, rendered_content AS content, "
+                       f"rendered_content_codec FROM email_parts WHERE email_id IN ({placeholders}) ORDER BY id", email_ids)
+        for row in cursor.fetchall():
+            row['content'] = decode(row['content'], row.pop('rendered_content_codec'))
+            grouped[row['email_id']].append(row)
+        return grouped
+
+    def select_attachments(self, cursor, email_ids, with_content=False):
+        """Attachments of a page of emails grouped by email_id, with their bytes if with_content."""
+        if not with_content:
+            return self.select_by_email_ids(cursor, 'email_attachments', ATTACHMENT_COLUMNS, email_ids)
+        grouped = {email_id: [] for email_id in email_ids}
+        if not email_ids:
+            return grouped
+        columns = ', '.join('a.' + c for c in ATTACHMENT_COLUMNS)
+        placeholders = ', '.join(['%s'] * len(email_ids))
+        cursor.execute(f"SELECT {columns}, b.content FROM email_attachments a "
+                       f"LEFT JOIN attachment_blobs b ON b.digest = a.digest "
+                       f"WHERE a.email_id IN ({placeholders}) ORDER BY a.id", email_ids)
+        for row in cursor.fetchall():
+            grouped[row['email_id']].append(row)
+        return grouped
+
+    def select_attachment(self, cursor, email_id, attachment_id):
+        """Metadata of one attachment of an email, or None."""
+        cursor.execute(f"SELECT {', '.join(ATTACHMENT_COLUMNS)} FROM email_attachments WHERE id = %s AND email_id = %s",
+                       (attachment_id, email_id))
+        return cursor.fetchone()
+
+    def read_blob(self, cursor, digest, offset, length):
+        """length bytes of a blob starting at offset; the database slices it, so only those bytes are sent.
+
+        The server still reads the whole blob on every call (InnoDB on MySQL 5.7
+        has no partial read of an off-page LONGBLOB, nor does SQLite of an
+        overflow chain), so read a blob in as few calls as memory allows.
+        Returns None if the blob no longer exists.
+        """
+        cursor.execute("SELECT SUBSTR(content, %s, %s) AS chunk FROM attachment_blobs WHERE digest = %s",
+                       (offset + 1, length, digest))
+        row = cursor.fetchone()
+        return row['chunk'] if row else None
+
+    # Rendering
+
+    def stale_email_ids(self, cursor, limit, after_id=0):
+        """Ids of emails rendered by an older RENDER_VERSION (or never), in id order."""
+        cursor.execute("SELECT id FROM emails WHERE id > %s AND (render_version IS NULL OR render_version < %s) "
+                       "ORDER BY id LIMIT %s", (after_id, RENDER_VERSION, limit))
+        return [row['id'] for row in cursor.fetchall()]
+
+    def rerender(self, email_ids):
+        """Render emails and their parts again from the stored raw columns.
+
+        Returns ({email_id: rendered_headers}, {email_id: rendered parts as select_parts returns them}) for the
+        emails that still exist, so callers reading from a replica need not wait for it to replicate the update.
+        """
+        if not email_ids:
+            return {}, {}
+        placeholders = ', '.join(['%s'] * len(email_ids))
+        with self.transaction('rerender') as cursor:
+            cursor.execute(f"SELECT id, raw_headers, raw_headers_codec FROM emails WHERE id IN ({placeholders})", email_ids)
+            rendered = {row['id']: render_headers(json.loads(decode_row(row, 'emails')['raw_headers'] or '{}'))
+                        for row in cursor.fetchall()}
+            cursor.execute(f"SELECT id, email_id, headers, content_type, content, content_codec FROM email_parts "
+                           f"WHERE email_id IN ({placeholders}) ORDER BY id", email_ids)
+            parts_by_email = {email_id: [] for email_id in rendered}
+            parts_data = []
+            for row in cursor.fetchall():
+                row = decode_row(row, 'email_parts')
+                headers = render_part_headers(json.loads(row['headers'] or '{}'))
+                content = render_part_content(row['content'])
+                parts_data.append((headers, *self.compressor.encode(content), row['id']))
+                if row['email_id'] in parts_by_email:
+                    parts_by_email[row['email_id']].append({'id': row['id'], 'email_id': row['email_id'], 'headers': headers,
+                                                            'content_type': row['content_type'], 'content': content})
+            if parts_data:
+                cursor.executemany("UPDATE email_parts SET rendered_headers = %s, rendered_content = %s, rendered_content_codec = %s "
+                                   "WHERE id = %s", parts_data)
+            if rendered:
+                cursor.executemany("UPDATE emails SET rendered_headers = %s, rendered_headers_codec = %s, render_version = %s WHERE id = %s",
+                                   [(*self.compressor.encode(headers), RENDER_VERSION, email_id) for email_id, headers in rendered.items()])
+        return rendered, parts_by_email
+
+    # Search
+
+    def _sql_search_insert(self):
+        return f"INSERT INTO email_search ({self.search_id}, subject, body) VALUES (%s, %s, %s)"
+
+    @abc.abstractmethod
+    def _search_match(self, terms):
+        """(condition, relevance, condition params, relevance params): SQL on email_search s matching every term
+        and its relevance, higher for better matches."""
+        raise NotImplementedError
+
+    def search_emails(self, cursor, terms, columns, limit, offset, to_email=None, roles=None, from_email=None,
+                      since=None, until=None):
+        """Emails matching every search term, best match first, each row with its relevance as score.
+
+        The full-text index picks the candidates; the recipient, sender and
+        received_time filters are applied to those.
+        """
+        match_sql, score_sql, match_params, score_params = self._search_match(terms)
+        columns = columns + [COMPRESSED_COLUMNS['emails'][c] for c in columns if c in COMPRESSED_COLUMNS['emails']]
+        sql = (f"SELECT {score_sql} AS score, {', '.join('e.' + c for c in columns)} FROM email_search s "
+               f"JOIN emails e ON e.id = s.{self.search_id} WHERE {match_sql}")
+        params = score_params + match_params
+        if to_email:
+            role_sql, role_params = _role_filter(roles)
+            sql += " AND EXISTS (SELECT 1 FROM email_recipients r WHERE r.email_id = e.id AND r.address = %s" + role_sql + ")"
+            params.extend([to_email.lower()] + role_params)
+        if from_email:
+            sql += " AND LOWER(e.from_email) = %s"
+            params.append(from_email.lower())
+        if since is not None:
+            sql += " AND e.received_time >= %s"
+            params.append(since)
+        if until is not None:
+            sql += " AND e.received_time < %s"
+            params.append(until)
+        sql += " ORDER BY score DESC, e.id DESC LIMIT %s OFFSET %s"
+        params.extend([limit, offset])
+        cursor.execute(sql, params)
+        return [decode_row(row, 'emails') for row in cursor.fetchall()]
+
+    def unindexed_email_ids(self, cursor, limit, after_id=0, everything=False):
+        """Ids of emails missing from email_search (of all emails if everything), in id order."""
+        sql = "SELECT id FROM emails e WHERE id > %s"
+        if not everything:
+            sql += f" AND NOT EXISTS (SELECT 1 FROM email_search s WHERE s.{self.search_id} = e.id)"
+        cursor.execute(sql + " ORDER BY id LIMIT %s", (after_id, limit))
+        return [row['id'] for row in cursor.fetchall()]
+
+    def index_emails(self, email_ids):
+        """Extract the text of stored emails again and replace their email_search rows."""
+        if not email_ids:
+            return
+        placeholders = ', '.join(['%s'] * len(email_ids))
+        with self.transaction('reindex') as cursor:
+            cursor.execute(f"SELECT id, subject FROM emails WHERE id IN ({placeholders})", email_ids)
+            rows = {row['id']: {'subject': row['subject'], 'parts': []} for row in cursor.fetchall()}
+            cursor.execute(f"SELECT email_id, content_type, content, content_codec FROM email_parts "
+                           f"WHERE email_id IN ({placeholders}) ORDER BY id", email_ids)
+            for part in cursor.fetchall():
+                rows[part['email_id']]['parts'].append(decode_row(part, 'email_parts'))
+            cursor.execute(f"DELETE FROM email_search WHERE {self.search_id} IN ({placeholders})", email_ids)
+            if rows:
+                cursor.executemany(self._sql_search_insert(),
+                                   [_search_row(email_id, data) for email_id, data in sorted(rows.items())])
+
+    # Compression
+
+    def recompress(self, table, after_id, limit, force=False):
+        """Rewrite the compressed columns of up to limit rows of table after after_id with the current compressor.
+
+        Values already stored with the target codec are left alone unless force
+        (e.g. to apply a new COMPRESSION_LEVEL). Returns (last_id, rows scanned,
+        rows rewritten); last_id is None when the table is done.
+        """
+        columns = COMPRESSED_COLUMNS[table]
+        selected = ', '.join(f"{column}, {flag}" for column, flag in columns.items())
+        assignments = ', '.join(f"{column} = %s, {flag} = %s" for column, flag in columns.items())
+        with self.transaction('recompress') as cursor:
+            cursor.execute(f"SELECT id, {selected} FROM {table} WHERE id > %s ORDER BY id LIMIT %s", (after_id, limit))
+            rows = cursor.fetchall()
+            updates = []
+            part_bytes = 0
+            for row in rows:
+                values = []
+                changed = False
+                for column, flag in columns.items():
+                    value, codec = self.compressor.encode(decode(row[column], row[flag]))
+                    changed = changed or force or codec != (row[flag] or 0)
+                    values.extend([value, codec])
+                    if column == 'content':
+                        part_bytes += _stored_length(value) - _stored_length(row[column])
+                if changed:
+                    updates.append((*values, row['id']))
+            if updates:
+                cursor.executemany(f"UPDATE {table} SET {assignments} WHERE id = %s", updates)
+                self._update_stats(cursor, {'part_bytes': part_bytes}, None, None)
+        return (rows[-1]['id'] if rows else None), len(rows), len(updates)
+
+    # Deletes
+
+    def delete_email(self, email_id):
+        """Delete one email with its parts, attachments and recipients.
+
+        Returns (deleted, addresses) so callers can invalidate what they cached.
+        """
+        deleted, addresses = self.delete_emails([email_id])
+        return deleted > 0, addresses
+
+    def delete_emails(self, email_ids):
+        """Delete a chunk of emails with their parts, attachments and recipients in one transaction.
+
+        Returns (number deleted, recipient addresses) so callers can invalidate what they cached.
+        """
+        if not email_ids:
+            return 0, []
+        ids_sql = ", ".join(["%s"] * len(email_ids))
+        email_ids = list(email_ids)
+        with self.transaction('delete') as cursor:
+            cursor.execute(f"SELECT email_id, address, role FROM email_recipients WHERE email_id IN ({ids_sql})", email_ids)
+            recipients = [(row['email_id'], row['address'], row['role']) for row in cursor.fetchall()]
+            addresses = sorted({address for _, address, _ in recipients})
+            cursor.execute(f"SELECT digest, size FROM email_attachments WHERE email_id IN ({ids_sql})", email_ids)
+            attachments = cursor.fetchall()
+            digests = Counter(row['digest'] for row in attachments)
+            cursor.execute(f"SELECT COALESCE(SUM({self.byte_length.format('content')}), 0) AS bytes"
+                           f" FROM email_parts WHERE email_id IN ({ids_sql})", email_ids)
+            part_bytes = int(cursor.fetchone()['bytes'])
+
+            cursor.execute(f"DELETE FROM email_parts WHERE email_id IN ({ids_sql})", email_ids)
+            blob_bytes = self._release_blobs(cursor, digests)
+            cursor.execute(f"DELETE FROM email_attachments WHERE email_id IN ({ids_sql})", email_ids)
+            cursor.execute(f"DELETE FROM email_recipients WHERE email_id IN ({ids_sql})", email_ids)
+            cursor.execute(f"DELETE FROM email_search WHERE {self.search_id} IN ({ids_sql})", email_ids)
+            cursor.execute(f"DELETE FROM emails WHERE id IN ({ids_sql})", email_ids)
+            deleted = cursor.rowcount
+            self._update_stats(cursor, {
+                'emails': -deleted,
+                'part_bytes': -part_bytes,
+                'attachment_bytes': -sum(row['size'] or 0 for row in attachments),
+                'blob_bytes': -blob_bytes,
+            }, *_recipient_counts(recipients, -1))
+        return deleted, addresses
+
+    def delete_all_emails(self, max_id, chunk_size=1000, progress=None):
+        """Delete every email up to id max_id, chunk_size per transaction, so no statement locks whole tables.
+
+        Mail stored later is left alone, so the job ends under steady ingest.
+        Calls progress(deleted, addresses) after each chunk and returns the number deleted.
+        """
+        total = 0
+        last_id = 0
+        while True:
+            with self.cursor() as cursor:
+                cursor.execute("SELECT id FROM emails WHERE id > %s AND id <= %s ORDER BY id LIMIT %s",
+                               (last_id, max_id, chunk_size))
+                email_ids = [row['id'] for row in cursor.fetchall()]
+            if not email_ids:
+                return total
+            last_id = email_ids[-1]
+            deleted, addresses = self.delete_emails(email_ids)
+            total += deleted
+            if progress is not None:
+                progress(deleted, addresses)
+
+    def email_count(self, cursor):
+        """Number of stored emails, from the counter the writers maintain."""
+        cursor.execute("SELECT value FROM stats_counters WHERE name = 'emails'")
+        row = cursor.fetchone()
+        return int(row['value']) if row else 0
+
+    def newest_email_id(self, cursor):
+        """Highest email id stored, 0 for an empty database."""
+        cursor.execute("SELECT COALESCE(MAX(id), 0) AS id FROM emails")
+        return int(cursor.fetchone()['id'])
+
+    def recipients_between(self, cursor, after_id, until_id):
+        """Addresses of every recipient role of the emails with after_id < id <= until_id, a primary key range scan."""
+        cursor.execute("SELECT DISTINCT address FROM email_recipients WHERE email_id > %s AND email_id <= %s",
+                       (after_id, until_id))
+        return [row['address'] for row in cursor.fetchall()]
+
+    def replication_delay(self, cursor):
+        """Seconds the server reports it is behind its primary, None if it is not replicating; 0 where the backend cannot tell."""
+        return 0
+
+    def current_time(self, cursor):
+        """The database's CURRENT_TIMESTAMP, the clock created_at is set by."""
+        cursor.execute("SELECT CURRENT_TIMESTAMP AS now")
+        now = cursor.fetchone()['now']
+        return datetime.fromisoformat(now) if isinstance(now, str) else now
+
+    def expired_emails(self, cursor, cutoff, limit, domain=None, exclude_domains=(), position=None):
+        """(created_at, id) rows of emails stored before cutoff, oldest first, starting after position if given.
+
+        domain keeps emails with a To, Cc or Bcc recipient in that domain,
+        exclude_domains drops those with one in any of these.
+        """
+        sql = "SELECT created_at, id FROM emails e WHERE created_at < %s"
+        params = [cutoff]
+        if position is not None:
+            created_at, email_id = position
+            sql += " AND (created_at > %s OR (created_at = %s AND id > %s))"
+            params.extend([created_at, created_at, email_id])
+        recipient_sql = ("SELECT 1 FROM email_recipients r WHERE r.email_id = e.id AND r.role IN ('to', 'cc', 'bcc')"
+                         " AND (%s)")
+        # ! escapes the LIKE wildcards a domain may contain; a backslash would need escaping in MySQL literals only
+        address_like = "r.address LIKE %s ESCAPE '!'"
+        if domain is not None:
+            sql += " AND EXISTS (" + recipient_sql % address_like + ")"
+            params.append(_domain_pattern(domain))
+        if exclude_domains:
+            sql += " AND NOT EXISTS (" + recipient_sql % " OR ".join([address_like] * len(exclude_domains)) + ")"
+            params.extend(_domain_pattern(excluded) for excluded in exclude_domains)
+        sql += " ORDER BY created_at, id LIMIT %s"
+        params.append(limit)
+        cursor.execute(sql, params)
+        return [(row['created_at'], row['id']) for row in cursor.fetchall()]
+
+    # Stats
+
+    def stats(self, cursor, top=10, address=None, domain=None):
+        """Totals from the counters the writers maintain, so the cost does not grow with the tables.
+
+        Adds the top recipients and domains by email count, the count for one
+        address or domain if given, and the emails stored in the last 1 and 5
+        minutes, counted on idx_created_at.
+        """
+        cursor.execute("SELECT name, value FROM stats_counters")
+        counters = {row['name']: int(row['value']) for row in cursor.fetchall()}
+
+        now = self.current_time(cursor)
+        cursor.execute("SELECT COUNT(*) AS last_5m, COALESCE(SUM(CASE WHEN created_at >= %s THEN 1 ELSE 0 END), 0) AS last_1m"
+                       " FROM emails WHERE created_at >= %s", (now - timedelta(minutes=1), now - timedelta(minutes=5)))
+        recent = cursor.fetchone()
+
+        stats = {
+            "total_email_count": counters.get('emails', 0),
+            "database_size_mb": self._cached_database_size_mb(cursor),
+            "part_bytes": counters.get('part_bytes', 0),
+            "attachment_bytes": counters.get('attachment_bytes', 0),
+            "attachment_stored_bytes": counters.get('blob_bytes', 0),
+            "ingest_rate": {
+                "1m": {"emails": int(recent['last_1m']), "per_second": round(int(recent['last_1m']) / 60, 2)},
+                "5m": {"emails": int(recent['last_5m']), "per_second": round(int(recent['last_5m']) / 300, 2)},
+            },
+            "top_recipients": self._top_stats(cursor, 'recipient_stats', 'address', top),
+            "top_domains": self._top_stats(cursor, 'domain_stats', 'domain', top),
+        }
+        if address is not None:
+            stats["recipient"] = self._one_stat(cursor, 'recipient_stats', 'address', address.lower())
+        if domain is not None:
+            stats["domain"] = self._one_stat(cursor, 'domain_stats', 'domain', domain.lower())
+        return stats
+
+    def _top_stats(self, cursor, table, key, limit):
+        if not limit:
+            return []
+        cursor.execute(f"SELECT {key}, emails FROM {table} ORDER BY emails DESC LIMIT %s", (limit,))
+        return [{key: row[key], "emails": int(row['emails'])} for row in cursor.fetchall()]
+
+    def _one_stat(self, cursor, table, key, value):
+        cursor.execute(f"SELECT emails FROM {table} WHERE {key} = %s", (value,))
+        row = cursor.fetchone()
+        return {key: value, "emails": int(row['emails']) if row else 0}
+
+    def _cached_database_size_mb(self, cursor):
+        if self._database_size is None or time.monotonic() - self._database_size[1] > STATS_SIZE_TTL:
+            self._database_size = (self._database_size_mb(cursor), time.monotonic())
+        return self._database_size[0]
+
+    @abc.abstractmethod
+    def _database_size_mb(self, cursor):
+        """Size of the database files in MB."""
+        raise NotImplementedError
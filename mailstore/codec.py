@@ -0,0 +1,107 @@
+"""Optional compression of large text columns.
+
+Each compressed column has a companion <column>_codec flag telling how its
+value is stored, so rows written before compression was enabled, or with a
+different codec, keep reading back correctly:
+
+    0 or NULL  plain UTF-8 text
+    1          zlib
+    2          zstd (needs the zstandard package)
+
+STORAGE_COMPRESSION selects the codec for new values (none, zlib or zstd).
+Values shorter than COMPRESSION_MIN_BYTES, or that do not shrink, stay plain.
+"""
+
+import os, threading, zlib
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+
+CODECS = {'none': CODEC_NONE, 'zlib': CODEC_ZLIB, 'zstd': CODEC_ZSTD}
+
+# Compressed columns and their codec flag column, per table
+COMPRESSED_COLUMNS = {
+    'emails': {'raw_headers': 'raw_headers_codec', 'rendered_headers': 'rendered_headers_codec'},
+    'email_parts': {'content': 'content_codec', 'rendered_content': 'rendered_content_codec'},
+}
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class Compressor:
+    def __init__(self, codec='none', min_bytes=512, level=None):
+        if codec not in CODECS:
+            raise ValueError("STORAGE_COMPRESSION must be one of %s, got %r" % (", ".join(CODECS), codec))
+        if codec == 'zstd' and zstandard is None:
+            raise ValueError("STORAGE_COMPRESSION=zstd needs the zstandard package")
+        self.name = codec
+        self.codec = CODECS[codec]
+        self.min_bytes = min_bytes
+        if codec == 'zlib':
+            self.level = level if level is not None else 6
+        elif codec == 'zstd':
+            self.level = level if level is not None else 3
+        else:
+            self.level = None
+
+    @classmethod
+    def from_env(cls):
+        level = os.getenv('COMPRESSION_LEVEL')
+        return cls(os.getenv('STORAGE_COMPRESSION', 'none'),
+                   int(os.getenv('COMPRESSION_MIN_BYTES', 512)),
+                   int(level) if level else None)
+
+    def encode(self, text):
+        """(value, codec) to store for text."""
+        if text is None or self.codec == CODEC_NONE:
+            return text, CODEC_NONE
+        raw = text.encode('utf-8')
+        if len(raw) < self.min_bytes:
+            return text, CODEC_NONE
+        if self.codec == CODEC_ZLIB:
+            packed = zlib.compress(raw, self.level)
+        else:
+            packed = _zstd('compressor%d' % self.level, lambda: zstandard.ZstdCompressor(level=self.level)).compress(raw)
+        if len(packed) >= len(raw):
+            return text, CODEC_NONE
+        return packed, self.codec
+
+
+# zstandard (de)compressor objects must not be shared between threads
+_local = threading.local()
+
+
+def _zstd(kind, create):
+    instance = getattr(_local, kind, None)
+    if instance is None:
+        instance = create()
+        setattr(_local, kind, instance)
+    return instance
+
+
+def decode(value, codec):
+    """Text of a stored value, whatever codec it was written with."""
+    if value is None:
+        return None
+    if not codec:
+        return bytes(value).decode('utf-8') if isinstance(value, (bytes, bytearray, memoryview)) else value
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(value).decode('utf-8')
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("Row compressed with zstd but the zstandard package is not installed")
+        # The frame header carries the content size, so no max_output_size is needed
+        return _zstd('decompressor', zstandard.ZstdDecompressor).decompress(value).decode('utf-8')
+    raise ValueError("Unknown codec %r" % codec)
+
+
+def decode_row(row, table):
+    """Decode the compressed columns present in a dict row in place and drop their codec flags."""
+    for column, flag in COMPRESSED_COLUMNS[table].items():
+        if column in row:
+            row[column] = decode(row[column], row.pop(flag, None))
+    return row
@@ -0,0 +1,253 @@
+"""In-process metrics in the Prometheus text exposition format.
+
+The LMTP server (METRICS_LISTEN) and the API (GET /metrics) record into the
+module-level registry and render it when scraped. Recording a value is a
+bisect and a few additions under a lock, about a microsecond, so the
+instrumentation stays on in production; nothing is sent anywhere.
+
+Values are per process and start from zero on restart, as Prometheus
+expects of counters and histograms.
+"""
+
+import bisect, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import contextmanager
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds, from a cached lookup to a slow batch commit
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in zip(names, values))
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label values tuple -> value
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """(name suffix, label names, label values, value) for every series."""
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            yield '', self.labelnames, labels, value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, names, values, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, _labels(names, values), _number(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """A value set as it changes, or read from function() on every scrape.
+
+    function returns the value, or with labels a dict of label values tuple -> value.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+    def samples(self):
+        if self.function is None:
+            yield from super().samples()
+            return
+        values = self.function()
+        if values is None:
+            return
+        if not self.labelnames:
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            yield '', self.labelnames, labels, value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=TIME_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                # Per-bucket (not cumulative) counts, the last one past every bound, then the sum
+                series = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, labels=()):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, labels)
+
+    def samples(self):
+        with self._lock:
+            items = sorted((labels, list(series)) for labels, series in self._values.items())
+        names = self.labelnames + ('le',)
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                yield '_bucket', names, labels + (_number(bound),), cumulative
+            yield '_sum', self.labelnames, labels, series[-1]
+            yield '_count', self.labelnames, labels, cumulative
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError("Metric %s is already registered" % metric.name)
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=TIME_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """The whole registry in the Prometheus text format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return ''.join(metric.render() + '\n' for metric in metrics)
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+render = REGISTRY.render
+
+# Recorded by the storage layer in every process that uses it
+DB_QUERY_SECONDS = histogram('email_db_query_seconds', 'Time to execute one SQL statement')
+DB_TRANSACTION_SECONDS = histogram('email_db_transaction_seconds',
+                                   'Time spent in write transactions, in the statements and in the commit',
+                                   ['operation', 'phase'])
+DB_POOL_WAIT_SECONDS = histogram('email_db_pool_wait_seconds', 'Time to get a connection from a pool', ['pool'])
+DB_POOL_TIMEOUTS = counter('email_db_pool_timeouts_total', 'Waits for a pooled connection given up after the pool timeout',
+                           ['pool'])
+DB_POOL_CONNECTIONS = gauge('email_db_pool_connections', 'Pooled database connections by pool and state (in_use, idle, max)',
+                            ['pool', 'state'])
+
+
+class RequestStats:
+    """Database and serialization work done for the current request of a thread."""
+    __slots__ = ('queries', 'db_seconds', 'serialization_seconds')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serialization_seconds = 0.0
+
+
+_local = threading.local()
+
+
+def begin_request():
+    """Start attributing queries and serialization on this thread to a new RequestStats."""
+    stats = _local.stats = RequestStats()
+    return stats
+
+
+def end_request():
+    _local.stats = None
+
+
+def record_query(seconds):
+    DB_QUERY_SECONDS.observe(seconds)
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += seconds
+
+
+def record_fetch(seconds):
+    """Time spent fetching rows of a statement already recorded with record_query."""
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.db_seconds += seconds
+
+
+def record_serialization(seconds):
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.serialization_seconds += seconds
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Every scrape would otherwise be written to stderr
+        pass
+
+
+def start_http_server(listen):
+    """Serve GET /metrics on host:port from a daemon thread, for processes without a web server."""
+    host, _, port = listen.rpartition(':')
+    server = ThreadingHTTPServer((host, int(port)), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -0,0 +1,129 @@
+"""MySQL backend: the docker-compose mysql:5.7 service through a PyMySQL pool.
+
+DB_REPLICA_HOSTS lists read replicas as host or host:port, reached with the
+same user, password and database; see mailstore/replication.py.
+"""
+
+import os, time
+import logging
+
+import pymysql
+from dbutils.pooled_db import PooledDB
+
+from . import metrics
+from .base import Storage, Pool, _role_filter, pool_timeout, setting_list
+from .search import boolean_query
+
+
+class TimedDictCursor(pymysql.cursors.DictCursor):
+    """DictCursor recording every statement; the buffered result is read inside execute()."""
+
+    def execute(self, query, args=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, args)
+        finally:
+            metrics.record_query(time.perf_counter() - started)
+
+
+class MySQLPool(Pool):
+    """A PooledDB of one server; PooledDB never blocks as the Pool hands out no more than maxconnections."""
+
+    def __init__(self, name, maxconnections, timeout=None, **connect_args):
+        super().__init__(name, maxconnections, timeout)
+        self._pool = PooledDB(
+            creator=pymysql,
+            autocommit=True,
+            cursorclass=TimedDictCursor,
+            blocking=True,
+            maxconnections=maxconnections,
+            **connect_args
+        )
+
+    def _connect(self):
+        return self._pool.connection()
+
+    def _idle(self):
+        # PooledDB keeps no public counters
+        return len(self._pool._idle_cache)
+
+
+def _host_port(address):
+    host, _, port = address.partition(':')
+    return host, int(port or 3306)
+
+
+class MySQLStorage(Storage):
+    name = 'mysql'
+    no_limit = '18446744073709551615'  # MySQL's maximum limit
+    sql_blob_upsert = """
+    INSERT INTO attachment_blobs (digest, size, refcount, content) VALUES (%s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE refcount = refcount + VALUES(refcount)
+    """
+    sql_recipient_stats_upsert = """
+    INSERT INTO recipient_stats (address, emails) VALUES (%s, %s)
+    ON DUPLICATE KEY UPDATE emails = emails + VALUES(emails)
+    """
+    sql_domain_stats_upsert = """
+    INSERT INTO domain_stats (domain, emails) VALUES (%s, %s)
+    ON DUPLICATE KEY UPDATE emails = emails + VALUES(emails)
+    """
+
+    def __init__(self, host=None, user=None, password=None, database=None, charset=None, maxconnections=None, compressor=None):
+        super().__init__(compressor)
+        self.database = database or os.getenv('DB_NAME')
+        connect_args = dict(
+            user=user or os.getenv('DB_USER'),
+            password=password or os.getenv('DB_PASSWORD'),
+            database=self.database,
+            charset=charset or os.getenv('DB_CHARSET')
+        )
+        maxconnections = maxconnections or int(os.getenv('DB_MAX_CONNECTIONS', 5))
+        self.primary = MySQLPool('primary', maxconnections, pool_timeout('DB_POOL_TIMEOUT'),
+                                 host=host or os.getenv('DB_HOST'), **connect_args)
+        replica_connections = int(os.getenv('DB_REPLICA_MAX_CONNECTIONS', maxconnections))
+        self.replicas = []
+        for address in setting_list('DB_REPLICA_HOSTS'):
+            replica_host, replica_port = _host_port(address)
+            self.replicas.append(MySQLPool('replica:' + address, replica_connections,
+                                           pool_timeout('DB_REPLICA_POOL_TIMEOUT', 0.5),
+                                           host=replica_host, port=replica_port, **connect_args))
+
+    def _first_insert_id(self, cursor, count):
+        # LAST_INSERT_ID() is the first row of the statement; InnoDB numbers the rest
+        # consecutively with innodb_autoinc_lock_mode 0 or 1 (the MySQL 5.7 default)
+        return cursor.lastrowid
+
+    def _search_match(self, terms):
+        # InnoDB ranks boolean mode matches too; the same MATCH in both places is evaluated once
+        match = "MATCH (s.subject, s.body) AGAINST (%s IN BOOLEAN MODE)"
+        query = boolean_query(terms)
+        return match, match, [query], [query]
+
+    def _estimate_count(self, cursor, address, roles):
+        # The optimizer's row estimate for the address index range, no rows are read;
+        # counts an email once per role the address holds in it
+        role_sql, role_params = _role_filter(roles)
+        cursor.execute("EXPLAIN SELECT email_id FROM email_recipients WHERE address = %s" + role_sql,
+                       [address.lower()] + role_params)
+        return cursor.fetchone()['rows']
+
+    def replication_delay(self, cursor):
+        # Needs the REPLICATION CLIENT privilege; a server that is no replica returns no row
+        cursor.execute("SHOW SLAVE STATUS")
+        status = cursor.fetchone()
+        if status is None:
+            logging.warning("SHOW SLAVE STATUS returned no row: the server is not a replica")
+            return None
+        return status['Seconds_Behind_Master']
+
+    def _database_size_mb(self, cursor):
+        cursor.execute("""
+        SELECT table_schema AS database_name,
+               ROUND(SUM(data_length + index_length) / 1024 / 1024, 2) AS size_mb
+        FROM information_schema.tables
+        WHERE table_schema = %s
+        GROUP BY table_schema
+        """, (self.database,))
+        row = cursor.fetchone()
+        return row['size_mb'] if row else 0
@@ -0,0 +1,52 @@
+"""Rewrite stored text columns with the configured compression.
+
+    python -m mailstore.recompress [-c zlib|zstd|none] [-l LEVEL] [-b BATCH_SIZE] [--force]
+
+Uses STORAGE_COMPRESSION / COMPRESSION_LEVEL / COMPRESSION_MIN_BYTES unless
+overridden. -c none decompresses everything again. Safe to run while mail is
+being received and served: every row is readable whatever codec it has.
+"""
+
+import time
+import logging
+from optparse import OptionParser
+
+from dotenv import load_dotenv
+
+from . import get_storage
+from .codec import Compressor, COMPRESSED_COLUMNS
+
+
+def main():
+    parser = OptionParser(usage="usage: python -m mailstore.recompress [options]")
+    parser.add_option("-c", "--codec", dest="codec", help="none, zlib or zstd (default STORAGE_COMPRESSION)")
+    parser.add_option("-l", "--level", dest="level", type="int", help="compression level")
+    parser.add_option("-b", "--batch-size", dest="batch_size", type="int", default=500, help="rows per transaction")
+    parser.add_option("-f", "--force", dest="force", action="store_true", default=False,
+                      help="also rewrite values already stored with the target codec")
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    load_dotenv()
+    storage = get_storage()
+    compressor = Compressor.from_env()
+    if options.codec or options.level is not None:
+        compressor = Compressor(options.codec or compressor.name, compressor.min_bytes, options.level)
+    storage.compressor = compressor
+
+    for table in COMPRESSED_COLUMNS:
+        scanned = rewritten = 0
+        last_id = 0
+        started = time.monotonic()
+        while last_id is not None:
+            last_id, rows, changed = storage.recompress(table, last_id, options.batch_size, options.force)
+            scanned += rows
+            rewritten += changed
+            if rows:
+                logging.info("%s: %d rows scanned, %d rewritten (up to id %d), %.0f rows/s",
+                             table, scanned, rewritten, last_id, scanned / (time.monotonic() - started))
+        logging.info("%s: done, %d of %d rows rewritten with %s", table, rewritten, scanned, compressor.name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""Add emails to the full-text search index (email_search).
+
+    python -m mailstore.reindex [-b BATCH_SIZE] [--all]
+
+Indexes the emails stored before the index existed; with --all every email is
+indexed again, e.g. after SEARCH_TEXT_MAX_CHARS or the text extraction changed.
+Safe to run while mail is being received and served; until an email is reached
+it is simply not found by GET /emails/search.
+"""
+
+import time
+import logging
+from optparse import OptionParser
+
+from dotenv import load_dotenv
+
+from . import get_storage
+
+
+def main():
+    parser = OptionParser(usage="usage: python -m mailstore.reindex [options]")
+    parser.add_option("-b", "--batch-size", dest="batch_size", type="int", default=500, help="emails per transaction")
+    parser.add_option("-a", "--all", dest="everything", action="store_true", default=False,
+                      help="index every email again, not only the missing ones")
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    load_dotenv()
+    storage = get_storage()
+
+    done = 0
+    last_id = 0
+    started = time.monotonic()
+    while True:
+        with storage.cursor() as cursor:
+            email_ids = storage.unindexed_email_ids(cursor, options.batch_size, last_id, options.everything)
+        if not email_ids:
+            break
+        storage.index_emails(email_ids)
+        done += len(email_ids)
+        last_id = email_ids[-1]
+        logging.info("Indexed %d emails (up to id %d), %.0f emails/s", done, last_id, done / (time.monotonic() - started))
+
+    logging.info("All emails are in the search index")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""The API representation of stored messages, computed once at ingest.
+
+GET /emails used to json.loads, escape and re-key every header dict and body on
+each read. The same transformation now runs when a message is stored and its
+result is kept as JSON text (emails.rendered_headers, email_parts.rendered_*),
+which the API splices into responses without parsing it again.
+
+Bump RENDER_VERSION whenever the output of these functions changes; rows with
+an older version are re-rendered on read and by `python -m mailstore.rerender`.
+"""
+
+import json, html, re, uuid
+
+RENDER_VERSION = 1
+
+
+def escape_json_special_characters(data):
+    """Escape special characters in JSON strings."""
+    if isinstance(data, str):
+        return data.replace('\\', '').replace('\n', ' ').replace('\t', ' ').replace('"', '')  # Remove \n, \t, ", and \
+    if isinstance(data, list):
+        return [escape_json_special_characters(item) for item in data]
+    if isinstance(data, dict):
+        return {key: escape_json_special_characters(value) for key, value in data.items()}
+    return data
+
+
+def decode_unicode_escape(data):
+    """Decode Unicode escape sequences in strings."""
+    if isinstance(data, str):
+        # Replace HTML entities and remove newlines
+        return html.unescape(data).replace('\n', '')
+    if isinstance(data, list):
+        return [decode_unicode_escape(item) for item in data]
+    if isinstance(data, dict):
+        return {key: decode_unicode_escape(value) for key, value in data.items()}
+    return data
+
+
+def replace_hyphens_in_keys(data):
+    """Recursively replace hyphens with underscores in JSON keys."""
+    if isinstance(data, dict):
+        new_data = {}
+        for key, value in data.items():
+            new_key = key.replace('-', '_')
+            new_data[new_key] = replace_hyphens_in_keys(value)
+        return new_data
+    elif isinstance(data, list):
+        return [replace_hyphens_in_keys(item) for item in data]
+    else:
+        return data
+
+
+def render_headers(headers):
+    """JSON text of the raw_headers object returned for an email."""
+    headers = escape_json_special_characters(headers)
+    headers['to'] = escape_json_special_characters(headers.get('to', ''))
+    return json.dumps(replace_hyphens_in_keys(headers))
+
+
+def render_part_headers(headers):
+    """JSON text of the headers object returned for a part."""
+    return json.dumps(replace_hyphens_in_keys(escape_json_special_characters(headers)))
+
+
+def render_part_content(content):
+    """JSON text of the content string returned for a part."""
+    return json.dumps(decode_unicode_escape(content))
+
+
+class RawJSON:
+    """Already serialized JSON to be emitted as is by dumps()."""
+
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+
+# Stands in for RawJSON values during json.dumps; unguessable so message content cannot forge it
+_RAW_MARKER = '__raw_json_%s_' % uuid.uuid4().hex
+_raw_placeholder_re = re.compile('"%s(\\d+)"' % _RAW_MARKER)
+
+
+def dumps(data, default=None, indent=None):
+    """json.dumps that splices RawJSON values in verbatim instead of encoding them as strings."""
+    raw = []
+
+    def encode(obj):
+        if isinstance(obj, RawJSON):
+            raw.append(obj.text)
+            return '%s%d' % (_RAW_MARKER, len(raw) - 1)
+        if default is None:
+            raise TypeError("Type not serializable")
+        return default(obj)
+
+    text = json.dumps(data, default=encode, indent=indent)
+    if raw:
+        text = _raw_placeholder_re.sub(lambda match: raw[int(match.group(1))], text)
+    return text
@@ -0,0 +1,173 @@
+"""Routing of the API's reads to read replicas of the primary database.
+
+DB_REPLICA_HOSTS (MySQL) or SQLITE_REPLICA_PATHS (SQLite) list the replicas.
+Ingest, deletes and every other write use the primary; ReadRouter.cursor()
+serves a read-only request from a replica only when it is known to hold what
+the request may ask for, and from the primary otherwise:
+
+- Every DB_REPLICA_CHECK_INTERVAL seconds each replica is checked. It is caught
+  up to the time of the last check at which it held the newest email id of the
+  primary, less the delay the server itself reports (Seconds_Behind_Master on
+  MySQL). A replica that fails the check or stops replicating, or is more than
+  DB_REPLICA_MAX_LAG seconds behind, gets no reads.
+- Reads about an address go to the primary from the moment it is written to
+  (mail stored for it, as notified by the ingest path, or deleted) until a
+  replica is caught up to DB_REPLICA_STICKY_SECONDS after that, so GET
+  /emails/wait and GET /emails see new mail as soon as they are told of it.
+- A read that gets no replica connection within DB_REPLICA_POOL_TIMEOUT
+  seconds goes to the primary.
+"""
+
+import os, threading, time
+import logging
+from contextlib import contextmanager
+
+from . import metrics
+from .base import PoolTimeout
+
+DB_REPLICA_MAX_LAG = float(os.getenv('DB_REPLICA_MAX_LAG', 5))
+DB_REPLICA_STICKY_SECONDS = float(os.getenv('DB_REPLICA_STICKY_SECONDS', 1))
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv('DB_REPLICA_CHECK_INTERVAL', 1))
+
+DB_READS = metrics.counter('email_db_reads_total',
+                           'API reads by the pool that served them and why (caught_up, lag, recent_write, busy, unavailable)',
+                           ['pool', 'reason'])
+DB_REPLICA_LAG_SECONDS = metrics.gauge('email_db_replica_lag_seconds',
+                                       'Seconds since the time each usable replica is caught up to', ['pool'])
+DB_REPLICA_UP = metrics.gauge('email_db_replica_up', 'Whether the last check of each replica succeeded', ['pool'])
+
+
+class ReadRouter:
+    """Hands out cursors for reads on a caught-up replica or the primary, see the module docstring."""
+
+    def __init__(self, storage, max_lag=DB_REPLICA_MAX_LAG, sticky=DB_REPLICA_STICKY_SECONDS,
+                 check_interval=DB_REPLICA_CHECK_INTERVAL):
+        self.storage = storage
+        self.max_lag = max_lag
+        self.sticky = sticky
+        self.check_interval = check_interval
+        self._caught_up = {pool.name: None for pool in storage.replicas}  # monotonic time, None while unusable
+        self._written = {}  # address -> monotonic time of its last write
+        self._lock = threading.Lock()
+        self._thread = None
+        DB_REPLICA_LAG_SECONDS.function = self._lags
+        DB_REPLICA_UP.function = lambda: {(name,): int(caught_up is not None)
+                                          for name, caught_up in self._caught_up.items()}
+
+    @property
+    def enabled(self):
+        return bool(self.storage.replicas)
+
+    def start(self):
+        """Check the replicas from a daemon thread; reads stay on the primary until a check succeeds."""
+        if self.enabled and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="replica-check", daemon=True)
+            self._thread.start()
+
+    def wrote(self, addresses):
+        """Route reads about these addresses to the primary until the replicas have the write."""
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for address in addresses:
+                self._written[address.lower()] = now
+
+    def lags(self):
+        """Seconds each replica is behind, None for the ones failing their checks."""
+        now = time.monotonic()
+        with self._lock:
+            return {name: None if caught_up is None else now - caught_up for name, caught_up in self._caught_up.items()}
+
+    def _lags(self):
+        return {(name,): lag for name, lag in self.lags().items() if lag is not None}
+
+    def _run(self):
+        while True:
+            try:
+                self.check()
+            except Exception:
+                # The primary is unreachable too; requests will report it
+                logging.exception("Checking the read replicas failed")
+            time.sleep(self.check_interval)
+
+    def check(self):
+        """Compare every replica with the primary once."""
+        started = time.monotonic()
+        with self.storage.cursor() as cursor:
+            newest = self.storage.newest_email_id(cursor)
+        for pool in self.storage.replicas:
+            try:
+                with self.storage.cursor(pool) as cursor:
+                    delay = self.storage.replication_delay(cursor)
+                    replica_newest = self.storage.newest_email_id(cursor)
+            except PoolTimeout:
+                # Busy serving reads; its state stands until the next check, and ages meanwhile
+                continue
+            except Exception as e:
+                logging.warning("Read replica %s is unavailable: %s", pool.name, e)
+                self._set_caught_up(pool.name, None)
+                continue
+            if delay is None:
+                logging.warning("Read replica %s is not replicating", pool.name)
+                self._set_caught_up(pool.name, None)
+            elif replica_newest >= newest:
+                self._set_caught_up(pool.name, started - delay)
+            # Otherwise it is still behind the newest email and stays caught up to an earlier check
+        self._forget_writes(started)
+
+    def _set_caught_up(self, name, caught_up):
+        with self._lock:
+            self._caught_up[name] = caught_up
+
+    def _forget_writes(self, now):
+        # Older writes are behind every replica allowed to serve reads anyway
+        horizon = now - self.max_lag - self.sticky
+        with self._lock:
+            for address in [address for address, written in self._written.items() if written < horizon]:
+                del self._written[address]
+
+    def _replica(self, addresses):
+        """(replica pool or None, reason) for a read about addresses."""
+        now = time.monotonic()
+        with self._lock:
+            written = max((self._written.get(address.lower(), 0) for address in addresses), default=0)
+            caught_up = dict(self._caught_up)
+        usable = [pool for pool in self.storage.replicas
+                  if caught_up[pool.name] is not None and now - caught_up[pool.name] <= self.max_lag]
+        if not usable:
+            return None, 'lag'
+        if written:
+            usable = [pool for pool in usable if caught_up[pool.name] >= written + self.sticky]
+            if not usable:
+                return None, 'recent_write'
+        return min(usable, key=lambda pool: pool.stats()['in_use']), 'caught_up'
+
+    def _connection(self, addresses):
+        if not self.enabled:
+            return self.storage.connection()
+        pool, reason = self._replica(addresses)
+        if pool is not None:
+            try:
+                conn = pool.connection()
+            except PoolTimeout:
+                reason = 'busy'
+            except Exception as e:
+                logging.warning("Read replica %s is unavailable: %s", pool.name, e)
+                self._set_caught_up(pool.name, None)
+                reason = 'unavailable'
+            else:
+                DB_READS.inc((pool.name, reason))
+                return conn
+        DB_READS.inc((self.storage.primary.name, reason))
+        return self.storage.connection()
+
+    @contextmanager
+    def cursor(self, addresses=()):
+        """Cursor for a read-only request about addresses (recipients, any if empty), given back when the block ends."""
+        conn = self._connection(addresses)
+        try:
+            with conn.cursor() as cursor:
+                yield cursor
+        finally:
+            conn.close()
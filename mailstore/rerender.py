@@ -0,0 +1,45 @@
+"""Backfill the rendered columns of emails stored before the current RENDER_VERSION.
+
+    python -m mailstore.rerender [-b BATCH_SIZE]
+
+Safe to run while mail is being received and served; GET /emails renders any
+row this has not reached yet on first read.
+"""
+
+import time
+import logging
+from optparse import OptionParser
+
+from dotenv import load_dotenv
+
+from . import get_storage
+from .render import RENDER_VERSION
+
+
+def main():
+    parser = OptionParser(usage="usage: python -m mailstore.rerender [options]")
+    parser.add_option("-b", "--batch-size", dest="batch_size", type="int", default=500, help="emails per transaction")
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    load_dotenv()
+    storage = get_storage()
+
+    done = 0
+    last_id = 0
+    started = time.monotonic()
+    while True:
+        with storage.cursor() as cursor:
+            email_ids = storage.stale_email_ids(cursor, options.batch_size, last_id)
+        if not email_ids:
+            break
+        storage.rerender(email_ids)
+        done += len(email_ids)
+        last_id = email_ids[-1]
+        logging.info("Rendered %d emails (up to id %d), %.0f emails/s", done, last_id, done / (time.monotonic() - started))
+
+    logging.info("All emails are rendered with version %d", RENDER_VERSION)
+
+
+if __name__ == "__main__":
+    main()
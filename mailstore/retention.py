@@ -0,0 +1,147 @@
+"""Retention policies and the chunked purge that enforces them.
+
+RETENTION_POLICIES gives the maximum age of stored mail per recipient domain,
+with * for all other mail, in days (d), hours (h) or minutes (m):
+
+    RETENTION_POLICIES=example.com=7d,test.example.org=12h,*=30d
+
+Age counts from when an email was stored (created_at). An email is covered by
+the policy of every listed domain one of its To, Cc or Bcc recipients is in, so
+the shortest of them applies; * covers the emails with no such recipient.
+
+The purge deletes PURGE_CHUNK_SIZE emails per transaction, found oldest first
+through idx_created_at, and pauses PURGE_CHUNK_PAUSE_MS between chunks, so it
+never holds long locks and lets ingest and reads through. The API runs it every
+RETENTION_INTERVAL seconds as a background job; to run it by hand:
+
+    python -m mailstore.retention [--dry-run]
+"""
+
+import os, re, time
+import logging
+from collections import Counter, namedtuple
+from datetime import timedelta
+from optparse import OptionParser
+
+from dotenv import load_dotenv
+
+from . import get_storage
+
+PURGE_CHUNK_SIZE = int(os.getenv('PURGE_CHUNK_SIZE', 500))
+PURGE_CHUNK_PAUSE_MS = int(os.getenv('PURGE_CHUNK_PAUSE_MS', 50))
+
+DEFAULT_DOMAIN = '*'
+UNITS = {'d': 'days', 'h': 'hours', 'm': 'minutes'}
+
+RetentionPolicy = namedtuple('RetentionPolicy', ['domain', 'max_age'])
+
+_policy_re = re.compile(r'^\s*([^=\s]+)\s*=\s*(\d+)\s*([dhm]?)\s*$')
+
+
+def parse_policies(text):
+    """RetentionPolicy list from a RETENTION_POLICIES value; raises ValueError if it is malformed."""
+    policies = []
+    for item in (text or '').split(','):
+        if not item.strip():
+            continue
+        match = _policy_re.match(item)
+        if match is None:
+            raise ValueError("RETENTION_POLICIES entries look like example.com=7d or *=30d, got %r" % item.strip())
+        domain, amount, unit = match.groups()
+        policies.append(RetentionPolicy(domain.lower().lstrip('@'), timedelta(**{UNITS[unit or 'd']: int(amount)})))
+    domains = [policy.domain for policy in policies]
+    if len(set(domains)) != len(domains):
+        raise ValueError("RETENTION_POLICIES lists a domain more than once: %s" % text)
+    return policies
+
+
+def policies_from_env():
+    return parse_policies(os.getenv('RETENTION_POLICIES', ''))
+
+
+def describe(policy):
+    """The policy as written in RETENTION_POLICIES, e.g. example.com=7d."""
+    minutes = int(policy.max_age.total_seconds()) // 60
+    for unit, size in (('d', 24 * 60), ('h', 60)):
+        if minutes % size == 0:
+            return "%s=%d%s" % (policy.domain, minutes // size, unit)
+    return "%s=%dm" % (policy.domain, minutes)
+
+
+def expired_chunks(storage, policies, chunk_size=PURGE_CHUNK_SIZE):
+    """Yield (policy, email ids) chunks of the emails past their retention, oldest first per policy.
+
+    Callers delete each chunk before asking for the next one.
+    """
+    listed = [policy.domain for policy in policies if policy.domain != DEFAULT_DOMAIN]
+    for policy in policies:
+        if policy.domain == DEFAULT_DOMAIN:
+            domain, exclude = None, listed
+        else:
+            domain, exclude = policy.domain, ()
+        with storage.cursor() as cursor:
+            cutoff = storage.current_time(cursor) - policy.max_age
+        position = None
+        while True:
+            with storage.cursor() as cursor:
+                rows = storage.expired_emails(cursor, cutoff, chunk_size, domain, exclude, position)
+            if not rows:
+                break
+            position = rows[-1]
+            yield policy, [email_id for _, email_id in rows]
+
+
+def purge(storage, policies, chunk_size=PURGE_CHUNK_SIZE, pause_ms=PURGE_CHUNK_PAUSE_MS, progress=None, stop=None):
+    """Delete the emails past their retention in chunks and return how many were deleted.
+
+    Calls progress(policy, deleted, addresses) after every chunk, and returns
+    early once stop() is true.
+    """
+    total = 0
+    for policy, email_ids in expired_chunks(storage, policies, chunk_size):
+        deleted, addresses = storage.delete_emails(email_ids)
+        total += deleted
+        if progress is not None:
+            progress(policy, deleted, addresses)
+        if stop is not None and stop():
+            break
+        time.sleep(pause_ms / 1000.0)
+    return total
+
+
+def main():
+    parser = OptionParser(usage="usage: python -m mailstore.retention [options]")
+    parser.add_option("-n", "--dry-run", dest="dry_run", action="store_true", default=False,
+                      help="count the expired emails without deleting them")
+    parser.add_option("-b", "--chunk-size", dest="chunk_size", type="int", default=PURGE_CHUNK_SIZE,
+                      help="emails per transaction")
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    load_dotenv()
+    policies = policies_from_env()
+    if not policies:
+        parser.error("RETENTION_POLICIES is not set")
+    storage = get_storage()
+
+    if options.dry_run:
+        counts = Counter()
+        for policy, email_ids in expired_chunks(storage, policies, options.chunk_size):
+            counts[policy.domain] += len(email_ids)
+        for policy in policies:
+            logging.info("%d emails expired by %s", counts[policy.domain], describe(policy))
+        return
+
+    started = time.monotonic()
+    done = [0]
+
+    def progress(policy, deleted, addresses):
+        done[0] += deleted
+        logging.info("Deleted %d emails (%s), %.0f emails/s", done[0], describe(policy), done[0] / (time.monotonic() - started))
+
+    purge(storage, policies, options.chunk_size, progress=progress)
+    logging.info("Purged %d emails", done[0])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Full-text search over the subject and a text-only rendition of the body.
+
+MailJson.parse extracts the text at ingest (extract_text), and the transaction
+that stores an email adds it to the email_search table: a FULLTEXT index on
+MySQL, an FTS5 table on SQLite. GET /emails/search ranks the matches with the
+engine's own relevance score.
+
+A query is a list of terms that must all match. A term is a word, a run of
+words joined by punctuation (abc-123, a.b@c.org) or a "quoted phrase", matched
+as a phrase; a trailing * matches words starting with the term. Emails stored
+before the index existed are added by
+
+    python -m mailstore.reindex [--all]
+"""
+
+import os, re, html
+from collections import namedtuple
+
+# Characters of body text indexed per email; the rest of a long message is not searchable
+SEARCH_TEXT_MAX_CHARS = int(os.getenv('SEARCH_TEXT_MAX_CHARS', 65536))
+SEARCH_MAX_TERMS = 16
+
+Term = namedtuple('Term', ['text', 'prefix'])
+
+_term_re = re.compile(r'"([^"]*)"(\*?)|([^\s"]+)')
+_word_re = re.compile(r'\w+')
+_invisible_html_re = re.compile(r'<(script|style|head)\b.*?</\1\s*>|<!--.*?-->', re.I | re.S)
+_tag_re = re.compile(r'<[^>]*>')
+
+
+def html_to_text(content):
+    """The visible text of an HTML body, tags and entities resolved."""
+    content = _invisible_html_re.sub(' ', content)
+    return html.unescape(_tag_re.sub(' ', content))
+
+
+def extract_text(parts):
+    """Text of a message's parts for the index: its text/plain parts, or the HTML ones stripped if it has none.
+
+    Whitespace is collapsed and the result cut at SEARCH_TEXT_MAX_CHARS.
+    """
+    plain = [part['content'] for part in parts if part['content_type'] == 'text/plain' and part['content']]
+    if plain:
+        text = ' '.join(plain)
+    else:
+        text = ' '.join(html_to_text(part['content']) for part in parts
+                        if part['content_type'] == 'text/html' and part['content'])
+    return ' '.join(text.split())[:SEARCH_TEXT_MAX_CHARS]
+
+
+def parse_query(text):
+    """Terms of a search query; raises ValueError if it has no word to look for or too many terms."""
+    terms = []
+    for phrase, phrase_prefix, word in _term_re.findall(text or ''):
+        prefix = bool(phrase_prefix) or word.endswith('*')
+        value = ' '.join((phrase if phrase or phrase_prefix else word.rstrip('*')).split())
+        if _word_re.search(value):
+            terms.append(Term(value, prefix))
+    if not terms:
+        raise ValueError("The query has no words to search for")
+    if len(terms) > SEARCH_MAX_TERMS:
+        raise ValueError("The query has more than %d terms" % SEARCH_MAX_TERMS)
+    return terms
+
+
+def fts5_query(terms):
+    """SQLite FTS5 MATCH expression requiring every term; quoting leaves tokenizing to FTS5."""
+    return ' '.join('"%s"%s' % (term.text, '*' if term.prefix else '') for term in terms)
+
+
+def boolean_query(terms):
+    """MySQL boolean mode expression requiring every term.
+
+    MySQL only takes a * after a bare word, so a prefix phrase is matched as a plain phrase.
+    """
+    expression = []
+    for term in terms:
+        if term.prefix and _word_re.fullmatch(term.text):
+            expression.append('+%s*' % term.text)
+        else:
+            expression.append('+"%s"' % term.text)
+    return ' '.join(expression)
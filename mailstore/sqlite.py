@@ -0,0 +1,367 @@
+"""Embedded SQLite backend, for CI runners and benchmarks without a MySQL server.
+
+The database runs in WAL mode so API reads are not blocked by ingest writes.
+The schema is created and upgraded on first use, tracked by PRAGMA user_version.
+SQLITE_REPLICA_PATHS lists copies of the database opened read-only as replicas,
+to try out replica routing (mailstore/replication.py) on one host.
+"""
+
+import os, hashlib, queue, sqlite3, time
+from datetime import datetime
+from functools import lru_cache
+
+from . import metrics
+from .base import Storage, Pool, pool_timeout, setting_list
+from .search import fts5_query
+
+# One entry per schema version; never edit an entry once released, append a new one
+MIGRATIONS = [
+    """
+    CREATE TABLE emails (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        received_time TIMESTAMP,
+        subject TEXT,
+        from_email TEXT,
+        from_name TEXT,
+        reply_to_email TEXT,
+        reply_to_name TEXT,
+        to_email TEXT COLLATE NOCASE,
+        to_name TEXT,
+        cc_email TEXT,
+        cc_name TEXT,
+        raw_headers TEXT,
+        encoding TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX idx_to_email_received ON emails (to_email, received_time, id);
+
+    CREATE TABLE email_attachments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        email_id INTEGER REFERENCES emails(id) ON DELETE CASCADE,
+        filename TEXT,
+        content_type TEXT,
+        content BLOB
+    );
+    CREATE INDEX idx_attachments_email_id ON email_attachments (email_id);
+
+    CREATE TABLE email_parts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        email_id INTEGER REFERENCES emails(id) ON DELETE CASCADE,
+        headers TEXT,
+        content_type TEXT,
+        content TEXT
+    );
+    CREATE INDEX idx_parts_email_id ON email_parts (email_id);
+    """,
+    """
+    CREATE TABLE email_recipients (
+        email_id INTEGER NOT NULL REFERENCES emails(id) ON DELETE CASCADE,
+        address TEXT NOT NULL,
+        role TEXT NOT NULL,
+        received_time TIMESTAMP,
+        PRIMARY KEY (email_id, address, role)
+    );
+    CREATE INDEX idx_recipients_address ON email_recipients (address, received_time, email_id, role);
+
+    INSERT OR IGNORE INTO email_recipients (email_id, address, role, received_time)
+    SELECT id, LOWER(to_email), 'to', received_time FROM emails WHERE to_email <> ''
+    UNION ALL
+    SELECT id, LOWER(cc_email), 'cc', received_time FROM emails WHERE cc_email <> ''
+    UNION ALL
+    SELECT id, LOWER(reply_to_email), 'reply_to', received_time FROM emails WHERE reply_to_email <> '';
+    """,
+    """
+    CREATE TABLE attachment_blobs (
+        digest TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        refcount INTEGER NOT NULL,
+        content BLOB
+    );
+    INSERT INTO attachment_blobs (digest, size, refcount, content)
+    SELECT sha256(COALESCE(content, X'')), LENGTH(COALESCE(content, X'')), COUNT(*), COALESCE(content, X'')
+    FROM email_attachments GROUP BY sha256(COALESCE(content, X''));
+
+    CREATE TABLE email_attachments_v3 (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        email_id INTEGER REFERENCES emails(id) ON DELETE CASCADE,
+        filename TEXT,
+        content_type TEXT,
+        digest TEXT,
+        size INTEGER
+    );
+    INSERT INTO email_attachments_v3 (id, email_id, filename, content_type, digest, size)
+    SELECT id, email_id, filename, content_type, sha256(COALESCE(content, X'')), LENGTH(COALESCE(content, X''))
+    FROM email_attachments;
+    DROP TABLE email_attachments;
+    ALTER TABLE email_attachments_v3 RENAME TO email_attachments;
+    CREATE INDEX idx_attachments_email_id ON email_attachments (email_id);
+    CREATE INDEX idx_attachments_digest ON email_attachments (digest);
+    """,
+    """
+    ALTER TABLE emails ADD COLUMN rendered_headers TEXT;
+    ALTER TABLE emails ADD COLUMN render_version INTEGER;
+    ALTER TABLE email_parts ADD COLUMN rendered_headers TEXT;
+    ALTER TABLE email_parts ADD COLUMN rendered_content TEXT;
+    """,
+    """
+    ALTER TABLE emails ADD COLUMN raw_headers_codec INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE emails ADD COLUMN rendered_headers_codec INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE email_parts ADD COLUMN content_codec INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE email_parts ADD COLUMN rendered_content_codec INTEGER NOT NULL DEFAULT 0;
+    """,
+    """
+    ALTER TABLE emails ADD COLUMN idempotency_key TEXT;
+    CREATE UNIQUE INDEX idx_idempotency_key ON emails (idempotency_key);
+    """,
+    """
+    CREATE INDEX idx_created_at ON emails (created_at, id);
+    """,
+    """
+    CREATE TABLE stats_counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    );
+    INSERT INTO stats_counters (name, value)
+    SELECT 'emails', COUNT(*) FROM emails
+    UNION ALL SELECT 'part_bytes', COALESCE(SUM(LENGTH(CAST(content AS BLOB))), 0) FROM email_parts
+    UNION ALL SELECT 'attachment_bytes', COALESCE(SUM(size), 0) FROM email_attachments
+    UNION ALL SELECT 'blob_bytes', COALESCE(SUM(size), 0) FROM attachment_blobs;
+
+    CREATE TABLE recipient_stats (
+        address TEXT PRIMARY KEY,
+        emails INTEGER NOT NULL
+    );
+    CREATE INDEX idx_recipient_stats_emails ON recipient_stats (emails);
+    INSERT INTO recipient_stats (address, emails)
+    SELECT address, COUNT(DISTINCT email_id) FROM email_recipients
+    WHERE role IN ('to', 'cc', 'bcc') GROUP BY address;
+
+    CREATE TABLE domain_stats (
+        domain TEXT PRIMARY KEY,
+        emails INTEGER NOT NULL
+    );
+    CREATE INDEX idx_domain_stats_emails ON domain_stats (emails);
+    INSERT INTO domain_stats (domain, emails)
+    SELECT substr(address, instr(address, '@') + 1) AS domain, COUNT(DISTINCT email_id) FROM email_recipients
+    WHERE role IN ('to', 'cc', 'bcc') GROUP BY domain;
+    """,
+    """
+    CREATE VIRTUAL TABLE email_search USING fts5 (subject, body, tokenize = 'unicode61 remove_diacritics 2');
+    """,
+]
+
+
+# Timestamps are stored as 'YYYY-MM-DD HH:MM:SS' text, like CURRENT_TIMESTAMP, so they compare
+# correctly in keyset conditions; registered explicitly as the defaults are deprecated in 3.12
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+sqlite3.register_converter('TIMESTAMP', lambda value: datetime.fromisoformat(value.decode()))
+
+
+@lru_cache(maxsize=1024)
+def _translate(sql):
+    """Turn the %s placeholders used throughout the storage layer into sqlite's ?."""
+    return sql.replace('%s', '?')
+
+
+def _statements(script):
+    """Split a migration script into statements, keeping trigger bodies whole."""
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement.strip()
+            statement = ''
+
+
+def _sha256(content):
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+
+def _dict_factory(cursor, row):
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+class SQLiteCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._cursor.close()
+
+    def execute(self, sql, params=()):
+        started = time.perf_counter()
+        self._cursor.execute(_translate(sql), params or ())
+        metrics.record_query(time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_params):
+        started = time.perf_counter()
+        self._cursor.executemany(_translate(sql), seq_of_params)
+        metrics.record_query(time.perf_counter() - started)
+
+    # sqlite3 steps through the result as rows are fetched, so that is database time too
+    def fetchone(self):
+        started = time.perf_counter()
+        row = self._cursor.fetchone()
+        metrics.record_fetch(time.perf_counter() - started)
+        return row
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = self._cursor.fetchall()
+        metrics.record_fetch(time.perf_counter() - started)
+        return rows
+
+    def fetchmany(self, size):
+        started = time.perf_counter()
+        rows = self._cursor.fetchmany(size)
+        metrics.record_fetch(time.perf_counter() - started)
+        return rows
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+
+class SQLiteConnection:
+    """A pooled sqlite3 connection; close() hands it back to the pool."""
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+
+    def cursor(self):
+        return SQLiteCursor(self._raw.cursor())
+
+    def begin(self):
+        # Take the write lock up front instead of upgrading a read lock mid-transaction
+        self._raw.execute("BEGIN IMMEDIATE")
+
+    def commit(self):
+        if self._raw.in_transaction:
+            self._raw.commit()
+
+    def rollback(self):
+        if self._raw.in_transaction:
+            self._raw.rollback()
+
+    def close(self):
+        if self._raw is not None:
+            self.rollback()
+            self._pool._release(self._raw)
+            self._raw = None
+
+
+class SQLitePool(Pool):
+    """sqlite3 connections to one database file, the most recently used first; query_only for replicas."""
+
+    def __init__(self, name, path, maxconnections, timeout=None, query_only=False):
+        super().__init__(name, maxconnections, timeout)
+        self.path = path
+        self.query_only = query_only
+        self._idle_connections = queue.LifoQueue()
+
+    def open(self):
+        # isolation_level=None: autocommit unless begin() is called, like the MySQL pool
+        raw = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False,
+                              detect_types=sqlite3.PARSE_DECLTYPES)
+        raw.row_factory = _dict_factory
+        # Used by migrations, SQLite has no built-in digest function
+        raw.create_function('sha256', 1, _sha256, deterministic=True)
+        if self.query_only:
+            raw.execute("PRAGMA query_only=ON")
+        else:
+            raw.execute("PRAGMA journal_mode=WAL")
+            raw.execute("PRAGMA synchronous=NORMAL")
+        raw.execute("PRAGMA foreign_keys=ON")
+        return raw
+
+    def _connect(self):
+        try:
+            raw = self._idle_connections.get_nowait()
+        except queue.Empty:
+            raw = self.open()
+        return SQLiteConnection(self, raw)
+
+    def _release(self, raw):
+        self._idle_connections.put(raw)
+
+    def _idle(self):
+        return self._idle_connections.qsize()
+
+
+class SQLiteStorage(Storage):
+    name = 'sqlite'
+    no_limit = '-1'
+    sql_blob_upsert = """
+    INSERT INTO attachment_blobs (digest, size, refcount, content) VALUES (%s, %s, %s, %s)
+    ON CONFLICT (digest) DO UPDATE SET refcount = refcount + excluded.refcount
+    """
+    sql_recipient_stats_upsert = """
+    INSERT INTO recipient_stats (address, emails) VALUES (%s, %s)
+    ON CONFLICT (address) DO UPDATE SET emails = emails + excluded.emails
+    """
+    sql_domain_stats_upsert = """
+    INSERT INTO domain_stats (domain, emails) VALUES (%s, %s)
+    ON CONFLICT (domain) DO UPDATE SET emails = emails + excluded.emails
+    """
+    # LENGTH() of text counts characters
+    byte_length = "LENGTH(CAST({} AS BLOB))"
+    # email_search is an FTS5 table, keyed by its rowid
+    search_id = 'rowid'
+
+    def __init__(self, path=None, maxconnections=None, compressor=None):
+        super().__init__(compressor)
+        self.path = path or os.getenv('SQLITE_PATH', '/var/lib/mailstore/emails.db')
+        maxconnections = maxconnections or int(os.getenv('DB_MAX_CONNECTIONS', 5))
+        self.primary = SQLitePool('primary', self.path, maxconnections, pool_timeout('DB_POOL_TIMEOUT'))
+        replica_connections = int(os.getenv('DB_REPLICA_MAX_CONNECTIONS', maxconnections))
+        self.replicas = [SQLitePool('replica:' + replica_path, replica_path, replica_connections,
+                                    pool_timeout('DB_REPLICA_POOL_TIMEOUT', 0.5), query_only=True)
+                         for replica_path in setting_list('SQLITE_REPLICA_PATHS')]
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        raw = self.primary.open()
+        try:
+            self._migrate(raw)
+        finally:
+            raw.close()
+
+    def _migrate(self, raw):
+        # The write lock makes concurrent first starts (ingest and API) wait for each other
+        raw.execute("BEGIN IMMEDIATE")
+        try:
+            version = raw.execute("PRAGMA user_version").fetchone()['user_version']
+            for number, script in enumerate(MIGRATIONS[version:], start=version + 1):
+                for statement in _statements(script):
+                    raw.execute(statement)
+                raw.execute("PRAGMA user_version = %d" % number)
+            raw.execute("COMMIT")
+        except Exception:
+            raw.execute("ROLLBACK")
+            raise
+
+    def _first_insert_id(self, cursor, count):
+        # lastrowid is the last row; nothing else can insert inside our write transaction
+        return cursor.lastrowid - count + 1
+
+    def _search_match(self, terms):
+        # bm25() is lower for better matches; a subject hit weighs as much as five in the body
+        return "email_search MATCH %s", "-bm25(email_search, 5.0, 1.0)", [fts5_query(terms)], []
+
+    def _estimate_count(self, cursor, address, roles):
+        # SQLite keeps no per-value statistics; counting the index range is cheap enough
+        return self.count_emails(cursor, address, 'exact', roles)
+
+    def _database_size_mb(self, cursor):
+        cursor.execute("SELECT page_count * page_size AS size FROM pragma_page_count(), pragma_page_size()")
+        return round(cursor.fetchone()['size'] / 1024 / 1024, 2)
@@ -0,0 +1,7 @@
+-- Composite index for keyset pagination of GET /emails by (received_time, id) per recipient.
+-- Replaces idx_to_email, which is a prefix of the new index.
+USE emails;
+
+ALTER TABLE emails
+    ADD INDEX idx_to_email_received (to_email, received_time, id),
+    DROP INDEX idx_to_email;
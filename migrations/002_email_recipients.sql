@@ -0,0 +1,21 @@
+-- One row per (email, address, role) so GET /emails finds a message by any of its
+-- To, Cc, Bcc/envelope or Reply-To recipients. Addresses are stored lowercased.
+-- Existing emails are backfilled from the first To, Cc and Reply-To they kept.
+USE emails;
+
+CREATE TABLE email_recipients (
+    email_id INT NOT NULL,
+    address VARCHAR(255) NOT NULL,
+    role VARCHAR(16) NOT NULL,
+    received_time DATETIME,
+    PRIMARY KEY (email_id, address, role),
+    INDEX idx_recipients_address (address, received_time, email_id),
+    FOREIGN KEY (email_id) REFERENCES emails(id) ON DELETE CASCADE
+);
+
+INSERT IGNORE INTO email_recipients (email_id, address, role, received_time)
+SELECT id, LOWER(to_email), 'to', received_time FROM emails WHERE to_email <> ''
+UNION ALL
+SELECT id, LOWER(cc_email), 'cc', received_time FROM emails WHERE cc_email <> ''
+UNION ALL
+SELECT id, LOWER(reply_to_email), 'reply_to', received_time FROM emails WHERE reply_to_email <> '';
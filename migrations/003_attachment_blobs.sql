@@ -0,0 +1,25 @@
+-- Move attachment bytes out of email_attachments into attachment_blobs, one row per
+-- SHA-256 digest with a count of the attachments referencing it.
+USE emails;
+
+CREATE TABLE attachment_blobs (
+    digest CHAR(64) PRIMARY KEY,
+    size BIGINT NOT NULL,
+    refcount INT NOT NULL,
+    content LONGBLOB
+);
+
+ALTER TABLE email_attachments
+    ADD COLUMN digest CHAR(64),
+    ADD COLUMN size BIGINT,
+    ADD INDEX idx_attachments_digest (digest);
+
+UPDATE email_attachments
+SET digest = SHA2(COALESCE(content, ''), 256), size = LENGTH(COALESCE(content, ''));
+
+INSERT INTO attachment_blobs (digest, size, refcount, content)
+SELECT digest, MAX(size), COUNT(*), ANY_VALUE(COALESCE(content, ''))
+FROM email_attachments
+GROUP BY digest;
+
+ALTER TABLE email_attachments DROP COLUMN content;
@@ -0,0 +1,12 @@
+-- Columns holding the API representation computed at ingest (mailstore/render.py).
+-- Existing rows are rendered on first read; fill them all ahead of time with
+--   docker exec flask_app python3 -m mailstore.rerender
+USE emails;
+
+ALTER TABLE emails
+    ADD COLUMN rendered_headers MEDIUMTEXT,
+    ADD COLUMN render_version INT;
+
+ALTER TABLE email_parts
+    ADD COLUMN rendered_headers MEDIUMTEXT,
+    ADD COLUMN rendered_content LONGTEXT;
@@ -0,0 +1,16 @@
+-- Let large text columns hold compressed values (mailstore/codec.py). The columns become
+-- binary so they can store zlib/zstd output; existing text keeps its bytes and gets codec 0.
+-- Compress existing rows afterwards with: python3 -m mailstore.recompress
+USE emails;
+
+ALTER TABLE emails
+    MODIFY raw_headers MEDIUMBLOB,
+    ADD COLUMN raw_headers_codec TINYINT NOT NULL DEFAULT 0 AFTER raw_headers,
+    MODIFY rendered_headers MEDIUMBLOB,
+    ADD COLUMN rendered_headers_codec TINYINT NOT NULL DEFAULT 0 AFTER rendered_headers;
+
+ALTER TABLE email_parts
+    MODIFY content LONGBLOB,
+    ADD COLUMN content_codec TINYINT NOT NULL DEFAULT 0 AFTER content,
+    MODIFY rendered_content LONGBLOB,
+    ADD COLUMN rendered_content_codec TINYINT NOT NULL DEFAULT 0 AFTER rendered_content;
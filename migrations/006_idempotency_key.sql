@@ -0,0 +1,8 @@
+-- Deduplicate messages replayed from the ingest spool (postfix/spool.py). The key is a hash
+-- of the Message-ID, the envelope recipients and the raw message; rows stored before this
+-- migration keep NULL, which the unique index allows any number of times.
+USE emails;
+
+ALTER TABLE emails
+    ADD COLUMN idempotency_key CHAR(64),
+    ADD UNIQUE KEY idx_idempotency_key (idempotency_key);
@@ -0,0 +1,6 @@
+-- Lets the retention purge (mailstore/retention.py) find expired emails oldest first
+-- without scanning the table.
+USE emails;
+
+ALTER TABLE emails
+    ADD INDEX idx_created_at (created_at, id);
@@ -0,0 +1,32 @@
+-- Counters behind GET /emails/stats, maintained by every insert and delete from now on.
+-- The backfill scans the tables once; stop ingest and the API while it runs so that no
+-- insert or delete is counted twice or missed.
+USE emails;
+
+CREATE TABLE stats_counters (
+    name VARCHAR(64) PRIMARY KEY,
+    value BIGINT NOT NULL DEFAULT 0
+);
+INSERT INTO stats_counters (name, value)
+SELECT 'emails', COUNT(*) FROM emails
+UNION ALL SELECT 'part_bytes', COALESCE(SUM(LENGTH(content)), 0) FROM email_parts
+UNION ALL SELECT 'attachment_bytes', COALESCE(SUM(size), 0) FROM email_attachments
+UNION ALL SELECT 'blob_bytes', COALESCE(SUM(size), 0) FROM attachment_blobs;
+
+CREATE TABLE recipient_stats (
+    address VARCHAR(255) PRIMARY KEY,
+    emails BIGINT NOT NULL,
+    INDEX idx_recipient_stats_emails (emails)
+);
+INSERT INTO recipient_stats (address, emails)
+SELECT address, COUNT(DISTINCT email_id) FROM email_recipients
+WHERE role IN ('to', 'cc', 'bcc') GROUP BY address;
+
+CREATE TABLE domain_stats (
+    domain VARCHAR(255) PRIMARY KEY,
+    emails BIGINT NOT NULL,
+    INDEX idx_domain_stats_emails (emails)
+);
+INSERT INTO domain_stats (domain, emails)
+SELECT SUBSTRING_INDEX(address, '@', -1) AS domain, COUNT(DISTINCT email_id) FROM email_recipients
+WHERE role IN ('to', 'cc', 'bcc') GROUP BY domain;
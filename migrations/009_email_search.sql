@@ -0,0 +1,11 @@
+-- Full-text index behind GET /emails/search (mailstore/search.py), filled by every insert from
+-- now on. The body text is extracted from the parts in Python, so emails stored before this
+-- migration are indexed by `python -m mailstore.reindex`, which can run while mail flows.
+USE emails;
+
+CREATE TABLE email_search (
+    email_id INT PRIMARY KEY,
+    subject VARCHAR(255),
+    body MEDIUMTEXT,
+    FULLTEXT INDEX ft_email_search (subject, body)
+);
@@ -0,0 +1,121 @@
+"""Group-commit writer for parsed messages.
+
+Delivery threads hand parsed messages to a single writer thread, which stores
+them with multi-row INSERTs in one transaction. A batch is flushed once it
+holds INGEST_BATCH_SIZE messages or its oldest message has waited
+INGEST_BATCH_MAX_LATENCY_MS, whichever comes first.
+"""
+
+import os, queue, threading, time
+import logging
+
+from email_processor import insert_email_batch, insert_email_data
+
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', 50))
+INGEST_BATCH_MAX_LATENCY_MS = int(os.getenv('INGEST_BATCH_MAX_LATENCY_MS', 20))
+# Seconds a delivery waits for its batch before it is answered with a temporary failure
+INGEST_BATCH_WAIT_TIMEOUT = float(os.getenv('INGEST_BATCH_WAIT_TIMEOUT', 60))
+
+
+class PendingInsert:
+    """A message waiting for its batch to be committed."""
+
+    def __init__(self, data):
+        self.data = data
+        self.email_id = None
+        self.submitted = time.monotonic()
+        self._done = threading.Event()
+
+    def resolve(self, email_id):
+        self.email_id = email_id
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """Block until the batch is flushed; returns the email id, or None on failure or timeout."""
+        if not self._done.wait(timeout):
+            logging.error("Batch insert did not finish within %s seconds", timeout)
+        return self.email_id
+
+
+class BatchWriter:
+    def __init__(self, batch_size=INGEST_BATCH_SIZE, max_latency_ms=INGEST_BATCH_MAX_LATENCY_MS,
+                 wait_timeout=INGEST_BATCH_WAIT_TIMEOUT):
+        self.batch_size = max(1, batch_size)
+        self.max_latency = max_latency_ms / 1000.0
+        self.wait_timeout = wait_timeout
+        self._queue = queue.Queue()
+        self._closed = False
+        # Orders submits against close(), so nothing is queued behind the stop marker
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="batch-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, data):
+        """Queue a message for the next batch; raises RuntimeError once the writer is closed."""
+        pending = PendingInsert(data)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("BatchWriter is closed")
+            self._queue.put(pending)
+        return pending
+
+    def insert(self, data):
+        """Store one message through the batch and wait for its own result.
+
+        Returns None if it failed or its batch took longer than wait_timeout;
+        a retried delivery is deduplicated by its idempotency key should the
+        batch commit after all. Once the writer is closed, deliveries still in
+        flight are stored on their own.
+        """
+        try:
+            pending = self.submit(data)
+        except RuntimeError:
+            return insert_email_data(data)
+        return pending.wait(self.wait_timeout)
+
+    def close(self):
+        """Flush whatever is queued and stop the writer thread."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first.submitted + self.max_latency
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # Keep the stop marker for the next round so this batch still flushes
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            self._flush(batch)
+
+    def _flush(self, batch):
+        try:
+            email_ids = insert_email_batch([pending.data for pending in batch])
+        except Exception as e:
+            # One bad message must not fail its neighbours: retry them one by one
+            logging.error("Batch insert of %d emails failed, retrying individually: %s", len(batch), e)
+            for pending in batch:
+                pending.resolve(insert_email_data(pending.data))
+            return
+        for pending, email_id in zip(batch, email_ids):
+            pending.resolve(email_id)
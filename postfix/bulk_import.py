@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+
+"""Bulk import of mbox files and Maildir directories.
+
+Messages are parsed with MailJson in a pool of worker processes and stored
+with multi-row INSERTs through insert_email_batch, so seeding a database or
+migrating an old mailbox does not fork email_processor.py once per message.
+
+    python bulk_import.py [options] archive.mbox ~/Maildir ...
+
+At most --window messages are read ahead of the database, which bounds memory
+on archives of any size. Progress is saved to --state after every batch; run
+the same command again after an interruption to continue where it stopped.
+Messages carry the idempotency key of the ingest path (spool.py), so the few
+committed after the last saved position are not stored twice.
+"""
+
+import os, sys, json, time, re
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from optparse import OptionParser
+
+from email_processor import MailJson, insert_email_batch, insert_email_data
+from spool import idempotency_key
+
+mbox_quoted_from_re = re.compile(rb"^>+From ")
+
+
+def read_mbox(path, position=None):
+    """Yield (position after the message, raw message) for the messages of an mbox file from position on.
+
+    The "From " separator lines are dropped and >From quoting (mboxrd) is undone.
+    """
+    offset = position or 0
+    with open(path, "rb") as f:
+        f.seek(offset)
+        lines = None  # the current message, None before the first separator
+        previous_blank = True
+        for line in f:
+            if line.startswith(b"From ") and previous_blank:
+                if lines is not None:
+                    yield offset, _mbox_message(lines)
+                lines = []
+            elif lines is not None:
+                lines.append(line[1:] if mbox_quoted_from_re.match(line) else line)
+            previous_blank = not line.strip()
+            offset += len(line)
+        if lines is not None:
+            yield offset, _mbox_message(lines)
+
+
+def _mbox_message(lines):
+    # The blank line before the next separator belongs to the mbox, not the message
+    if lines and not lines[-1].strip():
+        lines.pop()
+    return b"".join(lines)
+
+
+def read_maildir(path, position=None):
+    """Yield (file name, raw message) for the messages in cur/ and new/ of a Maildir, in name order after position."""
+    names = []
+    for subdir in ("cur", "new"):
+        for name in os.listdir(os.path.join(path, subdir)):
+            if not name.startswith("."):
+                names.append((name, subdir))
+    for name, subdir in sorted(names):
+        if position is not None and name <= position:
+            continue
+        try:
+            with open(os.path.join(path, subdir, name), "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            # Moved from new/ to cur/ by a mail client since the listing
+            continue
+        yield name, raw
+
+
+def read_source(path, position=None):
+    if os.path.isdir(path):
+        if not os.path.isdir(os.path.join(path, "cur")):
+            raise ValueError("%s is a directory but not a Maildir (no cur/)" % path)
+        return read_maildir(path, position)
+    return read_mbox(path, position)
+
+
+def parse_chunk(chunk, recipients):
+    """Parse a list of (sequence number, raw message) in a worker process.
+
+    Returns (sequence number, size, parsed message or None, error) for each.
+    """
+    results = []
+    for seq, raw in chunk:
+        try:
+            data = MailJson(raw).parse()
+            if recipients:
+                data["envelope-to"] = recipients
+            data["idempotency-key"] = idempotency_key(data["headers"].get("message-id"), recipients, raw)
+            results.append((seq, len(raw), data, None))
+        except Exception as e:
+            results.append((seq, len(raw), None, "%s: %s" % (type(e).__name__, e)))
+    return results
+
+
+class ImportState:
+    """Where to resume: the position in the source after which nothing is left unstored."""
+
+    def __init__(self, path, sources):
+        self.path = path
+        self.sources = sources
+        self.source = 0
+        self.position = None
+        self.imported = 0
+        self.failed = 0
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return False
+        if state["sources"] != self.sources:
+            raise ValueError("%s belongs to an import of %s; use --restart to start over"
+                             % (self.path, ", ".join(state["sources"])))
+        self.source = state["source"]
+        self.position = state["position"]
+        self.imported = state["imported"]
+        self.failed = state["failed"]
+        return True
+
+    def save(self):
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"sources": self.sources, "source": self.source, "position": self.position,
+                       "imported": self.imported, "failed": self.failed}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + ".tmp", self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class BulkImporter:
+    def __init__(self, state, options):
+        self.state = state
+        self.options = options
+        self.recipients = options.recipients or []
+        self._positions = {}   # sequence number -> (source, position after it)
+        self._done = set()     # sequence numbers stored or given up on, beyond _next
+        self._next = 0         # lowest sequence number not stored yet
+        self._batch = []
+        self.parsed = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+        self._reported = self.started
+
+    def messages(self):
+        """(sequence number, raw message) for every message left to import."""
+        seq = 0
+        for index in range(self.state.source, len(self.state.sources)):
+            path = self.state.sources[index]
+            position = self.state.position if index == self.state.source else None
+            for position, raw in read_source(path, position):
+                self._positions[seq] = (index, position)
+                yield seq, raw
+                seq += 1
+
+    def chunks(self):
+        chunk = []
+        for message in self.messages():
+            chunk.append(message)
+            if len(chunk) == self.options.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def run(self):
+        pending = deque()
+        max_pending = max(1, self.options.window // self.options.chunk_size)
+        with ProcessPoolExecutor(max_workers=self.options.jobs) as executor:
+            try:
+                for chunk in self.chunks():
+                    while len(pending) >= max_pending:
+                        self._collect(pending)
+                    pending.append(executor.submit(parse_chunk, chunk, self.recipients))
+                while pending:
+                    self._collect(pending)
+                self._write()
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+        self.report(final=True)
+
+    def _collect(self, pending):
+        """Hand parsed chunks to the writer: the oldest one if --ordered, otherwise whichever are done."""
+        if self.options.ordered:
+            done = [pending.popleft()]
+        else:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.remove(future)
+        for future in done:
+            for seq, size, data, error in future.result():
+                self.parsed += 1
+                self.bytes += size
+                if data is None:
+                    self._fail(seq, "cannot be parsed: %s" % error)
+                    continue
+                self._batch.append((seq, data))
+                if len(self._batch) >= self.options.batch_size:
+                    self._write()
+        if time.monotonic() - self._reported >= self.options.progress_interval:
+            self.report()
+
+    def _write(self):
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+        try:
+            insert_email_batch([data for _, data in batch])
+            stored = [seq for seq, _ in batch]
+        except Exception as e:
+            # One bad message must not fail its neighbours: retry them one by one
+            logging.error("Batch insert of %d emails failed, retrying individually: %s", len(batch), e)
+            stored = []
+            for seq, data in batch:
+                if insert_email_data(data) is not None:
+                    stored.append(seq)
+                else:
+                    self._fail(seq, "could not be stored, see the email_processor log")
+        self.state.imported += len(stored)
+        self._done.update(stored)
+        self._advance()
+
+    def _fail(self, seq, reason):
+        index, position = self._positions[seq]
+        print("%s at %s %s" % (self.state.sources[index], position, reason), file=sys.stderr)
+        self.state.failed += 1
+        self._done.add(seq)
+
+    def _advance(self):
+        """Move the saved position past every message up to the first one not done yet."""
+        moved = False
+        while self._next in self._done:
+            self._done.discard(self._next)
+            self.state.source, self.state.position = self._positions.pop(self._next)
+            self._next += 1
+            moved = True
+        if moved:
+            self.state.save()
+
+    def report(self, final=False):
+        self._reported = time.monotonic()
+        elapsed = max(self._reported - self.started, 1e-9)
+        print("%s%d messages parsed, %d imported in total, %d failed; %.0f msg/s, %.1f MB/s"
+              % ("Done: " if final else "", self.parsed, self.state.imported, self.state.failed,
+                 self.parsed / elapsed, self.bytes / elapsed / 1024 / 1024), flush=True)
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] MBOX_OR_MAILDIR...")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=os.cpu_count(), help="parser processes")
+    parser.add_option("-b", "--batch-size", dest="batch_size", type="int", default=int(os.getenv('INGEST_BATCH_SIZE', 50)),
+                      help="messages per insert transaction")
+    parser.add_option("-c", "--chunk-size", dest="chunk_size", type="int", default=20, help="messages per parser task")
+    parser.add_option("-w", "--window", dest="window", type="int", default=2000,
+                      help="messages read ahead of the database at most")
+    parser.add_option("-o", "--ordered", dest="ordered", action="store_true", default=False,
+                      help="store messages in input order, at some cost in throughput")
+    parser.add_option("-r", "--recipient", dest="recipients", action="append", metavar="ADDRESS",
+                      help="envelope recipient of every message, may be repeated")
+    parser.add_option("-s", "--state", dest="state", default="bulk_import.state", help="progress file to resume from")
+    parser.add_option("--restart", dest="restart", action="store_true", default=False,
+                      help="ignore the progress file and start from the beginning")
+    parser.add_option("-p", "--progress", dest="progress_interval", type="float", default=5,
+                      help="seconds between progress reports")
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.error("no mbox file or Maildir given")
+
+    state = ImportState(options.state, [os.path.abspath(path) for path in args])
+    if not options.restart and state.load():
+        print("Resuming %s after %s (%d imported so far)"
+              % (state.sources[state.source], state.position, state.imported), flush=True)
+
+    importer = BulkImporter(state, options)
+    try:
+        importer.run()
+    except KeyboardInterrupt:
+        importer.report()
+        print("Interrupted; run the same command again to resume from %s" % options.state, file=sys.stderr)
+        sys.exit(1)
+    state.remove()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,39 @@
 #!/usr/bin/env python
 
-import sys, urllib.request, email, re, csv, base64, json, pprint, os
-import pymysql
-from dbutils.pooled_db import PooledDB
+import sys, urllib.request, email, email.parser, re, csv, base64, json, pprint, os, time, string
+from functools import lru_cache
 from optparse import OptionParser
 from io import StringIO
 from datetime import datetime
 from dotenv import load_dotenv
 import logging
+from notify import notify_stored
+from spool import idempotency_key, spool_message
+
+# mailstore sits next to this file in the container and at the repository root in a checkout
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from mailstore import get_storage, recipient_addresses, metrics
+from mailstore.search import extract_text
 
 VERSION = "1.3.2"
+# sysexits.h: postfix defers the message and tries again later
+EX_TEMPFAIL = 75
 output_folder = "/tmp"
+read_chunk_size = 64 * 1024
 email_re = re.compile(r"(^[-!#$%&'*+/=?^_`{}|~0-9A-Z]+(\.[-!#$%&'*+/=?^_`{}|~0-9A-Z]+)*)@((?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)$|\[(25[0-5]|2[0-4]\d|[0-1]?\d?\d)(\.(25[0-5]|2[0-4]\d|[0-1]?\d?\d)){3}\]$)", re.IGNORECASE)
 email_extract_re = re.compile(r"<(([.0-9a-z_+-=]+)@(([0-9a-z-]+\.)+[0-9a-z]{2,9}))>", re.M | re.S | re.I)
 filename_re = re.compile(r"filename=\"(.+)\"|filename=([^;\n\r\"\']+)", re.I | re.S)
 begin_tab_re = re.compile(r"^\t{1,}", re.M)
 begin_space_re = re.compile(r"^\s{1,}", re.M)
 
+# Skip RFC 2047 decoding for plain ASCII headers and parse addresses without email_re where the result is
+# provably the same; 0 goes back to the original code paths (benchmarks/check_parse_equivalence.py compares them)
+MAILJSON_FAST_PATH = os.getenv('MAILJSON_FAST_PATH', '1') != '0'
+# Distinct address header entries remembered by the fast path
+RECIPIENT_CACHE_SIZE = int(os.getenv('RECIPIENT_CACHE_SIZE', 4096))
+
 # Setup logging
-logging.basicConfig(level=logging.DEBUG, filename="/var/log/postfix/email_processor.log", filemode="a",
+logging.basicConfig(level=logging.DEBUG, filename=os.getenv('EMAIL_PROCESSOR_LOG', "/var/log/postfix/email_processor.log"), filemode="a",
                     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
 #pool = PooledDB(
@@ -36,33 +51,91 @@ logging.basicConfig(level=logging.DEBUG, filename="/var/log/postfix/email_proces
 # Load environment variables from .env file
 load_dotenv()
 
-# Database connection pool
-pool = PooledDB(
-    creator=pymysql,
-    host=os.getenv('DB_HOST'),
-    user=os.getenv('DB_USER'),
-    password=os.getenv('DB_PASSWORD'),
-    database=os.getenv('DB_NAME'),
-    autocommit=True,
-    charset=os.getenv('DB_CHARSET'),
-    cursorclass=pymysql.cursors.DictCursor,
-    blocking=True,
-    maxconnections=int(os.getenv('DB_MAX_CONNECTIONS', 5))
-)
-# Verify environment variables
-print("DB_HOST:", os.getenv('DB_HOST'))
-print("DB_USER:", os.getenv('DB_USER'))
-print("DB_PASSWORD:", os.getenv('DB_PASSWORD'))
-print("DB_NAME:", os.getenv('DB_NAME'))
-print("DB_CHARSET:", os.getenv('DB_CHARSET'))
-print("DB_MAX_CONNECTIONS:", os.getenv('DB_MAX_CONNECTIONS'))
-print("API_KEY:", os.getenv('API_KEY'))
+# Storage backend, see mailstore (STORAGE_BACKEND=mysql|sqlite)
+storage = get_storage()
+# Connection settings for troubleshooting; DB_PASSWORD and API_KEY stay out of the log
+logging.debug("Storage %s: DB_HOST=%s DB_USER=%s DB_NAME=%s DB_CHARSET=%s DB_MAX_CONNECTIONS=%s",
+              storage.name, os.getenv('DB_HOST'), os.getenv('DB_USER'), os.getenv('DB_NAME'),
+              os.getenv('DB_CHARSET'), os.getenv('DB_MAX_CONNECTIONS'))
+
+# Ingest timings, served by the LMTP server on METRICS_LISTEN, see mailstore/metrics.py
+INGEST_STAGE_SECONDS = metrics.histogram("email_ingest_stage_seconds",
+                                         "Time per message in each ingest stage: read, parse (decode_headers included), decode_headers, spool",
+                                         ["stage"])
+INGEST_STORE_SECONDS = metrics.histogram("email_ingest_store_seconds", "Time to store one batch of messages, pool wait and commit included")
+INGEST_BATCH_MESSAGES = metrics.histogram("email_ingest_batch_messages", "Messages per stored batch", buckets=metrics.COUNT_BUCKETS)
+INGEST_MESSAGES = metrics.counter("email_ingest_messages_total", "Messages by outcome: stored, failed, spooled, rejected", ["result"])
+
+_local_part_chars = frozenset("-!#$%&'*+/=?^_`{}|~" + string.digits + string.ascii_letters)
+_label_chars = frozenset("-" + string.digits + string.ascii_letters)
+
+
+def _is_email(s):
+    """email_re.match(s) is not None, in linear time for ASCII domain names."""
+    local, at, domain = s.partition("@")
+    if not s.isascii() or domain.startswith("[") or s.endswith("\n"):
+        # Unicode case folding, address literals and $ before a final newline are left to the regular expression
+        return email_re.match(s) is not None
+    if not at:
+        return False
+    for atom in local.split("."):
+        if not atom or not _local_part_chars.issuperset(atom):
+            return False
+    if domain.endswith("."):
+        domain = domain[:-1]
+    labels = domain.split(".")
+    tld = labels.pop()
+    if not labels or len(tld) < 2 or not _label_chars.issuperset(tld):
+        return False
+    for label in labels:
+        if not 0 < len(label) < 64 or not _label_chars.issuperset(label) or label[0] == "-" or label[-1] == "-":
+            return False
+    return True
+
+
+def _extract_email(s):
+    ret = email_extract_re.findall(s)
+    if len(ret) < 1:
+        for e in s.split(" "):
+            e = e.strip()
+            if _is_email(e):
+                return e
+        return None
+    return ret[0][0]
+
+
+def _split_recipients(v):
+    """The entries of an address header, as csv.reader splits them."""
+    if '"' in v or "\0" in v:
+        return next(csv.reader(StringIO(v)), [])
+    return v.split(",") if v else []
+
+
+@lru_cache(maxsize=RECIPIENT_CACHE_SIZE)
+def _parse_recipient(entry):
+    """(name, address) of one address header entry, as MailJson._parse_recipients has always parsed it."""
+    entry = entry.strip()
+    if _is_email(entry):
+        return "", entry
+    e = _extract_email(entry)
+    entry = entry.replace("<%s>" % e, "")
+    entry = entry.strip()
+    if e and entry.find(e) != -1:
+        entry = entry.replace(e, "").strip()
+    if entry and e is None:
+        e_split = entry.split(" ")
+        e = e_split[-1].replace("<", "").replace(">", "")
+        entry = " ".join(e_split[:-1])
+    return entry, e
+
 
 class MailJson:
     def __init__(self, content=None):
         self.data = {}
         self.raw_parts = []
         self.encoding = "utf-8"  # output encoding
+        self.feed_parser = None
+        self.header_seconds = 0.0
         self.setContent(content)
 
     def setEncoding(self, encoding):
@@ -71,6 +144,18 @@ class MailJson:
     def setContent(self, content):
         self.content = content
 
+    def feed(self, chunk):
+        """Feed raw message bytes incrementally instead of passing the whole content up front."""
+        if self.feed_parser is None:
+            self.feed_parser = email.parser.BytesFeedParser()
+        self.feed_parser.feed(chunk)
+
+    def _header_str(self, v):
+        # The bytes parser hands back raw 8-bit header values as Header objects
+        if isinstance(v, email.header.Header):
+            return "".join(str(b, "utf-8", "replace") if isinstance(b, bytes) else b for b, charset in email.header.decode_header(v))
+        return v
+
     def _fixEncodedSubject(self, subject):
         if subject is None:
             return ""
@@ -109,7 +194,12 @@ class MailJson:
         if type(v) is not list:
             v = [v]
         ret = []
+        # Without encoded-words decode_header() returns the value as is, and the round trips below only strip it
+        fast = MAILJSON_FAST_PATH and self.encoding == "utf-8"
         for h in v:
+            if fast and "=?" not in h and h.isascii():
+                ret.append(h.strip())
+                continue
             h = email.header.decode_header(h)
             h_ret = []
             for h_decoded in h:
@@ -133,6 +223,8 @@ class MailJson:
         if isinstance(v, list):
             v = ",".join(v)
         v = v.replace("\n", " ").replace("\r", " ").strip()
+        if MAILJSON_FAST_PATH:
+            return [{"name": name, "email": e} for name, e in map(_parse_recipient, _split_recipients(v))]
         s = StringIO(v)
         c = csv.reader(s)
         try:
@@ -168,19 +260,36 @@ class MailJson:
         return date
 
     def _get_part_headers(self, part):
+        # Eager on purpose: every parsed message is stored, and insert renders the headers of every part
+        # (render_part_headers); decoding later would move the cost into insert, i.e. into the BatchWriter thread.
+        # The LMTP spool path needs only the top-level headers and calls parse_headers() instead.
+        started = time.perf_counter()
         headers = {}
         for k in list(part.keys()):
             k = k.lower()
-            v = part.get_all(k)
+            v = [self._header_str(h) for h in part.get_all(k)]
             v = self._decode_headers(v)
             if len(v) == 1:
                 headers[k] = v[0]
             else:
                 headers[k] = v
+        self.header_seconds += time.perf_counter() - started
         return headers
 
+    def parse_headers(self):
+        """Decoded headers of the message in content (bytes), read from its header section only."""
+        header_section = self.content.partition(b"\n\n")[0]
+        return self._get_part_headers(email.parser.BytesHeaderParser().parsebytes(header_section))
+
     def parse(self):
-        self.msg = email.message_from_string(self.content)
+        started = time.perf_counter()
+        if self.feed_parser is not None:
+            self.msg = self.feed_parser.close()
+            self.feed_parser = None
+        elif isinstance(self.content, bytes):
+            self.msg = email.message_from_bytes(self.content)
+        else:
+            self.msg = email.message_from_string(self.content)
         content_charset = self.msg.get_content_charset()
         if content_charset is None:
             content_charset = 'utf-8'
@@ -192,19 +301,21 @@ class MailJson:
         self.data["reply-to"] = self._parse_recipients(headers.get("reply-to", None))
         self.data["from"] = self._parse_recipients(headers.get("from", None))
         self.data["cc"] = self._parse_recipients(headers.get("cc", None))
+        self.data["bcc"] = self._parse_recipients(headers.get("bcc", None))
         attachments = []
         parts = []
         for part in self.msg.walk():
             if part.is_multipart():
                 continue
-            content_disposition = part.get("Content-Disposition", None)
+            content_disposition = self._header_str(part.get("Content-Disposition", None))
             if content_disposition:
                 r = filename_re.findall(content_disposition)
                 if r:
                     filename = sorted(r[0])[1]
                 else:
                     filename = "undefined"
-                a = {"filename": filename, "content": base64.b64encode(part.get_payload(decode=True)), "content_type": part.get_content_type()}
+                # Raw bytes; base64 is only produced for JSON output, see get_json()
+                a = {"filename": filename, "content": part.get_payload(decode=True) or b"", "content_type": part.get_content_type()}
                 attachments.append(a)
             else:
                 try:
@@ -215,60 +326,56 @@ class MailJson:
                     pass
         self.data["attachments"] = attachments
         self.data["parts"] = parts
+        # Indexed for GET /emails/search by the transaction that stores the message
+        self.data["search-text"] = extract_text(parts)
         self.data["encoding"] = self.encoding
+        INGEST_STAGE_SECONDS.observe(self.header_seconds, ("decode_headers",))
+        INGEST_STAGE_SECONDS.observe(time.perf_counter() - started, ("parse",))
         return self.get_data()
 
     def get_data(self):
         return self.data
 
+    def get_json(self, indent=4):
+        """Serialize the parsed data, base64 encoding attachment payloads."""
+        data = dict(self.data)
+        data["attachments"] = [dict(a, content=base64.b64encode(a["content"]).decode("ascii")) for a in self.data.get("attachments", [])]
+        return json.dumps(data, indent=indent)
+
     def get_raw_parts(self):
         return self.raw_parts
 
+def _addresses(data):
+    return [address for address, role in recipient_addresses(data)]
+
 def insert_email_data(data):
-    conn = pool.connection()
+    """Store a parsed message, returning the new email id or None on failure."""
+    started = time.perf_counter()
     try:
-        with conn.cursor() as cursor:
-            sql_email = """
-            INSERT INTO emails (received_time, subject, from_email, from_name, reply_to_email, reply_to_name,
-                                to_email, to_name, cc_email, cc_name, raw_headers, encoding)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """
-            from_data = data['from'][0] if data['from'] else {'email': None, 'name': None}
-            reply_to_data = data['reply-to'][0] if data['reply-to'] else {'email': None, 'name': None}
-            to_data = data['to'][0] if data['to'] else {'email': None, 'name': None}
-            cc_data = data['cc'][0] if data['cc'] else {'email': None, 'name': None}
-
-            cursor.execute(sql_email, (
-                data['datetime'], data['subject'],
-                from_data['email'], from_data['name'],
-                reply_to_data['email'], reply_to_data['name'],
-                to_data['email'], to_data['name'],
-                cc_data['email'], cc_data['name'],
-                json.dumps(data['headers']), data['encoding']
-            ))
-
-            email_id = cursor.lastrowid
-
-            sql_parts = """
-            INSERT INTO email_parts (email_id, headers, content_type, content)
-            VALUES (%s, %s, %s, %s)
-            """
-            parts_data = [(email_id, json.dumps(part['headers']), part['content_type'], part['content']) for part in data['parts']]
-            cursor.executemany(sql_parts, parts_data)
-
-            sql_attachments = """
-            INSERT INTO email_attachments (email_id, filename, content_type, content)
-            VALUES (%s, %s, %s, %s)
-            """
-            attachments_data = [(email_id, attachment['filename'], attachment['content_type'], base64.b64decode(attachment['content'])) for attachment in data['attachments']]
-            cursor.executemany(sql_attachments, attachments_data)
-
-        conn.commit()
+        email_id = storage.insert_email(data)
     except Exception as e:
         logging.error("Failed to insert email data: %s", e)
-        conn.rollback()
-    finally:
-        conn.close()
+        INGEST_MESSAGES.inc(("failed",))
+        return None
+    _record_store(started, 1)
+    notify_stored(_addresses(data))
+    return email_id
+
+def insert_email_batch(batch):
+    """Store several parsed messages in one transaction and return their email ids.
+
+    Raises on failure; nothing from the batch is stored then.
+    """
+    started = time.perf_counter()
+    email_ids = storage.insert_email_batch(batch)
+    _record_store(started, len(batch))
+    notify_stored([address for data in batch for address in _addresses(data)])
+    return email_ids
+
+def _record_store(started, count):
+    INGEST_STORE_SECONDS.observe(time.perf_counter() - started)
+    INGEST_BATCH_MESSAGES.observe(count)
+    INGEST_MESSAGES.inc(("stored",), count)
 
 def main():
     parser = OptionParser(usage="usage: %prog [options]", version="%prog " + VERSION)
@@ -277,38 +384,60 @@ def main():
     parser.add_option("-o", "--output", dest="output", help="output folder", default=output_folder)
     parser.add_option("-c", "--config", dest="config", help="config file", metavar="CONFIG")
     parser.add_option("-e", "--encoding", dest="encoding", help="output encoding")
+    parser.add_option("-j", "--json", dest="json", action="store_true", default=False, help="also write the parsed email as JSON to the output folder")
     (options, args) = parser.parse_args()
 
     logging.info("Starting email processing")
 
-    content = None
+    mj = MailJson()
+    if options.encoding:
+        logging.info("Setting encoding to: %s", options.encoding)
+        mj.setEncoding(options.encoding)
+
     if options.filename:
         logging.info("Reading content from file: %s", options.filename)
-        with open(options.filename, "r") as f:
-            content = f.read()
+        source = open(options.filename, "rb")
     elif options.url:
         logging.info("Downloading content from URL: %s", options.url)
-        content = urllib.request.urlopen(options.url).read()
+        source = urllib.request.urlopen(options.url)
     else:
         logging.info("Reading content from stdin")
-        content = sys.stdin.read()
+        source = sys.stdin.buffer
 
-    if options.encoding:
-        logging.info("Setting encoding to: %s", options.encoding)
-
-    mj = MailJson(content)
-    if options.encoding:
-        mj.setEncoding(options.encoding)
+    started = time.perf_counter()
+    chunks = []
+    with source:
+        for chunk in iter(lambda: source.read(read_chunk_size), b""):
+            mj.feed(chunk)
+            chunks.append(chunk)
+    raw = b"".join(chunks)
+    INGEST_STAGE_SECONDS.observe(time.perf_counter() - started, ("read",))
 
     email_data = mj.parse()
-    logging.debug("Parsed email data: %s", email_data)
-
-    insert_email_data(email_data)
-
-    #output_file = os.path.join(options.output, "email.json")
-    #with open(output_file, "w") as f:
-    #    f.write(json.dumps(email_data, indent=4))
-    #    logging.info("Email data written to: %s", output_file)
+    # The pipe transport passes ${sender} ${recipient}
+    recipients = args[1:]
+    if recipients:
+        email_data["envelope-to"] = recipients
+    email_data["idempotency-key"] = idempotency_key(email_data["headers"].get("message-id"), recipients, raw)
+    # Only a summary: logging the parsed message wrote every body and attachment to the log
+    logging.debug("Parsed email %s: %d bytes, %d parts, %d attachments", email_data["idempotency-key"],
+                  len(raw), len(email_data["parts"]), len(email_data["attachments"]))
+
+    if insert_email_data(email_data) is None:
+        # Leave the message to the spool replay of the LMTP server, or to postfix to retry
+        try:
+            spool_message({"envelope-to": recipients, "sender": args[0] if args else None,
+                           "key": email_data["idempotency-key"], "spooled_at": time.time()}, raw)
+            logging.info("Database unavailable, spooled message %s", email_data["idempotency-key"])
+        except OSError as e:
+            logging.error("Failed to spool message: %s", e)
+            sys.exit(EX_TEMPFAIL)
+
+    if options.json:
+        output_file = os.path.join(options.output, "email.json")
+        with open(output_file, "w") as f:
+            f.write(mj.get_json())
+            logging.info("Email data written to: %s", output_file)
 
     logging.info("Email processing completed")
 
@@ -2,7 +2,7 @@
 
 # Ensure correct permissions
 chown -R root:root /etc/postfix/*
-chown -R nobody /var/log/postfix/
+chown -R mailstore:postfix /var/log/postfix/ /var/spool/email_processor/
 chmod -R 644 /etc/postfix/*
 chmod -R 755 /etc/postfix/postfix-script
 chmod -R 755 /var/spool/postfix
@@ -13,5 +13,18 @@ newaliases
 postmap /etc/postfix/virtual
 postmap /etc/postfix/transport
 
+# Directory of the LMTP socket, writable by the daemon and reachable by postfix only
+install -d -o mailstore -g postfix -m 750 /var/spool/postfix/lmtp
+
+# Run the LMTP delivery daemon that postfix hands messages to as the unprivileged mailstore
+# user, and start it again if it exits; postfix defers deliveries meanwhile
+(
+    while true; do
+        su-exec mailstore python3 /opt/app/lmtp_server.py
+        echo "lmtp_server.py exited with status $?, restarting in 1 s" >&2
+        sleep 1
+    done
+) &
+
 # Start Postfix in foreground mode
 postfix start-fg
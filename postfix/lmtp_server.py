@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+"""Long-running LMTP delivery service for postfix.
+
+Postfix hands every message to this daemon over LMTP instead of spawning
+email_processor.py once per message, so the interpreter, the imports and the
+MySQL connection pool stay warm between deliveries.
+
+By default a message is acknowledged once it is in the local spool (spool.py)
+and written to the database in the background, so deliveries neither wait for
+nor fail with the database.
+"""
+
+import os, grp, hashlib, socket, socketserver, signal, threading, time
+import logging
+
+from email_processor import MailJson, insert_email_data, INGEST_STAGE_SECONDS, INGEST_MESSAGES
+from mailstore import metrics
+from batch_writer import BatchWriter
+from spool import Spool, idempotency_key
+from replay import Replayer
+
+# unix:/path/to/socket or inet:host:port
+LMTP_LISTEN = os.getenv('LMTP_LISTEN', 'unix:/var/spool/postfix/lmtp/email_processor')
+# Group given read/write access to a unix socket, the one postfix's lmtp client runs in; empty to keep ours
+LMTP_SOCKET_GROUP = os.getenv('LMTP_SOCKET_GROUP', 'postfix')
+# spool: acknowledge once spooled to local disk and replay into the database in the background,
+# batch: group-commit through BatchWriter, single: one transaction per message
+INGEST_MODE = os.getenv('INGEST_MODE', 'spool')
+# host:port of the Prometheus metrics endpoint (GET /metrics), empty to disable. It has no authentication, so it
+# listens on loopback only unless pointed at an address of the compose network, e.g. postfix:9101
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1:9101')
+MAX_LINE_LENGTH = 64 * 1024
+
+
+class TemporaryFailure(Exception):
+    """Delivery failed in a way postfix should retry later."""
+
+
+class LineTooLong(Exception):
+    """A DATA line exceeded MAX_LINE_LENGTH; the message is rejected."""
+
+
+writer = None
+spool = None
+
+
+def deliver(content, sender, recipients, raw_digest):
+    """Store a single message received over LMTP.
+
+    In spool mode content is the raw message, spooled once its headers parse;
+    the replay parses the whole message. Otherwise it is a MailJson already fed
+    the raw bytes, which are not kept. raw_digest is their SHA-256 digest.
+    """
+    if spool is not None:
+        headers = MailJson(content).parse_headers()
+        key = idempotency_key(headers.get("message-id"), recipients, raw_digest=raw_digest)
+        started = time.perf_counter()
+        try:
+            spool.append({"envelope-to": recipients, "sender": sender, "key": key, "spooled_at": time.time()}, content)
+        except OSError as e:
+            raise TemporaryFailure("spool write failed: %s" % e)
+        INGEST_STAGE_SECONDS.observe(time.perf_counter() - started, ("spool",))
+        INGEST_MESSAGES.inc(("spooled",))
+        return
+    email_data = content.parse()
+    email_data["envelope-to"] = recipients
+    email_data["idempotency-key"] = idempotency_key(email_data["headers"].get("message-id"), recipients,
+                                                    raw_digest=raw_digest)
+    if writer is not None:
+        email_id = writer.insert(email_data)
+    else:
+        email_id = insert_email_data(email_data)
+    if email_id is None:
+        raise TemporaryFailure("database insert failed")
+
+
+class LMTPHandler(socketserver.StreamRequestHandler):
+    """One LMTP session (RFC 2033); postfix may deliver several messages per connection."""
+
+    def reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def reset(self):
+        self.sender = None
+        self.recipients = []
+
+    def handle(self):
+        self.reset()
+        self.reply("220 %s LMTP email_processor ready" % socket.gethostname())
+        while True:
+            line = self.rfile.readline(MAX_LINE_LENGTH)
+            if not line:
+                return
+            command = line.decode("ascii", "replace").rstrip("\r\n")
+            verb, _, arg = command.partition(" ")
+            verb = verb.upper()
+
+            if verb == "LHLO":
+                self.reply("250-%s" % socket.gethostname())
+                self.reply("250-PIPELINING")
+                self.reply("250-ENHANCEDSTATUSCODES")
+                self.reply("250 8BITMIME")
+            elif verb == "MAIL":
+                self.reset()
+                self.sender = self._address(arg, "FROM:")
+                self.reply("250 2.1.0 Ok")
+            elif verb == "RCPT":
+                if self.sender is None:
+                    self.reply("503 5.5.1 Error: need MAIL command")
+                    continue
+                self.recipients.append(self._address(arg, "TO:"))
+                self.reply("250 2.1.5 Ok")
+            elif verb == "DATA":
+                if not self.recipients:
+                    self.reply("503 5.5.1 Error: need RCPT command")
+                    continue
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                try:
+                    content, raw_digest = self._read_data()
+                except LineTooLong as e:
+                    logging.error("Rejected message from %s: %s", self.sender, e)
+                    INGEST_MESSAGES.inc(("rejected",))
+                    for _ in self.recipients:
+                        self.reply("500 5.5.2 Error: line too long")
+                    self.reset()
+                    continue
+                if content is None:
+                    return
+                for status in self._deliver(content, raw_digest):
+                    self.reply(status)
+                self.reset()
+            elif verb == "RSET":
+                self.reset()
+                self.reply("250 2.0.0 Ok")
+            elif verb == "NOOP":
+                self.reply("250 2.0.0 Ok")
+            elif verb == "VRFY":
+                self.reply("252 2.0.0 Cannot VRFY user")
+            elif verb == "QUIT":
+                self.reply("221 2.0.0 Bye")
+                return
+            else:
+                self.reply("500 5.5.2 Error: command not recognized")
+
+    def _address(self, arg, prefix):
+        arg = arg.strip()
+        if arg.upper().startswith(prefix):
+            arg = arg[len(prefix):].strip()
+        # Drop ESMTP parameters such as SIZE= or BODY=8BITMIME
+        address = arg.split(" ")[0]
+        return address.strip("<>")
+
+    def _read_data(self):
+        """Read the DATA section; returns the content deliver() takes and the SHA-256 digest of the raw bytes.
+
+        Only spool mode keeps the raw bytes; otherwise they are streamed into a
+        MailJson parser as they arrive. Raises LineTooLong once the whole
+        section is read if a line was longer than MAX_LINE_LENGTH.
+        """
+        mj = MailJson() if spool is None else None
+        lines = [] if spool is not None else None
+        digest = hashlib.sha256()
+        too_long = False
+        line_start = True
+        started = time.perf_counter()
+        while True:
+            line = self.rfile.readline(MAX_LINE_LENGTH + 2)
+            if not line:
+                return None, None
+            if not line.endswith(b"\n"):
+                # The rest of the line follows in the next reads; drop the message but keep reading to its end
+                too_long = True
+                line_start = False
+                mj = lines = digest = None
+                continue
+            if not line_start:
+                line_start = True
+                continue
+            if line in (b".\r\n", b".\n"):
+                break
+            if too_long:
+                continue
+            if line.startswith(b".."):
+                line = line[1:]
+            # Store bare LF line endings, as the pipe transport used to hand us
+            if line.endswith(b"\r\n"):
+                line = line[:-2] + b"\n"
+            digest.update(line)
+            if mj is not None:
+                mj.feed(line)
+            else:
+                lines.append(line)
+        # Includes feeding the parser, which builds the message tree as lines arrive
+        INGEST_STAGE_SECONDS.observe(time.perf_counter() - started, ("read",))
+        if too_long:
+            raise LineTooLong("DATA line longer than %d bytes" % MAX_LINE_LENGTH)
+        return (mj if mj is not None else b"".join(lines)), digest.digest()
+
+    def _deliver(self, content, raw_digest):
+        """Deliver once and answer for every accepted recipient, as LMTP requires."""
+        try:
+            deliver(content, self.sender, self.recipients, raw_digest)
+            status = "250 2.0.0 Ok: delivered"
+        except TemporaryFailure as e:
+            logging.error("Temporary failure delivering message from %s: %s", self.sender, e)
+            status = "451 4.3.0 Error: temporary failure, try again later"
+        except Exception as e:
+            logging.exception("Failed to process message from %s: %s", self.sender, e)
+            status = "554 5.6.0 Error: message could not be processed"
+        return [status] * len(self.recipients)
+
+
+class ThreadingLMTPUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ThreadingLMTPTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def create_server(listen):
+    kind, _, address = listen.partition(":")
+    if kind == "unix":
+        if os.path.exists(address):
+            os.unlink(address)
+        server = ThreadingLMTPUnixServer(address, LMTPHandler)
+        # Only postfix may deliver; anyone able to connect could inject mail into every mailbox
+        if LMTP_SOCKET_GROUP:
+            os.chown(address, -1, grp.getgrnam(LMTP_SOCKET_GROUP).gr_gid)
+        os.chmod(address, 0o660)
+        return server
+    if kind == "inet":
+        host, _, port = address.rpartition(":")
+        return ThreadingLMTPTCPServer((host, int(port)), LMTPHandler)
+    raise ValueError("LMTP_LISTEN must start with unix: or inet:, got %r" % listen)
+
+
+def watch_spool(replayer):
+    """Export the spool depth and replay lag last reported by the replay thread."""
+    for name, key, documentation in (
+            ("email_spool_segments", "segments", "Spool segment files not yet replayed"),
+            ("email_spool_pending_bytes", "pending_bytes", "Spooled bytes not yet replayed into the database"),
+            ("email_spool_replay_lag_seconds", "replay_lag_seconds", "Age of the oldest message not yet replayed")):
+        metrics.gauge(name, documentation, function=lambda key=key: replayer.last_status.get(key))
+
+
+def main():
+    global writer, spool
+    replayer = None
+    if INGEST_MODE == "spool":
+        spool = Spool()
+        replayer = Replayer(spool)
+        watch_spool(replayer)
+    elif INGEST_MODE == "batch":
+        writer = BatchWriter()
+    server = create_server(LMTP_LISTEN)
+    metrics_server = metrics.start_http_server(METRICS_LISTEN) if METRICS_LISTEN else None
+
+    def shutdown(signum, frame):
+        logging.info("Received signal %s, shutting down LMTP server", signum)
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    logging.info("LMTP server listening on %s, metrics on %s", LMTP_LISTEN, METRICS_LISTEN or "(disabled)")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        if writer is not None:
+            writer.close()
+        if replayer is not None:
+            replayer.close()
+            spool.close()
+        logging.info("LMTP server stopped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Fire-and-forget notifications from the ingest path to the API.
+
+After mail is committed a small JSON datagram naming its recipients is sent
+over UDP to MAIL_EVENTS_ADDR, where flask_app/mail_events.py picks it up to
+drop cached responses. Delivery is best effort and never blocks ingestion.
+"""
+
+import os, socket, json, time
+import logging
+
+MAIL_EVENTS_ADDR = os.getenv('MAIL_EVENTS_ADDR', 'flask_app:5001')
+# Seconds to wait before resolving MAIL_EVENTS_ADDR again after a failure
+RESOLVE_RETRY_INTERVAL = 30
+
+_sock = None
+_address = None
+_resolve_failed_at = 0
+
+
+def _resolve():
+    global _address, _resolve_failed_at
+    if _address is None and time.monotonic() - _resolve_failed_at > RESOLVE_RETRY_INTERVAL:
+        host, _, port = MAIL_EVENTS_ADDR.rpartition(":")
+        try:
+            _address = socket.getaddrinfo(host, int(port), socket.AF_INET, socket.SOCK_DGRAM)[0][4]
+        except (OSError, ValueError) as e:
+            logging.debug("Cannot resolve MAIL_EVENTS_ADDR %s: %s", MAIL_EVENTS_ADDR, e)
+            _resolve_failed_at = time.monotonic()
+    return _address
+
+
+def send_event(event):
+    global _sock, _address
+    if not MAIL_EVENTS_ADDR:
+        return
+    address = _resolve()
+    if address is None:
+        return
+    try:
+        if _sock is None:
+            _sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            _sock.setblocking(False)
+        _sock.sendto(json.dumps(event).encode("utf-8"), address)
+    except OSError as e:
+        logging.debug("Failed to send mail event to %s: %s", MAIL_EVENTS_ADDR, e)
+        # The API container may have been recreated with a new address
+        _address = None
+
+
+def notify_stored(recipients):
+    """Tell the API that new mail was committed for these recipients."""
+    recipients = sorted({r.lower() for r in recipients if r})
+    if recipients:
+        send_event({"event": "stored", "recipients": recipients})
@@ -0,0 +1,254 @@
+"""Replay of the ingest spool (spool.py) into the database.
+
+A background thread of the LMTP server reads spooled messages in batches,
+stores them with insert_email_batch and only moves its checkpoint
+(SPOOL_DIR/checkpoint.json) past messages that are committed. After a crash
+the last batch is replayed again and deduplicated by its idempotency keys.
+
+While the database is failing the thread retries every SPOOL_RETRY_INTERVAL
+seconds and the spool grows. A message that keeps failing while the database
+otherwise works is moved to SPOOL_DIR/rejected after SPOOL_MAX_ATTEMPTS, as a
+segment that can be moved back into SPOOL_DIR to be replayed again.
+
+Spool depth and replay lag are logged, written to SPOOL_DIR/status.json,
+sent to the API as a "spool" mail event, see GET /emails/stats, and exported
+as email_spool_* metrics by the LMTP server.
+"""
+
+import os, json, time, threading
+import logging
+from itertools import islice
+
+from email_processor import MailJson, insert_email_batch, insert_email_data, storage, INGEST_MESSAGES
+from notify import send_event
+from spool import OPEN, SEALED, REJECTED_DIR, read_records, spool_message
+
+SPOOL_REPLAY_BATCH_SIZE = int(os.getenv('SPOOL_REPLAY_BATCH_SIZE', os.getenv('INGEST_BATCH_SIZE', 50)))
+# Seconds between replay attempts while the database is failing
+SPOOL_RETRY_INTERVAL = float(os.getenv('SPOOL_RETRY_INTERVAL', 5))
+# Failed inserts of one message, with the database otherwise working, before it is rejected
+SPOOL_MAX_ATTEMPTS = int(os.getenv('SPOOL_MAX_ATTEMPTS', 5))
+# Seconds between spool status reports (log, status.json and a "spool" mail event)
+SPOOL_STATUS_INTERVAL = int(os.getenv('SPOOL_STATUS_INTERVAL', 10))
+
+CHECKPOINT_FILE = "checkpoint.json"
+STATUS_FILE = "status.json"
+
+
+class Replayer:
+    """Background thread draining spooled messages into the database in batches."""
+
+    def __init__(self, spool, batch_size=SPOOL_REPLAY_BATCH_SIZE, retry_interval=SPOOL_RETRY_INTERVAL,
+                 max_attempts=SPOOL_MAX_ATTEMPTS, status_interval=SPOOL_STATUS_INTERVAL):
+        self.spool = spool
+        self.directory = spool.directory
+        self.batch_size = max(1, batch_size)
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+        self.status_interval = status_interval
+        self.replayed = 0
+        self.rejected = 0
+        self.last_error = None
+        # The latest status(), for the metrics endpoint
+        self.last_status = {}
+        self._attempts = {}  # idempotency key -> failed inserts
+        self._checkpoint = self._load_checkpoint()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="spool-replay", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stop after the current batch; whatever is left is replayed on the next start."""
+        self._stopping.set()
+        self.spool.durable.set()
+        self._thread.join()
+        self._report()
+
+    def status(self):
+        """Spool depth and replay lag, as reported in status.json and the "spool" mail event."""
+        pending_bytes = 0
+        oldest = None
+        segments = self._segments()
+        for name, path, end in segments:
+            offset = self._checkpoint.get(name, 0)
+            try:
+                size = os.path.getsize(path) if end is None else end
+                if size > offset and oldest is None:
+                    oldest = next((meta["spooled_at"] for meta, body, _ in read_records(path, offset, end)), None)
+            except OSError:
+                continue
+            pending_bytes += max(0, size - offset)
+        return {
+            "segments": len(segments),
+            "pending_bytes": pending_bytes,
+            "replay_lag_seconds": round(max(0.0, time.time() - oldest), 3) if oldest is not None else 0.0,
+            "replayed": self.replayed,
+            "rejected": self.rejected,
+            "last_error": self.last_error,
+            "reported_at": time.time(),
+        }
+
+    def _run(self):
+        reported_at = time.monotonic()
+        while not self._stopping.is_set():
+            self.spool.durable.clear()
+            try:
+                progressed = self._replay_once()
+            except Exception as e:
+                logging.exception("Spool replay failed: %s", e)
+                self.last_error = str(e)
+                progressed = None
+            if progressed is None:
+                self._stopping.wait(self.retry_interval)
+            elif not progressed:
+                self.spool.durable.wait(1.0)
+            if time.monotonic() - reported_at >= self.status_interval:
+                self._report()
+                reported_at = time.monotonic()
+
+    def _segments(self):
+        """(name, path, readable end) of every segment, oldest first; end is None for sealed ones."""
+        filenames = sorted(os.listdir(self.directory))
+        open_name, durable_size = self.spool.open_segment()
+        own_suffix = "-%d" % os.getpid()
+        segments = []
+        for filename in filenames:
+            name, extension = os.path.splitext(filename)
+            if extension not in (OPEN, SEALED):
+                continue
+            if name == open_name:
+                end = durable_size
+            elif extension == OPEN and name.endswith(own_suffix):
+                # Sealed since the listing; it is picked up under its new name
+                continue
+            else:
+                # Open segments of an earlier process are as complete as they will ever be
+                end = None
+            segments.append((name, os.path.join(self.directory, filename), end))
+        return segments
+
+    def _replay_once(self):
+        """Replay one batch. True if it made progress, False if caught up, None if the database is failing."""
+        for name, path, end in self._segments():
+            offset = self._checkpoint.get(name, 0)
+            try:
+                records = list(islice(read_records(path, offset, end), self.batch_size))
+            except FileNotFoundError:
+                # Sealed while listing; it is picked up under its new name
+                return True
+            if records:
+                stored = self._store(records)
+                if not stored:
+                    return None
+                self._save_checkpoint(name, records[stored - 1][2])
+                return True
+            if end is None:
+                try:
+                    self._drop_segment(name, path, offset)
+                except FileNotFoundError:
+                    pass
+                return True
+        return False
+
+    def _store(self, records):
+        """Insert a batch of records and return how many leading ones are done with."""
+        batch = []
+        for meta, body, _ in records:
+            try:
+                data = MailJson(body).parse()
+                data["envelope-to"] = meta["envelope-to"]
+                data["idempotency-key"] = meta["key"]
+            except Exception as e:
+                logging.exception("Failed to parse spooled message %s: %s", meta.get("key"), e)
+                data = None
+            batch.append(data)
+
+        parsed = [data for data in batch if data is not None]
+        try:
+            if parsed:
+                insert_email_batch(parsed)
+            results = [data is not None for data in batch]
+        except Exception as e:
+            # One bad message must not fail its neighbours: retry them one by one
+            logging.error("Replay of %d spooled emails failed, retrying individually: %s", len(parsed), e)
+            self.last_error = str(e)
+            results = [data is not None and insert_email_data(data) is not None for data in batch]
+
+        done = 0
+        for (meta, body, _), data, stored in zip(records, batch, results):
+            if stored:
+                self._attempts.pop(meta["key"], None)
+                self.replayed += 1
+            elif data is None:
+                self._reject(meta, body, "unparseable")
+            elif not self._database_available():
+                break
+            else:
+                attempts = self._attempts.get(meta["key"], 0) + 1
+                if attempts < self.max_attempts:
+                    self._attempts[meta["key"]] = attempts
+                    break
+                self._attempts.pop(meta["key"], None)
+                self._reject(meta, body, "insert failed %d times" % attempts)
+            done += 1
+        return done
+
+    def _database_available(self):
+        try:
+            with storage.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return True
+        except Exception as e:
+            self.last_error = str(e)
+            return False
+
+    def _reject(self, meta, body, reason):
+        logging.error("Moving spooled message %s to %s: %s", meta.get("key"), REJECTED_DIR, reason)
+        spool_message(dict(meta, rejected=reason), body, os.path.join(self.directory, REJECTED_DIR))
+        self.rejected += 1
+        INGEST_MESSAGES.inc(("rejected",))
+
+    def _drop_segment(self, name, path, offset):
+        size = os.path.getsize(path)
+        if offset < size:
+            logging.error("Spool segment %s has %d unreadable bytes after offset %d, moving it to %s",
+                          name, size - offset, offset, REJECTED_DIR)
+            os.rename(path, os.path.join(self.directory, REJECTED_DIR, os.path.basename(path) + ".corrupt"))
+        else:
+            os.unlink(path)
+        if self._checkpoint.pop(name, None) is not None:
+            self._write_checkpoint()
+
+    def _load_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _save_checkpoint(self, name, offset):
+        self._checkpoint[name] = offset
+        self._write_checkpoint()
+
+    def _write_checkpoint(self):
+        self._write_json(CHECKPOINT_FILE, self._checkpoint)
+
+    def _write_json(self, filename, data):
+        path = os.path.join(self.directory, filename)
+        with open(path + ".tmp", "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def _report(self):
+        try:
+            status = self.last_status = self.status()
+            self._write_json(STATUS_FILE, status)
+        except Exception as e:
+            logging.exception("Failed to report spool status: %s", e)
+            return
+        if status["pending_bytes"]:
+            logging.info("Spool: %d bytes in %d segments pending, replay lag %.1fs",
+                         status["pending_bytes"], status["segments"], status["replay_lag_seconds"])
+        send_event(dict(status, event="spool"))
@@ -0,0 +1,211 @@
+"""Durable local spool between delivery and the database.
+
+With INGEST_MODE=spool a delivery is acknowledged as soon as the raw message
+is on local disk, so neither a slow nor an unavailable database holds up
+postfix. Every message carries an idempotency key (Message-ID, envelope
+recipients and a hash of the raw message), so a message replayed twice, or
+delivered again by postfix after a failure, is stored once.
+
+Messages are appended to segment files in SPOOL_DIR, one record each:
+
+    meta length, body length    big-endian uint32
+    meta                        JSON: envelope recipients, idempotency key, spool time
+    body                        the raw message
+    crc32                       of meta and body, big-endian uint32
+
+Concurrent deliveries share one fsync (group commit). The segment being
+written is named *.open and renamed to *.seg once it is full. replay.py drains
+the segments into the database and deletes them.
+"""
+
+import os, json, time, hashlib, struct, threading, zlib
+import logging
+
+SPOOL_DIR = os.getenv('SPOOL_DIR', '/var/spool/email_processor')
+SPOOL_SEGMENT_BYTES = int(os.getenv('SPOOL_SEGMENT_MB', 64)) * 1024 * 1024
+# How long the fsync waits for more deliveries to join it
+SPOOL_FSYNC_INTERVAL_MS = int(os.getenv('SPOOL_FSYNC_INTERVAL_MS', 2))
+
+OPEN = ".open"
+SEALED = ".seg"
+REJECTED_DIR = "rejected"
+
+_record_header = struct.Struct(">II")
+_record_crc = struct.Struct(">I")
+
+
+def idempotency_key(message_id, recipients, raw=None, raw_digest=None):
+    """Key identifying one delivery of a message, stored in emails.idempotency_key.
+
+    raw_digest, the SHA-256 digest of raw, replaces raw for callers that hashed the message as it arrived.
+    """
+    digest = hashlib.sha256()
+    digest.update(str(message_id or "").strip().encode("utf-8", "surrogateescape") + b"\0")
+    digest.update(",".join(sorted(r.lower() for r in recipients)).encode("utf-8", "surrogateescape") + b"\0")
+    digest.update(raw_digest if raw_digest is not None else hashlib.sha256(raw).digest())
+    return digest.hexdigest()
+
+
+def encode_record(meta, body):
+    meta = json.dumps(meta).encode("utf-8")
+    crc = zlib.crc32(body, zlib.crc32(meta))
+    return _record_header.pack(len(meta), len(body)) + meta + body + _record_crc.pack(crc)
+
+
+def read_records(path, offset=0, end=None):
+    """Yield (meta, body, next offset) for the intact records of a segment from offset on.
+
+    Stops at end, or at a torn or corrupt record such as a crash while
+    appending leaves behind.
+    """
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while end is None or offset < end:
+            header = f.read(_record_header.size)
+            if len(header) < _record_header.size:
+                return
+            meta_length, body_length = _record_header.unpack(header)
+            length = meta_length + body_length + _record_crc.size
+            record = f.read(length)
+            if len(record) < length:
+                return
+            meta, body = record[:meta_length], record[meta_length:meta_length + body_length]
+            if _record_crc.unpack(record[-_record_crc.size:])[0] != zlib.crc32(body, zlib.crc32(meta)):
+                logging.error("Corrupt spool record in %s at offset %d", path, offset)
+                return
+            offset += _record_header.size + length
+            yield json.loads(meta), body, offset
+
+
+def _segment_name():
+    return "%020d-%d" % (time.time_ns(), os.getpid())
+
+
+def _fsync_dir(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def spool_message(meta, body, directory=SPOOL_DIR):
+    """Write one message as a sealed segment of its own.
+
+    For processes that do not keep a Spool open, such as email_processor.py
+    run by the pipe transport; the replay thread of the LMTP server picks it up.
+    """
+    os.makedirs(directory, exist_ok=True)
+    name = _segment_name()
+    path = os.path.join(directory, name + ".tmp")
+    with open(path, "wb") as f:
+        f.write(encode_record(meta, body))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path, os.path.join(directory, name + SEALED))
+    _fsync_dir(directory)
+
+
+class Spool:
+    """Append-only segment files written by the delivery threads."""
+
+    def __init__(self, directory=SPOOL_DIR, segment_bytes=SPOOL_SEGMENT_BYTES, fsync_interval_ms=SPOOL_FSYNC_INTERVAL_MS):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval_ms / 1000.0
+        os.makedirs(os.path.join(directory, REJECTED_DIR), exist_ok=True)
+        self._cond = threading.Condition()
+        self._appended = 0     # records written, ever
+        self._synced = 0       # records an fsync has completed for, successfully or not
+        self._failed_upto = 0  # records up to here were in an fsync that failed
+        self._closed = False
+        self._file = None
+        self._open_segment()
+        # Set whenever records become durable, to wake the replay thread
+        self.durable = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="spool-fsync", daemon=True)
+        self._thread.start()
+
+    def append(self, meta, body):
+        """Write a message and return once it is on disk; raises OSError if it could not be made durable."""
+        record = encode_record(meta, body)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Spool is closed")
+            if self._size and self._size + len(record) > self.segment_bytes:
+                self._sync()
+                self._seal()
+                self._open_segment()
+            self._file.write(record)
+            self._size += len(record)
+            self._appended += 1
+            target = self._appended
+            self._cond.notify_all()
+            while self._synced < target:
+                self._cond.wait()
+            if target <= self._failed_upto:
+                raise OSError("Failed to fsync spool segment %s" % self.segment)
+
+    def open_segment(self):
+        """(name, bytes on disk) of the segment being written; readers must not go past that."""
+        with self._cond:
+            return self.segment, self._durable_size
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        with self._cond:
+            self._sync()
+            if self._size:
+                self._seal()
+            else:
+                self._file.close()
+                os.unlink(os.path.join(self.directory, self.segment + OPEN))
+
+    def _open_segment(self):
+        self.segment = _segment_name()
+        self._file = open(os.path.join(self.directory, self.segment + OPEN), "ab")
+        _fsync_dir(self.directory)
+        self._size = 0
+        self._durable_size = 0
+
+    def _seal(self):
+        self._file.close()
+        os.rename(os.path.join(self.directory, self.segment + OPEN), os.path.join(self.directory, self.segment + SEALED))
+        _fsync_dir(self.directory)
+
+    def _sync(self):
+        target = self._appended
+        if target == self._synced:
+            return
+        try:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._durable_size = self._size
+        except OSError as e:
+            # What reached the disk is unknown; postfix retries those messages, and
+            # the copies that did survive are deduplicated by their idempotency key
+            logging.error("Failed to fsync spool segment %s: %s", self.segment, e)
+            self._failed_upto = target
+            try:
+                self._seal()
+            except OSError:
+                logging.exception("Failed to seal spool segment %s", self.segment)
+            self._open_segment()
+        self._synced = target
+        self._cond.notify_all()
+        self.durable.set()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._synced == self._appended and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+            # Let concurrent deliveries join this fsync
+            time.sleep(self.fsync_interval)
+            with self._cond:
+                self._sync()
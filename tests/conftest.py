@@ -0,0 +1,132 @@
+"""Fixtures for the mailstore tests.
+
+Every storage test runs on a fresh SQLite file, and on MySQL when TEST_DB_NAME
+names a scratch database with the schema of init.sql. That database is emptied
+before each test; it is reached with DB_HOST, DB_USER, DB_PASSWORD and
+DB_CHARSET like the services. The MySQL cases are skipped otherwise.
+
+The api fixture serves the same storage through the Flask app of flask_app/,
+and ingest stores into it with the modules of postfix/.
+"""
+
+import importlib, os, sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'flask_app'))
+sys.path.insert(0, os.path.join(ROOT, 'postfix'))
+
+from mailstore import create_storage
+from mailstore.replication import ReadRouter
+
+API_KEY = 'test-key'
+
+# Emptied before each MySQL test; stats_counters is reset instead
+TABLES = ['email_search', 'email_parts', 'email_attachments', 'attachment_blobs', 'email_recipients',
+          'recipient_stats', 'domain_stats', 'emails']
+
+
+def message(to='alice@example.com', subject='Hello', body='Hello there', received='2024-01-01 10:00:00',
+            cc=(), attachments=(), key=None, envelope_to=None, sender='sender@example.org'):
+    """A parsed message as MailJson.parse returns it; attachments are (filename, bytes) pairs."""
+    return {
+        'from': [{'email': sender, 'name': None}],
+        'reply-to': [],
+        'to': [{'email': to, 'name': None}] if to else [],
+        'cc': [{'email': address, 'name': None} for address in cc],
+        'datetime': received,
+        'subject': subject,
+        'headers': {'subject': subject, 'to': to or '', 'from': sender},
+        'encoding': 'utf-8',
+        'parts': [{'headers': {'content-type': 'text/plain'}, 'content_type': 'text/plain', 'content': body}],
+        'attachments': [{'filename': filename, 'content_type': 'application/octet-stream', 'content': content}
+                        for filename, content in attachments],
+        'idempotency-key': key,
+        'envelope-to': envelope_to,
+    }
+
+
+def raw_message(subject='Hello', to='alice@example.com', body='Hello there', message_id=None):
+    """An RFC 5322 message as postfix delivers it, with bare LF line endings."""
+    return (f"From: sender@example.org\nTo: {to}\nSubject: {subject}\n"
+            f"Message-ID: <{message_id or subject.replace(' ', '.')}@example.org>\n"
+            f"Date: Mon, 01 Jan 2024 10:00:00 +0000\nContent-Type: text/plain\n\n{body}\n").encode('utf-8')
+
+
+def _sqlite_storage(tmp_path):
+    return create_storage('sqlite', path=str(tmp_path / 'emails.db'))
+
+
+def _mysql_storage(tmp_path):
+    database = os.getenv('TEST_DB_NAME')
+    if not database:
+        pytest.skip("TEST_DB_NAME names no scratch MySQL database")
+    try:
+        storage = create_storage('mysql', database=database)
+        with storage.transaction() as cursor:
+            for table in TABLES:
+                cursor.execute(f"DELETE FROM {table}")
+            cursor.execute("UPDATE stats_counters SET value = 0")
+    except Exception as e:
+        pytest.skip("MySQL is unreachable: %s" % e)
+    return storage
+
+
+@pytest.fixture(params=['sqlite', 'mysql'])
+def storage(request, tmp_path, monkeypatch):
+    for variable in ['SQLITE_REPLICA_PATHS', 'DB_REPLICA_HOSTS']:
+        monkeypatch.delenv(variable, raising=False)
+    if request.param == 'sqlite':
+        return _sqlite_storage(tmp_path)
+    return _mysql_storage(tmp_path)
+
+
+@pytest.fixture
+def api(storage, tmp_path, monkeypatch):
+    """flask_app/app.py serving storage, with an empty response cache and neither mail events listener nor sweep."""
+    pytest.importorskip('flask')
+    # Only read when app is first imported; the module level storage is replaced below
+    monkeypatch.setenv('STORAGE_BACKEND', 'sqlite')
+    monkeypatch.setenv('SQLITE_PATH', str(tmp_path / 'unused.db'))
+    monkeypatch.setenv('MAIL_EVENTS_PORT', '0')
+    monkeypatch.setenv('MAIL_EVENTS_SWEEP_INTERVAL', '0')
+    app = importlib.import_module('app')
+    from response_cache import ResponseCache
+    from mail_events import MailboxWaiters
+    monkeypatch.setattr(app, 'storage', storage)
+    monkeypatch.setattr(app, 'reads', ReadRouter(storage))
+    monkeypatch.setattr(app, 'response_cache', ResponseCache())
+    monkeypatch.setattr(app, 'mailbox_waiters', MailboxWaiters())
+    monkeypatch.setattr(app, 'API_KEY', API_KEY)
+    return app
+
+
+@pytest.fixture
+def client(api):
+    return api.app.test_client()
+
+
+def get(client, path, headers=None, **params):
+    """GET path with the API key and the given query parameters."""
+    return client.get(path, query_string=dict(params, api_key=API_KEY), headers=headers)
+
+
+@pytest.fixture
+def email_processor(tmp_path, monkeypatch):
+    """postfix/email_processor.py; its module level storage is not meant to be used."""
+    # Only read when email_processor is first imported
+    monkeypatch.setenv('STORAGE_BACKEND', 'sqlite')
+    monkeypatch.setenv('SQLITE_PATH', str(tmp_path / 'unused.db'))
+    monkeypatch.setenv('EMAIL_PROCESSOR_LOG', str(tmp_path / 'email_processor.log'))
+    return importlib.import_module('email_processor')
+
+
+@pytest.fixture
+def ingest(email_processor, storage, monkeypatch):
+    """postfix/email_processor.py storing into storage, without notifying the API."""
+    import notify
+    monkeypatch.setattr(notify, 'MAIL_EVENTS_ADDR', '')
+    monkeypatch.setattr(email_processor, 'storage', storage)
+    return email_processor
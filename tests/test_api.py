@@ -0,0 +1,126 @@
+"""Request validation and responses of the Flask API, on the storage fixture."""
+
+import pytest
+
+from conftest import message, get
+
+
+@pytest.mark.parametrize('params', [{'timeout': 'nan'}, {'timeout': 'inf'}, {'timeout': '-1'}, {'timeout': 'soon'},
+                                    {'limit': '0'}, {'limit': '-1'}, {'limit': '100000'}, {'limit': '1.5'}])
+def test_wait_rejects_invalid_timeout_and_limit(client, params):
+    response = get(client, '/emails/wait', to_email='alice@example.com', **params)
+    assert response.status_code == 400
+
+
+def test_wait_returns_stored_mail_at_once(client, storage):
+    first = storage.insert_email(message())
+    second = storage.insert_email(message(subject='Second'))
+    response = get(client, '/emails/wait', to_email='alice@example.com', limit='1', timeout='5')
+    assert response.status_code == 200
+    assert [email['email']['id'] for email in response.json['emails']] == [first]
+
+    response = get(client, '/emails/wait', to_email='alice@example.com', since=response.json['cursor'], timeout='5')
+    assert [email['email']['id'] for email in response.json['emails']] == [second]
+
+
+def test_wait_times_out_empty(client):
+    response = get(client, '/emails/wait', to_email='nobody@example.com', timeout='0')
+    assert response.status_code == 200
+    assert response.json == {'count': 0, 'cursor': None, 'emails': []}
+
+
+def test_unchanged_mailbox_is_served_from_the_cache(api, client, storage, monkeypatch):
+    storage.insert_email(message())
+    first = get(client, '/emails', to_email='alice@example.com')
+    assert first.status_code == 200 and first.headers['ETag']
+
+    # Hits and 304s run no query
+    monkeypatch.setattr(api, 'reads', None)
+    assert get(client, '/emails', to_email='alice@example.com').data == first.data
+    response = get(client, '/emails', headers={'If-None-Match': first.headers['ETag']}, to_email='alice@example.com')
+    assert response.status_code == 304
+    assert response.headers['ETag'] == first.headers['ETag']
+    assert response.data == b''
+
+
+def test_stored_event_drops_the_cached_page(api, client, storage):
+    assert get(client, '/emails', to_email='alice@example.com').status_code == 404
+    storage.insert_email(message())
+    assert get(client, '/emails', to_email='alice@example.com').status_code == 404
+    api.on_mail_event({'event': 'stored', 'recipients': ['Alice@example.com']})
+    assert get(client, '/emails', to_email='alice@example.com').json['count'] == 1
+
+
+def test_sweep_stands_in_for_a_lost_notification(api, client, storage):
+    import mail_events
+    sweep = mail_events.MailSweep(storage, interval=0, max_emails=2)
+    mail_events.subscribe(api.on_mail_event)
+    try:
+        sweep.sweep()
+        assert get(client, '/emails', to_email='alice@example.com').status_code == 404
+        assert get(client, '/emails', to_email='bob@example.com').status_code == 404
+
+        storage.insert_email(message(to='bob@example.com', cc=['alice@example.com']))
+        sweep.sweep()
+        assert get(client, '/emails', to_email='alice@example.com').json['count'] == 1
+        first = get(client, '/emails', to_email='bob@example.com')
+        assert first.json['count'] == 1
+
+        # Too many to list: every mailbox is dropped
+        for _ in range(3):
+            storage.insert_email(message(to='carol@example.com'))
+        api.response_cache.put('bob@example.com', 'stale', 200, b'{}', 'etag', api.response_cache.generation())
+        sweep.sweep()
+        assert api.response_cache.get('bob@example.com', 'stale') is None
+    finally:
+        mail_events._callbacks.remove(api.on_mail_event)
+
+
+@pytest.fixture
+def attachment(api, storage, monkeypatch):
+    """(url, content) of a 3000 byte attachment, read 1024 bytes per query and sent 100 at a time."""
+    content = bytes(range(250)) * 12
+    email_id = storage.insert_email(message(attachments=[('data.bin', content)]))
+    with storage.cursor() as cursor:
+        [row] = storage.select_attachments(cursor, [email_id])[email_id]
+    monkeypatch.setattr(api, 'ATTACHMENT_READ_SIZE', 1024)
+    monkeypatch.setattr(api, 'ATTACHMENT_CHUNK_SIZE', 100)
+    return api.attachment_url(row), content
+
+
+def count_blob_reads(storage, monkeypatch):
+    reads = []
+    read_blob = storage.read_blob
+
+    def counted(cursor, digest, offset, length):
+        reads.append((offset, length))
+        return read_blob(cursor, digest, offset, length)
+
+    monkeypatch.setattr(storage, 'read_blob', counted)
+    return reads
+
+
+def test_attachment_is_streamed_in_read_size_windows(client, storage, attachment, monkeypatch):
+    url, content = attachment
+    blob_reads = count_blob_reads(storage, monkeypatch)
+    response = get(client, url)
+    assert response.status_code == 200
+    assert response.headers['Content-Length'] == '3000'
+    assert response.data == content
+    assert blob_reads == [(0, 1024), (1024, 1024), (2048, 952)]
+
+
+def test_attachment_range(client, storage, attachment, monkeypatch):
+    url, content = attachment
+    blob_reads = count_blob_reads(storage, monkeypatch)
+    response = get(client, url, headers={'Range': 'bytes=1000-2499'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == 'bytes 1000-2499/3000'
+    assert response.data == content[1000:2500]
+    assert blob_reads == [(1000, 1024), (2024, 476)]
+
+    etag = response.headers['ETag']
+    assert get(client, url, headers={'Range': 'bytes=-10', 'If-Range': etag}).data == content[-10:]
+    assert get(client, url, headers={'Range': 'bytes=0-9', 'If-Range': '"other"'}).status_code == 200
+    assert get(client, url, headers={'Range': 'bytes=5000-'}).status_code == 416
+    assert get(client, url, headers={'If-None-Match': etag}).status_code == 304
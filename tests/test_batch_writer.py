@@ -0,0 +1,94 @@
+"""Group-commit of LMTP deliveries (postfix/batch_writer.py)."""
+
+import threading
+
+import pytest
+
+from conftest import message
+
+
+def stored(storage):
+    """{email id: subject} of the stored emails."""
+    with storage.cursor() as cursor:
+        cursor.execute("SELECT id, subject FROM emails")
+        return {row['id']: row['subject'] for row in cursor.fetchall()}
+
+
+def stored_subjects(storage):
+    return sorted(stored(storage).values())
+
+
+@pytest.fixture
+def batch_writer(ingest):
+    import batch_writer
+    return batch_writer
+
+
+def insert_concurrently(writer, subjects):
+    results = {}
+
+    def insert(subject):
+        results[subject] = writer.insert(message(subject=subject))
+
+    threads = [threading.Thread(target=insert, args=(subject,)) for subject in subjects]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_deliveries_share_a_batch(batch_writer, storage, monkeypatch):
+    batches = []
+    insert_email_batch = batch_writer.insert_email_batch
+    monkeypatch.setattr(batch_writer, 'insert_email_batch',
+                        lambda batch: batches.append(len(batch)) or insert_email_batch(batch))
+    writer = batch_writer.BatchWriter(batch_size=10, max_latency_ms=200)
+    results = insert_concurrently(writer, ['Message %d' % i for i in range(5)])
+    writer.close()
+    assert batches == [5]
+    assert stored(storage) == {email_id: subject for subject, email_id in results.items()}
+
+
+def test_failed_batch_is_retried_one_message_at_a_time(batch_writer, storage, monkeypatch):
+    def failing(batch):
+        raise ValueError("deadlock")
+
+    insert_email_data = batch_writer.insert_email_data
+    monkeypatch.setattr(batch_writer, 'insert_email_batch', failing)
+    monkeypatch.setattr(batch_writer, 'insert_email_data',
+                        lambda data: None if data['subject'] == 'Poison' else insert_email_data(data))
+    writer = batch_writer.BatchWriter(batch_size=3, max_latency_ms=200)
+    results = insert_concurrently(writer, ['First', 'Poison', 'Last'])
+    writer.close()
+    assert results.pop('Poison') is None
+    assert stored(storage) == {email_id: subject for subject, email_id in results.items()}
+
+
+def test_close_flushes_queued_messages(batch_writer, storage):
+    writer = batch_writer.BatchWriter(batch_size=10, max_latency_ms=60000)
+    pending = [writer.submit(message(subject='Message %d' % i)) for i in range(3)]
+    writer.close()
+    assert stored(storage) == {p.wait(0): 'Message %d' % i for i, p in enumerate(pending)}
+    writer.close()
+
+
+def test_deliveries_after_close_are_stored_on_their_own(batch_writer, storage):
+    writer = batch_writer.BatchWriter()
+    writer.close()
+    with pytest.raises(RuntimeError):
+        writer.submit(message())
+    email_id = writer.insert(message(subject='Late'))
+    assert stored(storage) == {email_id: 'Late'}
+
+
+def test_insert_gives_up_on_a_batch_that_does_not_finish(batch_writer, storage, monkeypatch):
+    release = threading.Event()
+    insert_email_batch = batch_writer.insert_email_batch
+    monkeypatch.setattr(batch_writer, 'insert_email_batch', lambda batch: release.wait() and insert_email_batch(batch))
+    writer = batch_writer.BatchWriter(max_latency_ms=0, wait_timeout=0.05)
+    assert writer.insert(message(subject='Slow')) is None
+    release.set()
+    writer.close()
+    # Committed after all; postfix's retry is deduplicated by its idempotency key
+    assert stored_subjects(storage) == ['Slow']
@@ -0,0 +1,145 @@
+"""The LMTP session state machine of postfix/lmtp_server.py, over a socket pair."""
+
+import json, os, socket, threading
+
+import pytest
+
+from conftest import raw_message
+
+
+class Session:
+    """The client end of one LMTP session served by LMTPHandler in a thread."""
+
+    def __init__(self, lmtp_server):
+        client, server = socket.socketpair()
+        self.thread = threading.Thread(target=lmtp_server.LMTPHandler, args=(server, 'test', None), daemon=True)
+        self.thread.start()
+        self.file = client.makefile('rwb')
+        self.greeting = self.reply()
+
+    def send(self, data):
+        self.file.write(data)
+        self.file.flush()
+
+    def reply(self):
+        """The lines of the next reply."""
+        lines = []
+        while not lines or lines[-1][3:4] == '-':
+            lines.append(self.file.readline().decode('ascii').rstrip('\r\n'))
+        return lines
+
+    def command(self, line):
+        self.send(line.encode('ascii') + b'\r\n')
+        return self.reply()
+
+    def data(self, raw, recipients):
+        """Send DATA and the dot-stuffed message; the replies, one per recipient."""
+        assert self.command('DATA')[0].startswith('354')
+        lines = raw.split(b'\n')
+        if lines[-1] == b'':
+            lines.pop()
+        self.send(b''.join((b'.' + line if line.startswith(b'.') else line) + b'\r\n' for line in lines) + b'.\r\n')
+        return [self.reply()[0] for _ in range(recipients)]
+
+    def close(self):
+        assert self.command('QUIT') == ['221 2.0.0 Bye']
+        self.thread.join(5)
+        self.file.close()
+
+
+@pytest.fixture
+def lmtp_server(ingest, monkeypatch):
+    import lmtp_server
+    monkeypatch.setattr(lmtp_server, 'spool', None)
+    monkeypatch.setattr(lmtp_server, 'writer', None)
+    return lmtp_server
+
+
+def stored(storage):
+    with storage.cursor() as cursor:
+        cursor.execute("SELECT id FROM emails ORDER BY id")
+        email_ids = [row['id'] for row in cursor.fetchall()]
+        return [(email_id, parts) for email_id, parts in storage.select_parts(cursor, email_ids).items()]
+
+
+def test_delivery_answers_for_every_recipient(lmtp_server, storage):
+    session = Session(lmtp_server)
+    assert session.greeting[0].startswith('220 ')
+    assert session.command('LHLO postfix')[-1] == '250 8BITMIME'
+    assert session.command('MAIL FROM:<sender@example.org> BODY=8BITMIME') == ['250 2.1.0 Ok']
+    assert session.command('RCPT TO:<alice@example.com>') == ['250 2.1.5 Ok']
+    assert session.command('RCPT TO:<bob@example.com>') == ['250 2.1.5 Ok']
+    raw = raw_message(body='Hello\n.\n..two dots\n.leading dot')
+    assert session.data(raw, 2) == ['250 2.0.0 Ok: delivered'] * 2
+
+    # The next message of the same session starts from scratch
+    assert session.command('DATA') == ['503 5.5.1 Error: need RCPT command']
+    session.close()
+
+    [(email_id, [part])] = stored(storage)
+    assert json.loads(part['content']) == 'Hello...two dots.leading dot'
+    with storage.cursor() as cursor:
+        # bob is an envelope recipient only
+        assert storage.count_emails(cursor, 'bob@example.com', 'exact', ['bcc']) == 1
+
+
+def test_commands_out_of_order_are_refused(lmtp_server, storage):
+    session = Session(lmtp_server)
+    assert session.command('RCPT TO:<alice@example.com>') == ['503 5.5.1 Error: need MAIL command']
+    assert session.command('MAIL FROM:<sender@example.org>') == ['250 2.1.0 Ok']
+    assert session.command('DATA') == ['503 5.5.1 Error: need RCPT command']
+    assert session.command('RCPT TO:<alice@example.com>') == ['250 2.1.5 Ok']
+    assert session.command('RSET') == ['250 2.0.0 Ok']
+    assert session.command('RCPT TO:<alice@example.com>') == ['503 5.5.1 Error: need MAIL command']
+    assert session.command('DATA') == ['503 5.5.1 Error: need RCPT command']
+    assert session.command('NOOP') == ['250 2.0.0 Ok']
+    assert session.command('VRFY alice') == ['252 2.0.0 Cannot VRFY user']
+    assert session.command('EXPN list') == ['500 5.5.2 Error: command not recognized']
+    session.close()
+    assert stored(storage) == []
+
+
+def test_line_too_long_rejects_the_message_not_the_session(lmtp_server, storage):
+    session = Session(lmtp_server)
+    session.command('MAIL FROM:<sender@example.org>')
+    session.command('RCPT TO:<alice@example.com>')
+    session.command('RCPT TO:<bob@example.com>')
+    long_line = b'x' * (lmtp_server.MAX_LINE_LENGTH + 10)
+    assert session.data(raw_message(body=long_line.decode('ascii')), 2) == ['500 5.5.2 Error: line too long'] * 2
+    assert stored(storage) == []
+
+    session.command('MAIL FROM:<sender@example.org>')
+    session.command('RCPT TO:<alice@example.com>')
+    assert session.data(raw_message(body='Short'), 1) == ['250 2.0.0 Ok: delivered']
+    session.close()
+    assert len(stored(storage)) == 1
+
+
+def test_failed_insert_is_a_temporary_failure(lmtp_server, storage, monkeypatch):
+    monkeypatch.setattr(lmtp_server, 'insert_email_data', lambda data: None)
+    session = Session(lmtp_server)
+    session.command('MAIL FROM:<sender@example.org>')
+    session.command('RCPT TO:<alice@example.com>')
+    session.command('RCPT TO:<bob@example.com>')
+    assert session.data(raw_message(), 2) == ['451 4.3.0 Error: temporary failure, try again later'] * 2
+    session.close()
+
+
+def test_spool_mode_acknowledges_once_spooled(lmtp_server, storage, tmp_path, monkeypatch):
+    from spool import Spool, read_records, idempotency_key
+    spool = Spool(str(tmp_path / 'spool'))
+    monkeypatch.setattr(lmtp_server, 'spool', spool)
+    session = Session(lmtp_server)
+    session.command('MAIL FROM:<sender@example.org>')
+    session.command('RCPT TO:<Alice@example.com>')
+    raw = raw_message(body='.leading dot')
+    assert session.data(raw, 1) == ['250 2.0.0 Ok: delivered']
+    session.close()
+    spool.close()
+
+    assert stored(storage) == []
+    [segment] = [name for name in os.listdir(spool.directory) if name.endswith('.seg')]
+    [(meta, body, _)] = read_records(os.path.join(spool.directory, segment))
+    assert body == raw
+    assert meta['envelope-to'] == ['Alice@example.com']
+    assert meta['key'] == idempotency_key('<Hello@example.org>', ['Alice@example.com'], raw)
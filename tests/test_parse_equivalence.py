@@ -0,0 +1,45 @@
+"""The MailJson fast path parses exactly like the original code paths (MAILJSON_FAST_PATH=0).
+
+A smaller run of benchmarks/check_parse_equivalence.py, which compares more
+messages and address strings and can take a directory of real ones.
+"""
+
+import os, random, sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+import corpus
+from check_parse_equivalence import EDGE_CASES, FUZZ_ALPHABET, parse_outcome, recipients_outcome
+
+
+@pytest.fixture
+def email_processor(email_processor, monkeypatch):
+    # parse_outcome and recipients_outcome switch it; put it back afterwards
+    monkeypatch.setattr(email_processor, 'MAILJSON_FAST_PATH', True)
+    return email_processor
+
+
+def address_strings(count, seed=1):
+    rnd = random.Random(seed)
+    return EDGE_CASES + ["".join(rnd.choice(FUZZ_ALPHABET) for _ in range(rnd.randrange(1, 16))) for _ in range(count)]
+
+
+@pytest.mark.parametrize('kind', corpus.KINDS)
+def test_corpus_messages_parse_the_same(email_processor, kind):
+    messages = [message for message in corpus.generate(60, max_attachment_bytes=corpus.KB) if message.kind == kind]
+    assert messages
+    for message in messages:
+        assert parse_outcome(email_processor, message.raw, True) == parse_outcome(email_processor, message.raw, False)
+
+
+def test_is_email_agrees_with_email_re(email_processor):
+    for value in address_strings(5000):
+        assert email_processor._is_email(value) == (email_processor.email_re.match(value) is not None), value
+
+
+def test_recipients_parse_the_same(email_processor):
+    for value in address_strings(5000):
+        assert (recipients_outcome(email_processor, value, True) ==
+                recipients_outcome(email_processor, value, False)), value
@@ -0,0 +1,120 @@
+"""Read routing between the primary and replicas, on SQLite copies of the primary as the replicas."""
+
+import sqlite3
+
+import pytest
+
+from mailstore import create_storage
+from mailstore.replication import ReadRouter
+
+from conftest import message, get
+
+
+def copy_database(source, target):
+    with sqlite3.connect(source) as primary, sqlite3.connect(target) as replica:
+        primary.backup(replica)
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    primary = str(tmp_path / 'emails.db')
+    create_storage('sqlite', path=primary).insert_email(message())
+    copy_database(primary, str(tmp_path / 'replica.db'))
+    monkeypatch.setenv('SQLITE_REPLICA_PATHS', str(tmp_path / 'replica.db'))
+    return create_storage('sqlite', path=primary)
+
+
+def newest_seen(router, addresses=()):
+    with router.cursor(addresses) as cursor:
+        return router.storage.newest_email_id(cursor)
+
+
+def test_reads_stay_on_the_primary_until_a_replica_is_checked(storage):
+    router = ReadRouter(storage, max_lag=5, sticky=0)
+    newest = storage.insert_email(message())
+    assert router.enabled
+    assert router.lags() == {'replica:' + storage.replicas[0].path: None}
+    assert newest_seen(router) == newest
+
+
+def test_replica_serves_reads_once_it_holds_the_newest_email(storage, tmp_path):
+    router = ReadRouter(storage, max_lag=5, sticky=0)
+    router.check()
+    [lag] = router.lags().values()
+    assert 0 <= lag < 5
+    with router.cursor() as cursor:
+        with pytest.raises(sqlite3.OperationalError):
+            cursor.execute("DELETE FROM emails")
+
+    # Behind the new email, it still serves reads that cannot be about it
+    newest = storage.insert_email(message(to='bob@example.com'))
+    router.wrote(['Bob@example.com'])
+    router.check()
+    assert newest_seen(router) == newest - 1
+    assert newest_seen(router, ['alice@example.com']) == newest - 1
+    assert newest_seen(router, ['bob@example.com']) == newest
+
+    copy_database(storage.path, str(tmp_path / 'replica.db'))
+    router.check()
+    assert newest_seen(router, ['bob@example.com']) == newest
+
+
+def test_lagging_or_stopped_replicas_get_no_reads(storage, monkeypatch):
+    router = ReadRouter(storage, max_lag=0, sticky=0)
+    router.check()
+    newest = storage.insert_email(message())
+    assert newest_seen(router) == newest
+
+    router.max_lag = 5
+    monkeypatch.setattr(storage, 'replication_delay', lambda cursor: None)
+    router.check()
+    assert list(router.lags().values()) == [None]
+    assert newest_seen(router) == newest
+
+
+def test_unreachable_replica_gets_no_reads(storage, tmp_path, monkeypatch):
+    monkeypatch.setenv('SQLITE_REPLICA_PATHS', str(tmp_path / 'missing' / 'replica.db'))
+    storage = create_storage('sqlite', path=storage.path)
+    router = ReadRouter(storage, max_lag=5, sticky=0)
+    router.check()
+    assert list(router.lags().values()) == [None]
+    assert newest_seen(router) == 1
+
+
+def test_stale_rows_are_served_as_rendered_on_the_primary(api, client, storage, tmp_path):
+    # As after the migration adding the rendered columns, on the primary and the replica
+    with storage.transaction() as cursor:
+        cursor.execute("UPDATE emails SET render_version = NULL, rendered_headers = NULL")
+        cursor.execute("UPDATE email_parts SET rendered_headers = NULL, rendered_content = NULL")
+    copy_database(storage.path, str(tmp_path / 'replica.db'))
+    api.reads.check()
+
+    [email] = get(client, '/emails', to_email='alice@example.com').json['emails']
+    assert email['email']['raw_headers']['subject'] == 'Hello'
+    assert [(part['headers'], part['content']) for part in email['parts']] == [({'content_type': 'text/plain'}, 'Hello there')]
+    with storage.cursor() as cursor:
+        assert storage.stale_email_ids(cursor, 10) == []
+    with api.reads.cursor(['alice@example.com']) as cursor:
+        assert storage.stale_email_ids(cursor, 10) == [email['email']['id']]
+
+
+class SlaveStatusCursor:
+    def __init__(self, row):
+        self.row = row
+
+    def execute(self, sql, params=None):
+        assert sql == "SHOW SLAVE STATUS"
+
+    def fetchone(self):
+        return self.row
+
+
+@pytest.mark.parametrize('row, delay', [(None, None), ({'Seconds_Behind_Master': None}, None),
+                                        ({'Seconds_Behind_Master': 3}, 3)])
+def test_mysql_replication_delay(row, delay):
+    pytest.importorskip('pymysql')
+    pytest.importorskip('dbutils')
+    from mailstore.mysql import MySQLStorage
+    # The pool connects on first use only
+    storage = MySQLStorage(host='127.0.0.1', database='emails')
+    assert storage.replication_delay(SlaveStatusCursor(row)) == delay
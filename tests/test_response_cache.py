@@ -0,0 +1,80 @@
+"""The in-process cache of rendered GET /emails responses (flask_app/response_cache.py)."""
+
+from response_cache import ResponseCache
+
+
+def put(cache, recipient, key, body=b'{}', generation=None):
+    generation = cache.generation() if generation is None else generation
+    cache.put(recipient, key, 200, body, 'etag-' + key, generation)
+
+
+def test_get_returns_what_was_put():
+    cache = ResponseCache()
+    assert cache.get('alice@example.com', 'page') is None
+    put(cache, 'alice@example.com', 'page', b'{"emails": []}')
+    entry = cache.get('alice@example.com', 'page')
+    assert (entry.status, entry.body, entry.etag) == (200, b'{"emails": []}', 'etag-page')
+    assert cache.get('bob@example.com', 'page') is None
+
+
+def test_invalidate_drops_only_that_recipient():
+    cache = ResponseCache()
+    put(cache, 'alice@example.com', 'page')
+    put(cache, 'alice@example.com', 'other')
+    put(cache, 'bob@example.com', 'page')
+    cache.invalidate('alice@example.com')
+    assert cache.get('alice@example.com', 'page') is None
+    assert cache.get('alice@example.com', 'other') is None
+    assert cache.get('bob@example.com', 'page') is not None
+
+    cache.invalidate_all()
+    assert cache.get('bob@example.com', 'page') is None
+
+
+def test_response_rendered_before_a_change_is_not_stored():
+    cache = ResponseCache()
+    generation = cache.generation()
+    cache.invalidate('alice@example.com')
+    put(cache, 'alice@example.com', 'page', generation=generation)
+    put(cache, 'bob@example.com', 'page', generation=generation)
+    assert cache.get('alice@example.com', 'page') is None
+    assert cache.get('bob@example.com', 'page') is not None
+
+    generation = cache.generation()
+    cache.invalidate_all()
+    put(cache, 'bob@example.com', 'page', generation=generation)
+    assert cache.get('bob@example.com', 'page') is None
+
+
+def test_forgotten_invalidations_still_refuse_older_responses():
+    cache = ResponseCache(max_entries=1)
+    generation = cache.generation()
+    for i in range(20):
+        cache.invalidate('user%d@example.com' % i)
+    put(cache, 'user0@example.com', 'page', generation=generation)
+    assert cache.get('user0@example.com', 'page') is None
+
+
+def test_entries_expire_after_ttl():
+    cache = ResponseCache(ttl=30)
+    put(cache, 'alice@example.com', 'page')
+    cache.get('alice@example.com', 'page').stored_at -= 31
+    assert cache.get('alice@example.com', 'page') is None
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = ResponseCache(max_entries=2, max_bytes=10)
+    put(cache, 'alice@example.com', 'a')
+    put(cache, 'alice@example.com', 'b')
+    cache.get('alice@example.com', 'a')
+    put(cache, 'alice@example.com', 'c')
+    assert cache.get('alice@example.com', 'b') is None
+    assert cache.get('alice@example.com', 'a') is not None
+
+    put(cache, 'bob@example.com', 'big', b'x' * 9)
+    assert cache.get('bob@example.com', 'big') is not None
+    assert cache.get('alice@example.com', 'a') is None
+    assert cache.get('alice@example.com', 'c') is None
+
+    put(cache, 'bob@example.com', 'huge', b'x' * 11)
+    assert cache.get('bob@example.com', 'huge') is None
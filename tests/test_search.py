@@ -0,0 +1,36 @@
+"""Query parsing and text extraction for full-text search."""
+
+import pytest
+
+from mailstore.search import Term, parse_query, fts5_query, boolean_query, extract_text
+
+
+def test_parse_query_terms():
+    assert parse_query('Invoice  "planning   meeting" plan* abc-123 "multi word"*') == [
+        Term('Invoice', False), Term('planning meeting', False), Term('plan', True), Term('abc-123', False),
+        Term('multi word', True)]
+
+
+@pytest.mark.parametrize('query', ['', '   ', '"" * -- "..."'])
+def test_parse_query_needs_a_word(query):
+    with pytest.raises(ValueError):
+        parse_query(query)
+
+
+def test_parse_query_limits_terms():
+    with pytest.raises(ValueError):
+        parse_query(' '.join('word%d' % i for i in range(17)))
+
+
+def test_engine_queries():
+    terms = parse_query('a.b@c.org plan* "two words"*')
+    assert fts5_query(terms) == '"a.b@c.org" "plan"* "two words"*'
+    assert boolean_query(terms) == '+"a.b@c.org" +plan* +"two words"'
+
+
+def test_extract_text_prefers_plain_parts():
+    html = {'content_type': 'text/html', 'content': '<script>skip()</script><b>Bold</b> &amp; text'}
+    plain = {'content_type': 'text/plain', 'content': 'Plain\n\n  text'}
+    assert extract_text([html, plain]) == 'Plain text'
+    assert extract_text([html]) == 'Bold & text'
+    assert extract_text([]) == ''
@@ -0,0 +1,226 @@
+"""The ingest spool (postfix/spool.py) and its replay into the database (postfix/replay.py)."""
+
+import json, os, shutil, threading, time
+
+import pytest
+
+from conftest import raw_message
+
+
+def spooled(subject, to='alice@example.com'):
+    """(meta, body) of a message as the LMTP server spools it."""
+    from spool import idempotency_key
+    body = raw_message(subject, to)
+    meta = {"envelope-to": [to], "sender": "sender@example.org", "spooled_at": time.time(),
+            "key": idempotency_key('<%s@example.org>' % subject, [to], body)}
+    return meta, body
+
+
+def write_segment(directory, name, records):
+    """A segment holding records, as a crashed process leaves it."""
+    from spool import encode_record
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as f:
+        for meta, body in records:
+            f.write(encode_record(meta, body))
+    return path
+
+
+def eventually(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def stored_subjects(storage):
+    with storage.cursor() as cursor:
+        cursor.execute("SELECT subject FROM emails ORDER BY id")
+        return [row['subject'] for row in cursor.fetchall()]
+
+
+def segments(directory):
+    return sorted(filename for filename in os.listdir(directory) if filename.endswith(('.seg', '.open')))
+
+
+def test_read_records_stops_at_a_torn_or_corrupt_record(tmp_path):
+    from spool import read_records
+    records = [spooled('First'), spooled('Second'), spooled('Third')]
+    path = write_segment(str(tmp_path), 'a.seg', records)
+    read = list(read_records(path))
+    assert [(meta, body) for meta, body, _ in read] == records
+    assert read[-1][2] == os.path.getsize(path)
+    assert [body for _, body, _ in read_records(path, read[0][2])] == [records[1][1], records[2][1]]
+    assert [body for _, body, _ in read_records(path, 0, read[1][2])] == [records[0][1], records[1][1]]
+
+    # A crash while appending the third record
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 3)
+    assert len(list(read_records(path))) == 2
+
+    # A flipped bit in the second: its crc no longer matches
+    with open(path, 'r+b') as f:
+        f.seek(read[0][2] + 20)
+        byte = f.read(1)
+        f.seek(-1, os.SEEK_CUR)
+        f.write(bytes([byte[0] ^ 1]))
+    assert len(list(read_records(path))) == 1
+
+
+def test_concurrent_appends_share_fsyncs(tmp_path, monkeypatch):
+    import spool as spool_module
+    from spool import Spool, read_records
+    fsyncs = []
+    fsync = os.fsync
+    monkeypatch.setattr(spool_module.os, 'fsync', lambda fd: fsyncs.append(fd) or fsync(fd))
+    spool = Spool(str(tmp_path), fsync_interval_ms=50)
+    start = threading.Barrier(20)
+
+    def append(i):
+        start.wait()
+        spool.append(*spooled('Message %d' % i))
+
+    threads = [threading.Thread(target=append, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    spool.close()
+    # The segment directory is synced when the segment is created and when it is sealed
+    assert len(fsyncs) - 2 < 20
+    [segment] = segments(str(tmp_path))
+    assert segment.endswith('.seg')
+    assert len(list(read_records(os.path.join(str(tmp_path), segment)))) == 20
+
+
+def test_full_segments_are_sealed(tmp_path):
+    from spool import Spool
+    spool = Spool(str(tmp_path), segment_bytes=1)
+    for i in range(3):
+        spool.append(*spooled('Message %d' % i))
+    spool.close()
+    assert [name.rsplit('.', 1)[1] for name in segments(str(tmp_path))] == ['seg'] * 3
+
+
+@pytest.fixture
+def replay(ingest, storage, monkeypatch):
+    """start(directory, **options) runs a Replayer over a Spool of directory; the ones left running are closed."""
+    import replay as replay_module
+    monkeypatch.setattr(replay_module, 'storage', storage)
+    started = []
+
+    def start(directory, **kwargs):
+        from spool import Spool
+        spool = Spool(directory)
+        replayer = replay_module.Replayer(spool, **dict(dict(retry_interval=0.01, status_interval=3600), **kwargs))
+        started.append((replayer, spool))
+        return replayer, spool
+
+    yield start
+    for replayer, spool in started:
+        if replayer._thread.is_alive():
+            replayer.close()
+            spool.close()
+
+
+def stop(replayer, spool):
+    replayer.close()
+    spool.close()
+
+
+def test_replay_stores_spooled_mail_and_drops_the_segments(replay, storage, tmp_path):
+    directory = str(tmp_path / 'spool')
+    os.makedirs(directory)
+    write_segment(directory, '%020d-1.seg' % 1, [spooled('First'), spooled('Second')])
+    replayer, spool = replay(directory, batch_size=1)
+    spool.append(*spooled('Third'))
+    eventually(lambda: len(stored_subjects(storage)) == 3)
+    eventually(lambda: segments(directory) == [spool.segment + '.open'])
+    stop(replayer, spool)
+
+    assert stored_subjects(storage) == ['First', 'Second', 'Third']
+    assert replayer.replayed == 3
+    # Past everything in the segment that was open; the next start drops it
+    with open(os.path.join(directory, 'checkpoint.json')) as f:
+        assert json.load(f) == {spool.segment: os.path.getsize(os.path.join(directory, spool.segment + '.seg'))}
+    with open(os.path.join(directory, 'status.json')) as f:
+        status = json.load(f)
+    assert (status['pending_bytes'], status['replayed'], status['rejected']) == (0, 3, 0)
+
+
+def test_replay_resumes_from_the_checkpoint(replay, storage, tmp_path):
+    from spool import read_records
+    directory = str(tmp_path / 'spool')
+    os.makedirs(directory)
+    path = write_segment(directory, '%020d-1.seg' % 1, [spooled('First'), spooled('Second')])
+    first_end = next(read_records(path))[2]
+    with open(os.path.join(directory, 'checkpoint.json'), 'w') as f:
+        json.dump({'%020d-1' % 1: first_end}, f)
+
+    replayer, spool = replay(directory)
+    eventually(lambda: not os.path.exists(path))
+    stop(replayer, spool)
+    assert stored_subjects(storage) == ['Second']
+
+
+def test_replaying_twice_stores_each_message_once(replay, storage, tmp_path):
+    directory = str(tmp_path / 'spool')
+    os.makedirs(directory)
+    path = write_segment(directory, '%020d-1.seg' % 1, [spooled('First'), spooled('Second')])
+    copy = shutil.copy(path, str(tmp_path / 'copy.seg'))
+    replayer, spool = replay(directory)
+    eventually(lambda: not os.path.exists(path))
+    stop(replayer, spool)
+
+    # As if the process had died after the commit and before moving its checkpoint
+    shutil.copy(copy, path)
+    replayer, spool = replay(directory)
+    eventually(lambda: not os.path.exists(path))
+    stop(replayer, spool)
+    assert stored_subjects(storage) == ['First', 'Second']
+    assert replayer.replayed == 2
+
+
+def test_torn_tail_of_a_crashed_segment_is_moved_to_rejected(replay, storage, tmp_path):
+    directory = str(tmp_path / 'spool')
+    os.makedirs(directory)
+    # The open segment of a process that crashed while appending its second record
+    path = write_segment(directory, '%020d-999999.open' % 1, [spooled('First'), spooled('Second')])
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 5)
+    replayer, spool = replay(directory)
+    eventually(lambda: not os.path.exists(path))
+    stop(replayer, spool)
+
+    assert stored_subjects(storage) == ['First']
+    [corrupt] = os.listdir(os.path.join(directory, 'rejected'))
+    assert corrupt == os.path.basename(path) + '.corrupt'
+
+
+def test_message_failing_every_insert_is_moved_to_rejected(replay, storage, tmp_path, monkeypatch):
+    import replay as replay_module
+    from spool import read_records
+    insert_email_batch, insert_email_data = replay_module.insert_email_batch, replay_module.insert_email_data
+
+    def poisoned(batch):
+        if any(data['subject'] == 'Poison' for data in batch):
+            raise ValueError("cannot store Poison")
+        return insert_email_batch(batch)
+
+    monkeypatch.setattr(replay_module, 'insert_email_batch', poisoned)
+    monkeypatch.setattr(replay_module, 'insert_email_data',
+                        lambda data: None if data['subject'] == 'Poison' else insert_email_data(data))
+    directory = str(tmp_path / 'spool')
+    os.makedirs(directory)
+    poison = spooled('Poison')
+    path = write_segment(directory, '%020d-1.seg' % 1, [spooled('First'), poison, spooled('Last')])
+    replayer, spool = replay(directory, max_attempts=2)
+    eventually(lambda: not os.path.exists(path))
+    stop(replayer, spool)
+
+    assert stored_subjects(storage) == ['First', 'Last']
+    assert replayer.rejected == 1
+    [rejected] = segments(os.path.join(directory, 'rejected'))
+    [(meta, body, _)] = read_records(os.path.join(directory, 'rejected', rejected))
+    assert body == poison[1]
+    assert meta == dict(poison[0], rejected="insert failed 2 times")
@@ -0,0 +1,276 @@
+"""Storage behaviour both backends must share, see conftest.py for the backends under test."""
+
+from datetime import timedelta
+
+from mailstore.search import parse_query
+
+from conftest import message
+
+COLUMNS = ['id', 'subject', 'received_time']
+
+
+def store(storage, count, to='alice@example.com', **kwargs):
+    """Ids of count emails stored for to in one batch, one minute apart."""
+    return storage.insert_email_batch([message(to=to, subject='Message %d' % i,
+                                               received='2024-01-01 10:%02d:00' % i, **kwargs)
+                                       for i in range(count)])
+
+
+def page_ids(storage, address, scan_desc, limit, offset=0, position=None):
+    with storage.cursor() as cursor:
+        rows = storage.select_email_page(cursor, address, COLUMNS, scan_desc, limit, offset, position)
+    return [row['id'] for row in rows]
+
+
+def test_insert_email_batch_assigns_consecutive_ids(storage):
+    first = store(storage, 3)
+    second = store(storage, 2)
+    assert first == list(range(first[0], first[0] + 3))
+    assert second == list(range(first[-1] + 1, first[-1] + 3))
+    with storage.cursor() as cursor:
+        rows = storage.select_by_email_ids(cursor, 'emails', ['id AS email_id', 'subject'], first + second)
+    assert [rows[email_id][0]['subject'] for email_id in first + second] == [
+        'Message 0', 'Message 1', 'Message 2', 'Message 0', 'Message 1']
+
+
+def test_insert_email_batch_stores_each_idempotency_key_once(storage):
+    [stored] = storage.insert_email_batch([message(key='k1')])
+    ids = storage.insert_email_batch([message(key='k2'), message(key='k1'), message(), message(key='k2')])
+    assert ids[1] == stored
+    assert ids[3] == ids[0]
+    assert len({stored, ids[0], ids[2]}) == 3
+    assert page_ids(storage, 'alice@example.com', False, None) == sorted({stored, ids[0], ids[2]})
+
+
+def test_select_email_page_orders_by_received_time_then_id(storage):
+    ids = store(storage, 3)
+    [same_time] = storage.insert_email_batch([message(received='2024-01-01 10:01:00')])
+    expected = [ids[0], ids[1], same_time, ids[2]]
+    assert page_ids(storage, 'alice@example.com', False, None) == expected
+    assert page_ids(storage, 'Alice@Example.com', True, None) == expected[::-1]
+    assert page_ids(storage, 'alice@example.com', False, 2, offset=1) == expected[1:3]
+
+
+def test_select_email_page_continues_after_position(storage):
+    ids = store(storage, 5)
+    store(storage, 2, to='bob@example.com')
+    for scan_desc in (False, True):
+        expected = ids[::-1] if scan_desc else ids
+        seen = []
+        position = None
+        while True:
+            with storage.cursor() as cursor:
+                rows = storage.select_email_page(cursor, 'alice@example.com', COLUMNS, scan_desc, 2, 0, position)
+            if not rows:
+                break
+            seen.extend(row['id'] for row in rows)
+            position = (rows[-1]['received_time'], rows[-1]['id'])
+        assert seen == expected
+
+
+def test_select_new_emails_returns_mail_after_since_id(storage):
+    ids = store(storage, 4)
+    with storage.cursor() as cursor:
+        rows = storage.select_new_emails(cursor, 'alice@example.com', COLUMNS, ids[1], 10)
+    assert [row['id'] for row in rows] == ids[2:]
+
+
+def test_recipients_between_lists_every_role_of_the_range(storage):
+    first = storage.insert_email(message(to='bob@example.com'))
+    second = storage.insert_email(message(to='Alice@example.com', cc=['carol@example.com'], envelope_to=['dave@example.com']))
+    with storage.cursor() as cursor:
+        assert sorted(storage.recipients_between(cursor, first, second)) == [
+            'alice@example.com', 'carol@example.com', 'dave@example.com']
+        assert storage.recipients_between(cursor, second, second + 10) == []
+
+
+def test_delete_email(storage):
+    ids = store(storage, 2, cc=['carol@example.com'])
+    assert storage.delete_email(ids[0]) == (True, ['alice@example.com', 'carol@example.com'])
+    assert storage.delete_email(ids[0]) == (False, [])
+    assert page_ids(storage, 'alice@example.com', False, None) == ids[1:]
+    with storage.cursor() as cursor:
+        assert storage.select_parts(cursor, [ids[0]]) == {ids[0]: []}
+        assert len(storage.select_parts(cursor, [ids[1]])[ids[1]]) == 1
+
+
+def test_delete_all_emails_in_chunks(storage):
+    ids = store(storage, 5) + store(storage, 2, to='bob@example.com')
+    progress = []
+    with storage.cursor() as cursor:
+        newest = storage.newest_email_id(cursor)
+    assert newest == ids[-1]
+    deleted = storage.delete_all_emails(newest, chunk_size=3,
+                                        progress=lambda count, addresses: progress.append((count, addresses)))
+    assert deleted == 7
+    assert [count for count, addresses in progress] == [3, 3, 1]
+    assert progress[-1][1] == ['bob@example.com']
+    with storage.cursor() as cursor:
+        assert storage.newest_email_id(cursor) == 0
+    assert page_ids(storage, 'alice@example.com', False, None) == []
+
+
+def test_every_recipient_finds_the_email(storage):
+    data = message(to='alice@example.com', cc=['carol@example.com'],
+                   envelope_to=['Alice@example.com', 'dave@example.com'])
+    data['reply-to'] = [{'email': 'replies@example.com', 'name': None}]
+    [email_id] = storage.insert_email_batch([data])
+    for address in ['alice@example.com', 'carol@example.com', 'dave@example.com', 'replies@example.com']:
+        assert page_ids(storage, address, False, None) == [email_id]
+    with storage.cursor() as cursor:
+        assert storage.count_emails(cursor, 'alice@example.com', 'exact') == 1
+        assert storage.count_emails(cursor, 'dave@example.com', 'exact', ['to', 'cc']) == 0
+        assert storage.count_emails(cursor, 'dave@example.com', 'exact', ['bcc']) == 1
+        assert storage.count_emails(cursor, 'alice@example.com', 'none') is None
+        rows = storage.select_email_page(cursor, 'carol@example.com', COLUMNS, False, None, 0, roles=['to'])
+    assert rows == []
+
+
+def blob_refcounts(storage):
+    with storage.cursor() as cursor:
+        cursor.execute("SELECT digest, refcount FROM attachment_blobs")
+        return {row['digest']: row['refcount'] for row in cursor.fetchall()}
+
+
+def test_attachment_blobs_are_shared_and_reference_counted(storage):
+    shared = ('report.pdf', b'%PDF shared bytes')
+    first, second = storage.insert_email_batch([message(attachments=[shared, ('a.txt', b'only in the first')]),
+                                                message(attachments=[shared])])
+    [third] = storage.insert_email_batch([message(attachments=[shared, shared])])
+    with storage.cursor() as cursor:
+        attachments = storage.select_attachments(cursor, [first, second, third])
+    digest = attachments[first][0]['digest']
+    assert [a['digest'] for a in attachments[second] + attachments[third]] == [digest] * 3
+    assert blob_refcounts(storage) == {digest: 4, attachments[first][1]['digest']: 1}
+
+    storage.delete_email(first)
+    assert blob_refcounts(storage) == {digest: 3}
+    storage.delete_emails([second, third])
+    assert blob_refcounts(storage) == {}
+
+
+def test_read_blob_returns_the_requested_range(storage):
+    content = bytes(range(256)) * 4
+    [email_id] = storage.insert_email_batch([message(attachments=[('data.bin', content)])])
+    with storage.cursor() as cursor:
+        [attachment] = storage.select_attachments(cursor, [email_id])[email_id]
+        assert storage.select_attachment(cursor, email_id, attachment['id'])['size'] == len(content)
+        assert storage.select_attachment(cursor, email_id + 1, attachment['id']) is None
+        assert bytes(storage.read_blob(cursor, attachment['digest'], 0, 10)) == content[:10]
+        assert bytes(storage.read_blob(cursor, attachment['digest'], 1000, 100)) == content[1000:]
+    storage.delete_email(email_id)
+    with storage.cursor() as cursor:
+        assert storage.read_blob(cursor, attachment['digest'], 0, 10) is None
+
+
+def test_delete_all_emails_keeps_mail_stored_after_max_id(storage):
+    ids = store(storage, 4)
+    later = store(storage, 2)
+    assert storage.delete_all_emails(ids[-1], chunk_size=3) == 4
+    assert page_ids(storage, 'alice@example.com', False, None) == later
+
+
+def test_expired_emails_filters_by_literal_domain(storage):
+    underscore, = store(storage, 1, to='a@ex_ample.com')
+    other, = store(storage, 1, to='a@exxample.com')
+    percent, = store(storage, 1, to='b@100%.example.com')
+    with storage.cursor() as cursor:
+        cutoff = storage.current_time(cursor) + timedelta(minutes=1)
+        assert [email_id for _, email_id in storage.expired_emails(cursor, cutoff, 10)] == [underscore, other, percent]
+        assert [email_id for _, email_id in storage.expired_emails(cursor, cutoff, 10, 'ex_ample.com')] == [underscore]
+        assert [email_id for _, email_id in storage.expired_emails(cursor, cutoff, 10, '100%.example.com')] == [percent]
+        assert [email_id for _, email_id in storage.expired_emails(
+            cursor, cutoff, 10, exclude_domains=['ex_ample.com', '100%.example.com'])] == [other]
+        position = storage.expired_emails(cursor, cutoff, 1)[0]
+        assert [email_id for _, email_id in storage.expired_emails(cursor, cutoff, 10, position=position)] == [other, percent]
+        assert storage.expired_emails(cursor, cutoff - timedelta(days=1), 10) == []
+
+
+def recount(storage):
+    """The stats counters computed from the tables, as migrations/008_stats_counters.sql backfills them."""
+    with storage.cursor() as cursor:
+        cursor.execute(f"SELECT (SELECT COUNT(*) FROM emails) AS emails, "
+                       f"(SELECT COALESCE(SUM({storage.byte_length.format('content')}), 0) FROM email_parts) AS part_bytes, "
+                       f"(SELECT COALESCE(SUM(size), 0) FROM email_attachments) AS attachment_bytes, "
+                       f"(SELECT COALESCE(SUM(size), 0) FROM attachment_blobs) AS blob_bytes")
+        return {name: int(value) for name, value in cursor.fetchone().items()}
+
+
+def test_stats_counters_follow_inserts_and_deletes(storage):
+    shared = ('logo.png', b'\x89PNG' * 100)
+    ids = store(storage, 3, cc=['carol@other.example'], attachments=[shared])
+    ids += store(storage, 1, to='bob@example.com', body='x' * 1000)
+    with storage.cursor() as cursor:
+        stats = storage.stats(cursor, 2, 'Carol@other.example', 'example.com')
+    expected = recount(storage)
+    assert expected['attachment_bytes'] == 3 * expected['blob_bytes'] == 1200
+    assert {name: stats[key] for name, key in [('emails', 'total_email_count'), ('part_bytes', 'part_bytes'),
+                                               ('attachment_bytes', 'attachment_bytes'),
+                                               ('blob_bytes', 'attachment_stored_bytes')]} == expected
+    # Ties come in either order
+    assert sorted(stats['top_recipients'], key=lambda row: row['address']) == [
+        {'address': 'alice@example.com', 'emails': 3}, {'address': 'carol@other.example', 'emails': 3}]
+    assert stats['top_domains'] == [{'domain': 'example.com', 'emails': 4}, {'domain': 'other.example', 'emails': 3}]
+    assert stats['recipient'] == {'address': 'carol@other.example', 'emails': 3}
+    assert stats['domain'] == {'domain': 'example.com', 'emails': 4}
+    assert stats['ingest_rate']['1m']['emails'] == 4
+
+    storage.delete_emails(ids[:2])
+    storage.delete_email(ids[3])
+    with storage.cursor() as cursor:
+        stats = storage.stats(cursor, 10, 'bob@example.com')
+        assert storage.email_count(cursor) == 1
+    assert stats['total_email_count'] == 1
+    assert stats['part_bytes'] == recount(storage)['part_bytes']
+    assert stats['attachment_stored_bytes'] == 400
+    assert stats['recipient'] == {'address': 'bob@example.com', 'emails': 0}
+    assert sorted(stats['top_recipients'], key=lambda row: row['address']) == [
+        {'address': 'alice@example.com', 'emails': 1}, {'address': 'carol@other.example', 'emails': 1}]
+
+
+def search_ids(storage, query, **filters):
+    with storage.cursor() as cursor:
+        rows = storage.search_emails(cursor, parse_query(query), COLUMNS, 10, 0, **filters)
+    return [row['id'] for row in rows]
+
+
+def test_search_emails_matches_every_term(storage):
+    newsletter = message(subject='Newsletter', body='<style>p {color: red}</style><p>The quarterly&nbsp;report</p>')
+    newsletter['parts'][0]['content_type'] = 'text/html'
+    invoice, meeting, html = storage.insert_email_batch([
+        message(subject='Invoice 2024-117', body='Please pay the attached invoice by Friday.'),
+        message(subject='Planning meeting', body='The invoice review moves to the planning meeting on Monday.',
+                to='bob@example.com', sender='boss@example.org', received='2024-02-01 09:00:00'),
+        newsletter,
+    ])
+
+    assert search_ids(storage, 'invoice') == [invoice, meeting]
+    assert search_ids(storage, 'invoice monday') == [meeting]
+    assert search_ids(storage, '"planning meeting"') == [meeting]
+    assert search_ids(storage, '"meeting planning"') == []
+    assert search_ids(storage, 'plan*') == [meeting]
+    assert search_ids(storage, 'quarterly report') == [html]
+    assert search_ids(storage, 'color') == []
+    assert search_ids(storage, 'invoice', to_email='Bob@example.com') == [meeting]
+    assert search_ids(storage, 'invoice', to_email='bob@example.com', roles=['cc']) == []
+    assert search_ids(storage, 'invoice', from_email='BOSS@example.org') == [meeting]
+    assert search_ids(storage, 'invoice', since='2024-01-15 00:00:00') == [meeting]
+    assert search_ids(storage, 'invoice', until='2024-01-15 00:00:00') == [invoice]
+
+    storage.delete_email(meeting)
+    assert search_ids(storage, 'invoice') == [invoice]
+
+
+def test_index_emails_adds_unindexed_emails(storage):
+    ids = store(storage, 3, body='Shipment tracking details')
+    with storage.transaction() as cursor:
+        cursor.execute(f"DELETE FROM email_search WHERE {storage.search_id} IN (%s, %s)", ids[1:])
+    assert search_ids(storage, 'shipment') == ids[:1]
+    with storage.cursor() as cursor:
+        assert storage.unindexed_email_ids(cursor, 10) == ids[1:]
+        assert storage.unindexed_email_ids(cursor, 10, after_id=ids[1]) == ids[2:]
+        assert storage.unindexed_email_ids(cursor, 10, everything=True) == ids
+    storage.index_emails(ids)
+    assert sorted(search_ids(storage, 'shipment')) == ids
+    with storage.cursor() as cursor:
+        assert storage.unindexed_email_ids(cursor, 10) == []